@@ -0,0 +1,354 @@
+"""
+Drive the real dispatcher with registered handlers using synthetic
+updates and a fake bot which records sent messages. Reports throughput,
+handler latency and db round trips per update as JSON, for thread per
+update dispatcher and asyncio one.
+Needs db configured in settings with schema migrated by `python -m db.migrate`. Rows
+created by the benchmark are removed after every scenario.
+Usage: `python -m benchmarks.bot_benchmark [--scenario mixed] [--mode async]
+[--updates 2000] [--output results.json]`
+"""
+# pylint: disable=wrong-import-order,unused-import
+# imported first to lift telegram rate limits before settings are read
+from benchmarks import limits  # noqa: F401
+
+import argparse
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from queue import Queue
+from typing import Any, Callable, Optional
+
+from telegram import Update
+
+from config import settings
+from db.queries import DBManager
+from handlers import register_admin_handlers, register_handlers
+from runtime.aio import stop_loop
+from runtime.metrics import POOL_CHECKOUT, QUERY_LATENCY
+from runtime.scheduler import AsyncDispatcher, OrderedDispatcher
+from runtime.sender import outbox
+from services import catalog, user_cache
+
+CHAT_BASE = 2_000_000_000
+ADMIN_CHAT = CHAT_BASE - 1
+CATEGORY_PREFIX = 'bench_'
+
+
+class FakeBot:
+    """
+    Bot recording sent messages instead of calling telegram.
+    """
+    id = 1
+    username = 'benchmark_bot'
+    first_name = 'Benchmark'
+    name = '@benchmark_bot'
+    defaults = None
+
+    def __init__(self, latency: float = 0.0) -> None:
+        """
+        :param latency: seconds every api call takes.
+        """
+        self.latency = latency
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def _call(self) -> bool:
+        if self.latency:
+            time.sleep(self.latency)
+        return True
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> bool:
+        self._call()
+        with self._lock:
+            self.sent += 1
+        return True
+
+    def answer_callback_query(self, *args, **kwargs) -> bool:
+        return self._call()
+
+    def edit_message_reply_markup(self, *args, **kwargs) -> bool:
+        return self._call()
+
+
+class Timings:
+    """
+    Processing time of every update and time from queueing to the end
+    of processing, recorded by dispatchers below.
+    """
+
+    def __init__(self) -> None:
+        self.queued_at: dict[int, float] = {}
+        self.handler_seconds: list[float] = []
+        self.total_seconds: list[float] = []
+        self._timings_lock = threading.Lock()
+
+    def record(self, update: Any, started: float) -> None:
+        finished = time.perf_counter()
+        with self._timings_lock:
+            self.handler_seconds.append(finished - started)
+            queued_at = self.queued_at.pop(update.update_id, None)
+            if queued_at is not None:
+                self.total_seconds.append(finished - queued_at)
+
+
+class TimedDispatcher(OrderedDispatcher, Timings):
+    """
+    Thread per update dispatcher recording timings.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        OrderedDispatcher.__init__(self, *args, **kwargs)
+        Timings.__init__(self)
+
+    def _process_now(self, update: Any) -> None:
+        started = time.perf_counter()
+        super()._process_now(update)
+        self.record(update, started)
+
+
+class TimedAsyncDispatcher(AsyncDispatcher, Timings):
+    """
+    Asyncio dispatcher recording timings.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        AsyncDispatcher.__init__(self, *args, **kwargs)
+        Timings.__init__(self)
+
+    async def process_update_async(self, update: Update) -> None:
+        started = time.perf_counter()
+        await super().process_update_async(update)
+        self.record(update, started)
+
+
+class UpdateFactory:
+    """
+    Synthetic updates in telegram json format.
+    """
+
+    def __init__(self, bot: FakeBot) -> None:
+        self.bot = bot
+        self._ids = itertools.count(1)
+
+    def message(self, chat_id: int, text: str) -> Update:
+        data = {
+            'update_id': next(self._ids),
+            'message': {
+                'message_id': next(self._ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'},
+                'text': text,
+            },
+        }
+        if text.startswith('/'):
+            data['message']['entities'] = [
+                {'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}
+            ]
+        return Update.de_json(data, self.bot)
+
+
+def percentile(values: list[float], share: float) -> float:
+    """
+    :return: value below which `share` of sorted values lie, in milliseconds.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] * 1000
+
+
+def create_categories(count: int) -> list[str]:
+    """
+    Insert benchmark categories directly and reload catalog.
+    :return: codenames.
+    """
+    codenames = [f'{CATEGORY_PREFIX}{number:05}' for number in range(count)]
+    with DBManager().transaction() as db_manager:
+        db_manager.insert_many(
+            'category', ('codename', 'title', 'description', 'type'),
+            [(codename, f'Bench {codename}', 'Benchmark category', 'expense')
+             for codename in codenames],
+        )
+    catalog.invalidate()
+    return codenames
+
+
+def cleanup() -> None:
+    """
+    Remove rows created by benchmark.
+    """
+    with DBManager().transaction() as db_manager:
+        for table_name in ('ledger', 'ledger_daily', 'ledger_monthly', 'telegram_user'):
+            db_manager.execute(f'DELETE FROM {table_name} WHERE chat_id >= %s', (ADMIN_CHAT,))
+        db_manager.execute('DELETE FROM category WHERE codename LIKE %s', (CATEGORY_PREFIX + '%',))
+    catalog.invalidate()
+    user_cache.clear()
+
+
+def start_storm(factory: UpdateFactory, updates: int) -> list[Update]:
+    """
+    Every update is `/start` from a new user.
+    """
+    return [factory.message(CHAT_BASE + number, '/start') for number in range(updates)]
+
+
+def admin_categories(factory: UpdateFactory, updates: int,
+                     categories: int = 5000) -> list[Update]:
+    """
+    Admin lists categories while catalog holds thousands of them.
+    """
+    create_categories(categories)
+    return [factory.message(ADMIN_CHAT, '/admin_categories') for _ in range(updates)]
+
+
+def mixed(factory: UpdateFactory, updates: int, users: int = 200,
+          categories: int = 50) -> list[Update]:
+    """
+    Users mostly record expenses, sometimes ask for report or listing.
+    Every user starts with `/start`.
+    """
+    codenames = create_categories(categories)
+    rng = random.Random(1)
+    result = [factory.message(CHAT_BASE + number, '/start') for number in range(users)]
+    for _ in range(updates - len(result)):
+        chat_id = CHAT_BASE + rng.randrange(users)
+        kind = rng.random()
+        if kind < 0.8:
+            text = f'{rng.randint(1, 500)}.{rng.randint(0, 99):02} {rng.choice(codenames)} lunch'
+        elif kind < 0.9:
+            text = '/report'
+        else:
+            text = '/entries'
+        result.append(factory.message(chat_id, text))
+    return result
+
+
+SCENARIOS: dict[str, Callable[..., list[Update]]] = {
+    'start_storm': start_storm,
+    'admin_categories': admin_categories,
+    'mixed': mixed,
+}
+
+
+MODES = ('sync', 'async')
+
+
+def run_scenario(name: str, updates: int, workers: int, send_latency: float,
+                 mode: str = 'sync') -> dict[str, Any]:
+    """
+    Feed scenario updates to dispatcher as fast as possible and wait until
+    they are processed and replies are delivered to fake bot.
+    :param workers: threads processing updates, in async mode threads
+           running sync handlers.
+    :param mode: `sync` for thread per update dispatcher, `async` for asyncio one.
+    :return: scenario results.
+    """
+    cleanup()
+    bot = FakeBot(send_latency)
+    if mode == 'async':
+        dispatcher = TimedAsyncDispatcher(bot, Queue(), max_updates=settings.ASYNC_MAX_UPDATES,
+                                          sync_workers=workers, max_chat_queue=max(updates, 1))
+    else:
+        dispatcher = TimedDispatcher(bot, Queue(), chat_workers=workers,
+                                     max_chat_queue=max(updates, 1))
+    register_handlers(dispatcher)
+    register_admin_handlers(dispatcher)
+    batch = SCENARIOS[name](UpdateFactory(bot), updates)
+
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+    queries_before, checkouts_before = QUERY_LATENCY.total(), POOL_CHECKOUT.total()
+    started = time.perf_counter()
+    for update in batch:
+        dispatcher.queued_at[update.update_id] = time.perf_counter()
+        dispatcher.update_queue.put(update)
+    while dispatcher.queue_depth():
+        time.sleep(0.001)
+    processed = time.perf_counter() - started
+    while outbox.depth():
+        time.sleep(0.001)
+    delivered = time.perf_counter() - started
+    queries = QUERY_LATENCY.total() - queries_before
+    checkouts = POOL_CHECKOUT.total() - checkouts_before
+    dispatcher.stop()
+    thread.join()
+    cleanup()
+
+    return {
+        'mode': mode,
+        'updates': len(batch),
+        'workers': workers,
+        'seconds': round(processed, 4),
+        'updates_per_second': round(len(batch) / processed, 1),
+        'handler_p50_ms': round(percentile(dispatcher.handler_seconds, 0.5), 3),
+        'handler_p99_ms': round(percentile(dispatcher.handler_seconds, 0.99), 3),
+        'latency_p50_ms': round(percentile(dispatcher.total_seconds, 0.5), 3),
+        'latency_p99_ms': round(percentile(dispatcher.total_seconds, 0.99), 3),
+        'queries_per_update': round(queries / len(batch), 3),
+        'checkouts_per_update': round(checkouts / len(batch), 3),
+        'messages_sent': bot.sent,
+        'delivered_seconds': round(delivered, 4),
+    }
+
+
+def git_commit() -> Optional[str]:
+    """
+    :return: current commit hash, None outside git checkout.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    """
+    Run scenarios and print JSON results.
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--scenario', choices=sorted(SCENARIOS), action='append',
+                            help='scenario to run, all by default, can be repeated')
+    arg_parser.add_argument('--mode', choices=MODES, action='append',
+                            help='dispatcher to run scenarios with, both by default')
+    arg_parser.add_argument('--updates', type=int, default=2000)
+    arg_parser.add_argument('--workers', type=int, default=settings.SCHEDULER_WORKERS)
+    arg_parser.add_argument('--send-latency', type=float, default=0.0,
+                            help='milliseconds every fake api call takes')
+    arg_parser.add_argument('--output', help='file to write JSON to, stdout by default')
+    args = arg_parser.parse_args()
+
+    settings.ADMIN_CHATS.append(ADMIN_CHAT)
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'scenarios': {
+            name: {
+                mode: run_scenario(
+                    name, args.updates, args.workers, args.send_latency / 1000, mode
+                )
+                for mode in args.mode or MODES
+            }
+            for name in args.scenario or SCENARIOS
+        },
+    }
+    stop_loop(timeout=10)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Measure budget evaluation time for many users.
+Needs db configured in settings with schema migrated by `python -m db.migrate`. Synthetic
+users, budgets and monthly totals are removed after the run.
+Usage: `python -m benchmarks.budget_benchmark [--users 200000]`
+"""
+import argparse
+import time
+
+from db.queries import DBManager
+from services import Budget
+from services.budget import current_month
+
+CHAT_BASE = 2_000_000_000
+CODENAMES = ('bench_food', 'bench_rent')
+
+
+def populate(db_manager: DBManager, users: int) -> None:
+    """
+    Create users with budget and monthly total in every category.
+    A third of totals is below warning share, a third between warning
+    share and budget, a third above budget.
+    """
+    month = current_month()
+    db_manager.execute(
+        'INSERT INTO category (codename, title, description, type) '
+        "SELECT c, c, 'Benchmark category', 'expense' FROM unnest(%s) c",
+        (list(CODENAMES),),
+    )
+    db_manager.execute(
+        "INSERT INTO telegram_user (chat_id, is_bot, first_name) "
+        "SELECT %s + n, false, 'user' FROM generate_series(0, %s - 1) n",
+        (CHAT_BASE, users),
+    )
+    db_manager.execute(
+        "INSERT INTO budget (chat_id, codename, currency, amount) "
+        "SELECT %s + n, c, 'USD', 100 FROM generate_series(0, %s - 1) n, unnest(%s) c",
+        (CHAT_BASE, users, list(CODENAMES)),
+    )
+    db_manager.execute(
+        'INSERT INTO ledger_monthly (chat_id, codename, type, currency, month, total, entries) '
+        "SELECT %s + n, c, 'expense', 'USD', %s, 50 + (n %% 3) * 40, 1 "
+        'FROM generate_series(0, %s - 1) n, unnest(%s) c',
+        (CHAT_BASE, month, users, list(CODENAMES)),
+    )
+    db_manager.execute('ANALYZE budget')
+    db_manager.execute('ANALYZE ledger_monthly')
+
+
+def cleanup() -> None:
+    """
+    Remove synthetic rows.
+    """
+    with DBManager().transaction() as db_manager:
+        for table_name in ('budget', 'ledger_monthly', 'telegram_user'):
+            db_manager.execute(f'DELETE FROM {table_name} WHERE chat_id >= %s', (CHAT_BASE,))
+        db_manager.execute('DELETE FROM category WHERE codename = ANY(%s)', (list(CODENAMES),))
+
+
+def main() -> None:
+    """
+    Print time of first check, which finds alerts, and of repeated
+    check, which finds nothing new.
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--users', type=int, default=200000)
+    args = arg_parser.parse_args()
+
+    cleanup()
+    started = time.perf_counter()
+    with DBManager().transaction() as db_manager:
+        populate(db_manager, args.users)
+    print(f'{args.users * len(CODENAMES)} budgets created in '
+          f'{time.perf_counter() - started:.1f} s')
+    try:
+        for label in ('first check', 'repeated check'):
+            started = time.perf_counter()
+            alerts = Budget.check()
+            print(f'{label:<16} {time.perf_counter() - started:8.3f} s, {len(alerts)} alerts')
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
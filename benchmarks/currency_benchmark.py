@@ -0,0 +1,169 @@
+"""
+Compare converting ledger rows to one currency one by one in Python
+with converted reports summed from daily rollups in db.
+Needs db configured in settings with schema migrated by `python -m db.migrate`. Synthetic
+users, entries, rollups and rates are removed after the run.
+Usage: `python -m benchmarks.currency_benchmark [--rows 1000000] [--chats 100] [--months 6]`
+"""
+import argparse
+import time
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import Decimal
+
+from config.settings import DEFAULT_CURRENCY, REPORT_TIMEZONE
+from db.queries import DBManager, Range
+from services import LedgerPartitions, Rates, Rollup, rate_cache
+from services.partitions import month_start, next_month, report_timezone
+
+CHAT_BASE = 2_000_000_000
+CODENAMES = ('bench_food', 'bench_rent')
+# codes reserved for testing and bond units, never used by real entries
+CURRENCIES = ('XTS', 'XBA')
+TARGET = CURRENCIES[0]
+
+
+def months_after_current(count: int) -> list[date]:
+    """
+    :return: first days of `count` months after current one,
+             they are never archived.
+    """
+    month = datetime.now(report_timezone).date().replace(day=1)
+    months = []
+    for _ in range(count):
+        month = next_month(month)
+        months.append(month)
+    return months
+
+
+def populate(db_manager: DBManager, rows: int, chats: int, months: list[date]) -> None:
+    """
+    Create users, entries spread over months in default and benchmark
+    currencies, daily rollups of entries and daily rates without Sundays,
+    so some days use rate of previous day.
+    """
+    since, until = month_start(months[0]), month_start(next_month(months[-1]))
+    LedgerPartitions.create(since, until, db_manager=db_manager)
+    db_manager.execute(
+        'INSERT INTO category (codename, title, description, type) '
+        "SELECT c, c, 'Benchmark category', 'expense' FROM unnest(%s) c",
+        (list(CODENAMES),),
+    )
+    db_manager.execute(
+        "INSERT INTO telegram_user (chat_id, is_bot, first_name) "
+        "SELECT %s + n, false, 'user' FROM generate_series(0, %s - 1) n",
+        (CHAT_BASE, chats),
+    )
+    db_manager.execute(
+        'INSERT INTO ledger (chat_id, codename, amount, currency, created_at) '
+        'SELECT %s + n %% %s, (%s::text[])[1 + n %% 2], round((1 + random() * 99)::numeric, 2), '
+        '(%s::text[])[1 + n %% 3], %s + random() * (%s - %s::timestamptz) '
+        'FROM generate_series(0, %s - 1) n',
+        (CHAT_BASE, chats, list(CODENAMES), [DEFAULT_CURRENCY, *CURRENCIES],
+         since, until, since, rows),
+    )
+    db_manager.execute(
+        'INSERT INTO currency_rate (currency, day, rate) '
+        'SELECT c, d::date, round((0.5 + random())::numeric, 4) '
+        "FROM unnest(%s) c, generate_series(%s, %s, interval '1 day') d "
+        'WHERE extract(isodow FROM d) <> 7 OR d = %s',
+        (list(CURRENCIES), months[0], next_month(months[-1]), months[0]),
+    )
+    db_manager.execute(
+        'INSERT INTO ledger_daily (chat_id, codename, type, currency, day, total, entries) '
+        "SELECT chat_id, codename, 'expense'::category_type, currency, "
+        '(created_at AT TIME ZONE %s)::date, sum(amount), count(*) '
+        'FROM ledger WHERE chat_id >= %s GROUP BY 1, 2, 3, 4, 5',
+        (REPORT_TIMEZONE, CHAT_BASE),
+    )
+    for table_name in ('ledger', 'ledger_daily', 'currency_rate'):
+        db_manager.execute(f'ANALYZE {table_name}')
+
+
+def cleanup() -> None:
+    """
+    Remove synthetic rows.
+    """
+    with DBManager().transaction() as db_manager:
+        for table_name in ('ledger', 'ledger_daily', 'ledger_monthly', 'telegram_user'):
+            db_manager.execute(f'DELETE FROM {table_name} WHERE chat_id >= %s', (CHAT_BASE,))
+        db_manager.execute(
+            'DELETE FROM currency_rate WHERE currency = ANY(%s)', (list(CURRENCIES),)
+        )
+        db_manager.execute('DELETE FROM category WHERE codename = ANY(%s)', (list(CODENAMES),))
+    rate_cache.clear()
+
+
+def convert_rows() -> dict[tuple, Decimal]:
+    """
+    Stream every entry and convert it with cached rate of its day.
+    :return: converted totals by chat, month and codename.
+    """
+    totals: dict[tuple, Decimal] = defaultdict(Decimal)
+    rows = DBManager().select_iter(
+        'ledger', ('chat_id', 'codename', 'amount', 'currency', 'created_at'),
+        {'chat_id': Range(CHAT_BASE)},
+    )
+    for chat_id, codename, amount, currency, created_at in rows:
+        day = created_at.astimezone(report_timezone).date()
+        totals[(chat_id, day.replace(day=1), codename)] += Rates.convert(
+            amount, currency, TARGET, day
+        )
+    return totals
+
+
+def convert_reports(chats: int, months: list[date]) -> dict[tuple, Decimal]:
+    """
+    Read converted report of every chat and month.
+    :return: converted totals by chat, month and codename.
+    """
+    totals = {}
+    for chat_id in range(CHAT_BASE, CHAT_BASE + chats):
+        for month in months:
+            for row in Rollup.get_report(chat_id, 'month', month, TARGET):
+                totals[(chat_id, month, row.codename)] = row.total
+    return totals
+
+
+def main() -> None:
+    """
+    Print time of both conversions and the largest difference of their totals.
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--rows', type=int, default=1_000_000)
+    arg_parser.add_argument('--chats', type=int, default=100)
+    arg_parser.add_argument('--months', type=int, default=6)
+    args = arg_parser.parse_args()
+    months = months_after_current(args.months)
+
+    cleanup()
+    started = time.perf_counter()
+    with DBManager().transaction() as db_manager:
+        populate(db_manager, args.rows, args.chats, months)
+    print(f'{args.rows} entries created in {time.perf_counter() - started:.1f} s')
+    try:
+        started = time.perf_counter()
+        by_row = convert_rows()
+        elapsed = time.perf_counter() - started
+        stats = rate_cache.stats()
+        print(f'{"per row in python":<24} {elapsed:8.3f} s, {args.rows / elapsed:10.0f} rows/s, '
+              f'rate cache hit rate {stats["hit_rate"]:.3f}')
+
+        started = time.perf_counter()
+        by_report = convert_reports(args.chats, months)
+        elapsed = time.perf_counter() - started
+        reports = args.chats * len(months)
+        print(f'{"reports from rollups":<24} {elapsed:8.3f} s, '
+              f'{elapsed / reports * 1000:10.2f} ms/report')
+
+        difference = max(
+            abs(by_row.get(key, Decimal(0)).quantize(Decimal('0.01')) - by_report.get(key, 0))
+            for key in by_row.keys() | by_report.keys()
+        )
+        print(f'max difference of totals {difference}')
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
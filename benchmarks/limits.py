@@ -0,0 +1,15 @@
+"""
+Lift telegram rate limits and flood control for benchmarks. Imported
+before config.settings, so limits are read from the environment set here.
+"""
+import os
+
+# telegram rate limits are not benchmarked, outbound queue adds only its overhead
+os.environ.setdefault("SENDER_GLOBAL_RATE", '1000000')
+os.environ.setdefault("SENDER_CHAT_RATE", '1000000')
+os.environ.setdefault("SENDER_CHAT_BURST", '1000000')
+# every update reaches handlers, flood control adds only its overhead
+for budget in ('', 'EXPENSIVE_', 'ADMIN_'):
+    os.environ.setdefault(f"FLOOD_{budget}RATE", '1000000')
+    os.environ.setdefault(f"FLOOD_{budget}BURST", '1000000')
+os.environ.setdefault("FLOOD_SHED_DEPTH", '0')
@@ -0,0 +1,84 @@
+"""
+Measure expense messages parsed per second with large alias catalog.
+Does not need db: index is built from synthetic aliases.
+Usage: `python -m benchmarks.parser_benchmark [--aliases 5000] [--messages 100000]`
+"""
+import argparse
+import random
+import string
+import time
+
+from services.parser import AliasIndex, ExpenseParser
+
+
+def make_aliases(count: int, categories: int) -> list[tuple[str, str]]:
+    """
+    :return: pairs of random alias and codename. Every tenth alias has two words.
+    """
+    rng = random.Random(1)
+    aliases = set()
+    while len(aliases) < count:
+        word = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10)))
+        if len(aliases) % 10 == 0:
+            word += ' ' + ''.join(rng.choices(string.ascii_lowercase, k=5))
+        aliases.add(word)
+    return [(alias, f'cat{number % categories}') for number, alias in enumerate(sorted(aliases))]
+
+
+def make_messages(aliases: list[tuple[str, str]], count: int) -> list[str]:
+    """
+    :return: messages with exact aliases, prefixes, typos and diacritics.
+    """
+    rng = random.Random(2)
+    messages = []
+    for number in range(count):
+        alias = rng.choice(aliases)[0]
+        kind = number % 4
+        if kind == 1:
+            alias = alias.split()[0][:-1]
+        elif kind == 2:
+            word = alias.split()[0]
+            position = rng.randint(1, len(word) - 1)
+            alias = word[:position] + rng.choice(string.ascii_lowercase) + word[position + 1:]
+        elif kind == 3:
+            alias = alias.capitalize().replace('e', 'é')
+        messages.append(f'{rng.randint(1, 999)}.{rng.randint(0, 99):02d} {alias} at work')
+    return messages
+
+
+def main() -> None:
+    """
+    Build index, parse messages and print throughput.
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--aliases', type=int, default=5000)
+    arg_parser.add_argument('--categories', type=int, default=200)
+    arg_parser.add_argument('--messages', type=int, default=100000)
+    args = arg_parser.parse_args()
+
+    aliases = make_aliases(args.aliases, args.categories)
+    messages = make_messages(aliases, args.messages)
+
+    started = time.perf_counter()
+    index = AliasIndex(aliases)
+    build_time = time.perf_counter() - started
+
+    parser = ExpenseParser(lambda: index, ['USD'], 'USD')
+    parsed = failed = 0
+    started = time.perf_counter()
+    for message in messages:
+        try:
+            parser.parse(message)
+            parsed += 1
+        except Exception:  # pylint: disable=broad-except
+            failed += 1
+    elapsed = time.perf_counter() - started
+
+    print(f'aliases: {index.size}, index build: {build_time * 1000:.1f} ms')
+    print(f'messages: {len(messages)}, parsed: {parsed}, unresolved: {failed}')
+    print(f'throughput: {len(messages) / elapsed:,.0f} messages/s, '
+          f'{elapsed / len(messages) * 1e6:.1f} us/message')
+
+
+if __name__ == '__main__':
+    main()
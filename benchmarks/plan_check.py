@@ -0,0 +1,52 @@
+"""
+Check that queries of hot paths are served by indexes. Bot benchmark
+scenarios are run to make DBManager produce real statement shapes,
+then generic plan of every shape is explained with sequential scans
+disabled. Exits with status 1 if any of them reads a large table whole.
+Needs db configured in settings with schema migrated by `python -m db.migrate`.
+Usage: `python -m benchmarks.plan_check [--updates 300]`
+"""
+# pylint: disable=wrong-import-order
+import argparse
+import sys
+
+# imported first to lift telegram rate limits before settings are read
+from benchmarks.bot_benchmark import ADMIN_CHAT, SCENARIOS, run_scenario
+
+import psycopg2
+
+from config import settings
+from db.migrate import check_plans
+from db.queries import recorded_queries
+
+
+def main() -> None:
+    """
+    Print queries reading large tables without index.
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--updates', type=int, default=300)
+    args = arg_parser.parse_args()
+
+    settings.ADMIN_CHATS.append(ADMIN_CHAT)
+    for name in SCENARIOS:
+        run_scenario(name, args.updates, settings.SCHEDULER_WORKERS, 0.0)
+
+    connection = psycopg2.connect(**settings.DB_CONNECTION)
+    try:
+        queries = list(recorded_queries(connection))
+        problems, skipped = check_plans(connection, queries)
+    finally:
+        connection.close()
+
+    print(f'Explained {len(queries) - len(skipped)} of {len(queries)} queries')
+    for reason in skipped:
+        print(f'Skipped {reason}')
+    for problem in problems:
+        print(f'{problem.node} on {problem.table} in {problem.label}: {problem.query}')
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
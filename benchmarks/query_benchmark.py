@@ -0,0 +1,72 @@
+"""
+Compare statement building and execution overhead of the old
+f-string queries with cached and prepared statements of DBManager.
+Needs db configured in settings with schema migrated by `python -m db.migrate`.
+Usage: `python -m benchmarks.query_benchmark [--queries 20000]`
+"""
+import argparse
+import time
+from typing import Callable
+
+from db.queries import DBManager, as_filter, select_statement
+
+
+def legacy_select_text(table_name: str, cols: tuple, filters: dict) -> str:
+    """
+    Query text built the way DBManager built it before statement cache.
+    """
+    columns = ', '.join(cols)
+    where = 'WHERE ' + ' AND '.join(f'{key}=%s' for key in filters) if filters else ''
+    return f'SELECT {columns} FROM {table_name} {where}'
+
+
+def timed(label: str, count: int, run: Callable[[int], None]) -> float:
+    """
+    Run `run` count times and print time per call.
+    :return: microseconds per call.
+    """
+    started = time.perf_counter()
+    for number in range(count):
+        run(number)
+    per_call = (time.perf_counter() - started) / count * 1e6
+    print(f'{label:<45} {per_call:8.1f} us/query')
+    return per_call
+
+
+def main() -> None:
+    """
+    Print build and execution time per query for both approaches.
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--queries', type=int, default=20000)
+    args = arg_parser.parse_args()
+
+    table_name = 'telegram_user'
+    cols = ('chat_id', 'is_bot', 'first_name', 'last_name', 'username', 'language_code')
+    db_manager = DBManager()
+
+    print('statement build')
+    timed('legacy f-string', args.queries,
+          lambda number: legacy_select_text(table_name, cols, {'chat_id': number}))
+    with db_manager.pool.connection() as connection:
+        timed('cached statement', args.queries, lambda number: select_statement(
+            table_name, cols, as_filter({'chat_id': number}), (), False, None
+        ).text(connection))
+
+    print('execution on one connection')
+    with db_manager.pool.connection() as connection, connection.cursor() as cursor:
+        legacy = timed('legacy f-string + execute', args.queries, lambda number: (
+            cursor.execute(legacy_select_text(table_name, cols, {'chat_id': number}),
+                           (number,)),
+            cursor.fetchall(),
+        ))
+        connection.rollback()
+
+    with db_manager.transaction():
+        cached = timed('DBManager.select (cached, prepared)', args.queries,
+                       lambda number: db_manager.select(table_name, cols, {'chat_id': number}))
+    print(f'speedup: {legacy / cached:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
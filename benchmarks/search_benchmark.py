@@ -0,0 +1,170 @@
+"""
+Compare `/search` queries using full-text index on ledger notes with
+regular expression scan of chat entries and with cached pages.
+Chats have very different number of entries, words of notes are
+common or rare. Needs db configured in settings with schema migrated
+by `python -m db.migrate`. Synthetic users and entries are removed after the run.
+Usage: `python -m benchmarks.search_benchmark [--rows 3000000] [--chats 1000] [--months 3]`
+"""
+import argparse
+import statistics
+import time
+from datetime import date
+
+from db.queries import DBManager
+from services import LedgerEntry, LedgerPartitions, search_cache
+from services.partitions import month_start, next_month
+from .currency_benchmark import months_after_current
+
+CHAT_BASE = 2_000_000_000
+CODENAME = 'bench_search'
+VOCABULARY = 1000
+PAGE_SIZE = 51
+QUERIES = 20
+
+# newest page of chat entries having words found by regular expression,
+# `\m` is start of word, so words match by prefix as in search
+_SCAN = '''
+    SELECT id FROM ledger
+    WHERE chat_id = %s AND note ~* %s
+    ORDER BY created_at DESC, id DESC LIMIT %s
+'''
+
+
+def word(number: int) -> str:
+    """
+    :return: word of vocabulary, no word is a prefix of another one.
+    """
+    return f'w{number}x'
+
+
+def populate(db_manager: DBManager, rows: int, chats: int, months: list[date]) -> None:
+    """
+    Create users and entries spread over months. Chat of entry is skewed,
+    so the first chats have most of entries. Notes have three words, word
+    `n` is used about `1 / n` times as often as the first one.
+    """
+    since, until = month_start(months[0]), month_start(next_month(months[-1]))
+    LedgerPartitions.create(since, until, db_manager=db_manager)
+    db_manager.execute(
+        'INSERT INTO category (codename, title, description, type) '
+        "VALUES (%s, %s, 'Benchmark category', 'expense')",
+        (CODENAME, CODENAME),
+    )
+    db_manager.execute(
+        "INSERT INTO telegram_user (chat_id, is_bot, first_name) "
+        "SELECT %s + n, false, 'user' FROM generate_series(0, %s - 1) n",
+        (CHAT_BASE, chats),
+    )
+    db_manager.execute(
+        'INSERT INTO ledger (chat_id, codename, amount, currency, note, created_at) '
+        'SELECT %s + floor(%s * power(random(), 3))::int, %s, '
+        "round((1 + random() * 99)::numeric, 2), 'USD', "
+        "concat_ws(' ', 'w' || floor(power(%s, random()))::int || 'x', "
+        "'w' || floor(power(%s, random()))::int || 'x', "
+        "'w' || floor(power(%s, random()))::int || 'x'), "
+        '%s + random() * (%s - %s::timestamptz) '
+        'FROM generate_series(0, %s - 1) n',
+        (CHAT_BASE, chats, CODENAME, VOCABULARY, VOCABULARY, VOCABULARY,
+         since, until, since, rows),
+    )
+    db_manager.execute('ANALYZE ledger')
+
+
+def cleanup() -> None:
+    """
+    Remove synthetic rows.
+    """
+    with DBManager().transaction() as db_manager:
+        for table_name in ('ledger', 'ledger_daily', 'ledger_monthly', 'telegram_user'):
+            db_manager.execute(f'DELETE FROM {table_name} WHERE chat_id >= %s', (CHAT_BASE,))
+        db_manager.execute('DELETE FROM category WHERE codename = %s', (CODENAME,))
+    search_cache.clear()
+
+
+def chat_sizes() -> list[tuple[int, int]]:
+    """
+    :return: `(chat_id, entries)` of synthetic chats, largest first.
+    """
+    return DBManager().execute(
+        'SELECT chat_id, count(*) FROM ledger WHERE chat_id >= %s '
+        'GROUP BY chat_id ORDER BY 2 DESC',
+        (CHAT_BASE,), fetch='all',
+    )
+
+
+def scan(chat_id: int, words: tuple[str, ...]) -> list[int]:
+    """
+    :return: ids of the first page found by regular expression.
+    """
+    pattern = ''.join(f'(?=.*\\m{word})' for word in words)
+    rows = DBManager().execute(_SCAN, (chat_id, pattern, PAGE_SIZE), fetch='all')
+    return [entry_id for entry_id, in rows]
+
+
+def search(chat_id: int, words: tuple[str, ...]) -> list[int]:
+    """
+    :return: ids of the first page found by LedgerEntry.search.
+    """
+    return [entry.id for entry in LedgerEntry.search(chat_id, words, limit=PAGE_SIZE)]
+
+
+def measure(function, queries: list[tuple[int, tuple[str, ...]]]) -> tuple[float, list]:
+    """
+    :return: median milliseconds of query and results of queries.
+    """
+    timings = []
+    results = []
+    for chat_id, words in queries:
+        started = time.perf_counter()
+        results.append(function(chat_id, words))
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), results
+
+
+def main() -> None:
+    """
+    Print median time of page search by chat size and word frequency
+    and whether both ways find the same entries.
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--rows', type=int, default=3_000_000)
+    arg_parser.add_argument('--chats', type=int, default=1000)
+    arg_parser.add_argument('--months', type=int, default=3)
+    args = arg_parser.parse_args()
+    months = months_after_current(args.months)
+
+    cleanup()
+    started = time.perf_counter()
+    with DBManager().transaction() as db_manager:
+        populate(db_manager, args.rows, args.chats, months)
+    print(f'{args.rows} entries created in {time.perf_counter() - started:.1f} s')
+    try:
+        sizes = chat_sizes()
+        groups = {
+            'largest chats': [chat_id for chat_id, _ in sizes[:QUERIES]],
+            'median chats': [chat_id for chat_id, _ in sizes[len(sizes) // 2:][:QUERIES]],
+        }
+        words = {
+            'common word': lambda number: (word(1 + number % 3),),
+            'rare word': lambda number: (word(VOCABULARY - 1 - number),),
+            'two words': lambda number: (word(2), word(20 + number)),
+        }
+        print(f'{"":<30} {"regex scan":>12} {"index":>12} {"cached":>12}')
+        for group, chats in groups.items():
+            entries = dict(sizes)[chats[0]]
+            for kind, make_words in words.items():
+                queries = [(chat_id, make_words(number)) for number, chat_id in enumerate(chats)]
+                search_cache.clear()
+                scanned, expected = measure(scan, queries)
+                indexed, found = measure(search, queries)
+                cached, _ = measure(search, queries)
+                same = 'same' if found == expected else 'DIFFERENT'
+                print(f'{group + ", " + kind:<30} {scanned:9.2f} ms {indexed:9.2f} ms '
+                      f'{cached:9.2f} ms  {same} results, {entries} entries in first chat')
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,195 @@
 """
 Script for bot running
 """
-from telegram.ext import Updater
+import signal
+from multiprocessing.connection import Connection
+from queue import Queue
+
+from telegram import Bot
+from telegram.ext import JobQueue, Updater
+from telegram.utils.request import Request
 
 from config import settings
-from handlers import register_handlers, register_admin_handlers
+from db.pool import get_pool
+from db.replicas import get_router
+from handlers import flood_control, register_handlers, register_admin_handlers, register_jobs
+from runtime.aio import stop_loop
+from runtime.metrics import StatsGauge, registry, start_http_server, start_log_summary
+from runtime.persistence import persistence
+from runtime.scheduler import AsyncDispatcher, OrderedDispatcher
+from runtime.sender import outbox
+from runtime.shards import ShardedDispatcher, serve_shard
+from runtime.webhook import run_webhook
+from services import alias_catalog, catalog, rate_cache, search_cache, user_cache
+from services.ledger import ledger_writer
 
 
-def main() -> None:
+def build_updater() -> Updater:
+    """
+    Create updater with dispatcher processing chats concurrently
+    and updates of one chat in order. In asyncio mode updates are
+    tasks of event loop instead of jobs of worker threads.
+    """
+    bot = Bot(
+        token=settings.API_TOKEN,
+        request=Request(
+            con_pool_size=settings.SCHEDULER_WORKERS + settings.SENDER_WORKERS + 4
+        ),
+    )
+    job_queue = JobQueue()
+    if settings.ASYNC_MODE:
+        dispatcher = AsyncDispatcher(
+            bot, Queue(), job_queue=job_queue, persistence=persistence,
+            max_updates=settings.ASYNC_MAX_UPDATES,
+            sync_workers=settings.SCHEDULER_WORKERS,
+            max_chat_queue=settings.SCHEDULER_MAX_CHAT_QUEUE,
+        )
+    else:
+        dispatcher = OrderedDispatcher(
+            bot, Queue(), job_queue=job_queue, persistence=persistence,
+            chat_workers=settings.SCHEDULER_WORKERS,
+            max_chat_queue=settings.SCHEDULER_MAX_CHAT_QUEUE,
+        )
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def build_front() -> Updater:
+    """
+    Create updater of front process of sharded mode, it sends updates
+    to worker processes running `run_shard`.
+    """
+    bot = Bot(token=settings.API_TOKEN)
+    job_queue = JobQueue()
+    dispatcher = ShardedDispatcher(
+        bot, Queue(), job_queue=job_queue, shards=settings.SHARDS, target=run_shard,
+        restart_delay=settings.SHARD_RESTART_DELAY,
+        max_attempts=settings.SHARD_MAX_ATTEMPTS,
+        drain_timeout=settings.SHARD_DRAIN_TIMEOUT,
+    )
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def serve_metrics(port: int = settings.METRICS_PORT) -> None:
+    """
+    Serve metrics and log latency summary if configured.
+    """
+    if port:
+        start_http_server(port, settings.METRICS_LISTEN)
+    if settings.METRICS_LOG_INTERVAL:
+        start_log_summary(settings.METRICS_LOG_INTERVAL)
+
+
+def start_metrics(updater: Updater, port: int = settings.METRICS_PORT) -> None:
+    """
+    Register runtime state gauges, serve metrics and log
+    latency summary if configured.
+    """
+    dispatcher = updater.dispatcher
+    for name, documentation, collect in (
+        ('bot_db_pool', 'DB connection pool state.', get_pool().stats),
+        ('bot_scheduler', 'Update scheduler state.', (
+            dispatcher.stats if settings.ASYNC_MODE else dispatcher.scheduler.stats
+        )),
+        ('bot_sender', 'Outbound queue state.', outbox.queue_stats),
+        ('bot_flood', 'Flood control state.', flood_control.stats),
+        ('bot_user_cache', 'User cache state.', user_cache.stats),
+        ('bot_rate_cache', 'Currency rate cache state.', rate_cache.stats),
+        ('bot_search_cache', 'Search result cache state.', search_cache.stats),
+        ('bot_ledger_writer', 'Ledger batch writer state.', lambda: ledger_writer.stats),
+        ('bot_db_replicas', 'Read routing state.', get_router().replica_stats),
+        ('bot_persistence', 'User and chat data state.', persistence.memory_stats),
+    ):
+        registry.register(StatsGauge(name, documentation, collect))
+    serve_metrics(port)
+
+
+def setup(jobs: bool = True, metrics_port: int = settings.METRICS_PORT) -> Updater:
     """
-    Start bot with polling
+    Warm catalogs, create updater with registered handlers and start metrics.
+    :param jobs: register scheduled jobs.
+    :param metrics_port: port to serve metrics on.
     """
-    updater = Updater(token=settings.API_TOKEN)
+    for table_catalog in (catalog, alias_catalog):
+        table_catalog.warm()
+        table_catalog.listen()
+    updater = build_updater()
     register_handlers(updater.dispatcher)
     register_admin_handlers(updater.dispatcher)
-    updater.start_polling()
+    if jobs:
+        register_jobs(updater.job_queue)
+    start_metrics(updater, metrics_port)
+    return updater
+
+
+def shutdown() -> None:
+    """
+    Drop deferred updates, write changed user and chat data,
+    deliver queued messages and stop event loop.
+    """
+    flood_control.stop()
+    persistence.stop()
+    outbox.stop(timeout=10)
+    stop_loop(timeout=10)
+
+
+def run_shard(index: int, connection: Connection) -> None:
+    """
+    Worker process of sharded mode. Scheduled jobs run in the first
+    shard only, metrics of shard are served on METRICS_PORT + 1 + index.
+    Running workers share SENDER_GLOBAL_RATE equally.
+    """
+    updater = setup(
+        jobs=index == 0,
+        metrics_port=settings.METRICS_PORT and settings.METRICS_PORT + 1 + index,
+    )
+    serve_shard(
+        connection, updater, settings.SHARD_DRAIN_TIMEOUT,
+        on_workers=lambda workers: outbox.set_global_rate(settings.SENDER_GLOBAL_RATE / workers),
+    )
+    shutdown()
+
+
+def start_front() -> Updater:
+    """
+    Create front updater and serve its metrics. SIGUSR1 adds a shard,
+    SIGUSR2 removes the last one, chats are rebalanced between shards.
+    """
+    updater = build_front()
+    dispatcher = updater.dispatcher
+    registry.register(StatsGauge('bot_shards', 'Shard workers state.', dispatcher.stats))
+    serve_metrics()
+    signal.signal(signal.SIGUSR1, lambda *_: dispatcher.resize(dispatcher.shards + 1))
+    signal.signal(
+        signal.SIGUSR2, lambda *_: dispatcher.resize(max(dispatcher.shards - 1, 1))
+    )
+    return updater
+
+
+def main() -> None:
+    """
+    Start bot with webhook if WEBHOOK_URL is configured else with polling.
+    With SHARDS set updates are processed by worker processes.
+    """
+    updater = start_front() if settings.SHARDS else setup()
+
+    if settings.WEBHOOK_URL:
+        run_webhook(
+            updater,
+            url=settings.WEBHOOK_URL,
+            listen=settings.WEBHOOK_LISTEN,
+            port=settings.WEBHOOK_PORT,
+            secret_token=settings.WEBHOOK_SECRET,
+            max_queue_size=settings.WEBHOOK_MAX_QUEUE_SIZE,
+            cert=settings.WEBHOOK_CERT,
+            key=settings.WEBHOOK_KEY,
+        )
+    else:
+        updater.start_polling()
+        updater.idle()
+    if not settings.SHARDS:
+        shutdown()
 
 
 if __name__ == '__main__':
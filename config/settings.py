@@ -19,3 +19,156 @@ DB_CONNECTION = {
     'password': os.environ.get("DB_PASSWORD"),
     'user': os.environ.get("DB_USER"),
 }
+
+DB_POOL = {
+    'min_size': int(os.environ.get("DB_POOL_MIN_SIZE", 1)),
+    'max_size': int(os.environ.get("DB_POOL_MAX_SIZE", 10)),
+    'timeout': float(os.environ.get("DB_POOL_TIMEOUT", 5)),
+    'max_idle': float(os.environ.get("DB_POOL_MAX_IDLE", 300)),
+    'health_check_interval': float(os.environ.get("DB_POOL_HEALTH_CHECK_INTERVAL", 30)),
+}
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 600))
+
+# Webhook mode is used instead of polling when WEBHOOK_URL is set
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_CERT = os.environ.get("WEBHOOK_CERT")
+WEBHOOK_KEY = os.environ.get("WEBHOOK_KEY")
+WEBHOOK_MAX_QUEUE_SIZE = int(os.environ.get("WEBHOOK_MAX_QUEUE_SIZE", 1000))
+
+CURRENCIES = [
+    currency.strip().upper()
+    for currency in os.environ.get("CURRENCIES", 'USD').split(',')
+    if currency.strip()
+]
+DEFAULT_CURRENCY = CURRENCIES[0]
+# Currency rates by day are cached for this number of seconds, rates
+# loaded in other processes are used after cached ones expire
+RATE_CACHE_SIZE = int(os.environ.get("RATE_CACHE_SIZE", 10000))
+RATE_CACHE_TTL = float(os.environ.get("RATE_CACHE_TTL", 3600))
+
+LEDGER_BATCH_SIZE = int(os.environ.get("LEDGER_BATCH_SIZE", 500))
+LEDGER_BATCH_DELAY = float(os.environ.get("LEDGER_BATCH_DELAY", 0.05))
+LEDGER_WRITE_TIMEOUT = float(os.environ.get("LEDGER_WRITE_TIMEOUT", 10))
+# Pages of /search results are cached for SEARCH_CACHE_SIZE chats, at most
+# SEARCH_CACHE_PAGES pages of every chat. Pages of chat are dropped when it
+# writes to ledger, entries written by other processes are found after TTL
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 1000))
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", 300))
+SEARCH_CACHE_PAGES = int(os.environ.get("SEARCH_CACHE_PAGES", 10))
+
+# Timezone used to assign ledger entries to days and months in reports
+REPORT_TIMEZONE = os.environ.get("REPORT_TIMEZONE", 'UTC')
+
+# Rows fetched at once by server-side cursors
+DB_ITERSIZE = int(os.environ.get("DB_ITERSIZE", 500))
+
+# Statement is prepared on server after this number of executions, 0 disables
+DB_PREPARE_THRESHOLD = int(os.environ.get("DB_PREPARE_THRESHOLD", 5))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 1024))
+
+# Updates of different chats are processed in parallel by this number of
+# workers, updates of one chat are processed in order. Updates of chat with
+# SCHEDULER_MAX_CHAT_QUEUE pending updates are dropped, in asyncio mode too
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 8))
+SCHEDULER_MAX_CHAT_QUEUE = int(os.environ.get("SCHEDULER_MAX_CHAT_QUEUE", 100))
+
+# Asyncio mode: updates are processed as tasks of one event loop, at most
+# ASYNC_MAX_UPDATES at once, sync handlers run in SCHEDULER_WORKERS threads
+ASYNC_MODE = os.environ.get("ASYNC_MODE", '').lower() in ('1', 'true', 'yes')
+ASYNC_MAX_UPDATES = int(os.environ.get("ASYNC_MAX_UPDATES", 1000))
+# asyncpg pool of asyncio mode, `timeout` is seconds to connect to db or
+# to wait for free connection
+ASYNC_DB_POOL = {
+    'min_size': int(os.environ.get("ASYNC_DB_POOL_MIN_SIZE", 1)),
+    'max_size': int(os.environ.get("ASYNC_DB_POOL_MAX_SIZE", 20)),
+    'timeout': float(os.environ.get("ASYNC_DB_POOL_TIMEOUT", 5)),
+}
+
+# Sharded mode: front process routes updates by chat to this number of
+# worker processes, 0 processes updates in one process
+SHARDS = int(os.environ.get("SHARDS", 0))
+# Seconds before restarting crashed worker, doubled on every crash in a row
+SHARD_RESTART_DELAY = float(os.environ.get("SHARD_RESTART_DELAY", 1))
+# Update is dropped after its worker crashed this number of times while processing it
+SHARD_MAX_ATTEMPTS = int(os.environ.get("SHARD_MAX_ATTEMPTS", 3))
+# Max seconds stopped worker processes updates it received
+SHARD_DRAIN_TIMEOUT = float(os.environ.get("SHARD_DRAIN_TIMEOUT", 30))
+
+# user_data and chat_data changes are written to db every this number of
+# seconds, data of users and chats idle for PERSISTENCE_IDLE_SECONDS is
+# dropped from memory and loaded again on next update
+PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", 1))
+PERSISTENCE_IDLE_SECONDS = float(os.environ.get("PERSISTENCE_IDLE_SECONDS", 600))
+PERSISTENCE_BATCH_SIZE = int(os.environ.get("PERSISTENCE_BATCH_SIZE", 500))
+
+# Updates of every chat are admitted within token bucket budgets: FLOOD_BURST
+# updates at once and FLOOD_RATE per second on average. Commands listed in
+# FLOOD_EXPENSIVE_COMMANDS have their own budget, ADMIN_CHATS have one budget
+# for all updates
+FLOOD_RATE = float(os.environ.get("FLOOD_RATE", 1))
+FLOOD_BURST = float(os.environ.get("FLOOD_BURST", 10))
+FLOOD_EXPENSIVE_COMMANDS = [
+    command.strip().lower()
+    for command in os.environ.get(
+        "FLOOD_EXPENSIVE_COMMANDS", 'report,export,import,search'
+    ).split(',')
+    if command.strip()
+]
+FLOOD_EXPENSIVE_RATE = float(os.environ.get("FLOOD_EXPENSIVE_RATE", 0.2))
+FLOOD_EXPENSIVE_BURST = float(os.environ.get("FLOOD_EXPENSIVE_BURST", 3))
+FLOOD_ADMIN_RATE = float(os.environ.get("FLOOD_ADMIN_RATE", 10))
+FLOOD_ADMIN_BURST = float(os.environ.get("FLOOD_ADMIN_BURST", 100))
+# Update over budget is deferred if it fits in budget within FLOOD_MAX_DELAY
+# seconds and its chat has less than FLOOD_MAX_DEFERRED deferred updates,
+# otherwise it is dropped
+FLOOD_MAX_DELAY = float(os.environ.get("FLOOD_MAX_DELAY", 5))
+FLOOD_MAX_DEFERRED = int(os.environ.get("FLOOD_MAX_DEFERRED", 5))
+# Updates of chats except ADMIN_CHATS are dropped while more than this number
+# of updates wait for or run on workers, 0 disables
+FLOOD_SHED_DEPTH = int(os.environ.get("FLOOD_SHED_DEPTH", 1000))
+
+# Outbound messages are sent by this number of threads within telegram limits,
+# in sharded mode every worker process sends its share of global rate
+SENDER_WORKERS = int(os.environ.get("SENDER_WORKERS", 4))
+SENDER_GLOBAL_RATE = float(os.environ.get("SENDER_GLOBAL_RATE", 30))
+SENDER_CHAT_RATE = float(os.environ.get("SENDER_CHAT_RATE", 1))
+SENDER_CHAT_BURST = float(os.environ.get("SENDER_CHAT_BURST", 3))
+SENDER_MAX_RETRIES = int(os.environ.get("SENDER_MAX_RETRIES", 3))
+
+# Prometheus metrics are served on this port if set
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0)) or None
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", '127.0.0.1')
+# Seconds between latency summaries in log, 0 disables
+METRICS_LOG_INTERVAL = float(os.environ.get("METRICS_LOG_INTERVAL", 0))
+
+# Read-only queries are routed to replicas: `;` separated libpq connection
+# strings, DB_NAME, DB_USER and DB_PASSWORD are applied to them too
+DB_REPLICAS = [
+    dsn.strip() for dsn in os.environ.get("DB_REPLICAS", '').split(';') if dsn.strip()
+]
+DB_REPLICA_MAX_LAG = float(os.environ.get("DB_REPLICA_MAX_LAG", 5))
+DB_REPLICA_CHECK_INTERVAL = float(os.environ.get("DB_REPLICA_CHECK_INTERVAL", 5))
+# Chat reads from primary for this number of seconds after it writes
+DB_STICKY_SECONDS = float(os.environ.get("DB_STICKY_SECONDS", 5))
+
+# Budgets are checked against monthly totals every this number of seconds
+BUDGET_CHECK_INTERVAL = float(os.environ.get("BUDGET_CHECK_INTERVAL", 300))
+# Share of budget spent after which user is warned
+BUDGET_WARNING_SHARE = float(os.environ.get("BUDGET_WARNING_SHARE", 0.8))
+
+# Exported and imported CSV files stay in memory up to this size in bytes,
+# bigger ones are spooled to disk
+SPOOL_MAX_SIZE = int(os.environ.get("SPOOL_MAX_SIZE", 1024 * 1024))
+# Imported rows are validated in batches of this size
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 1000))
+
+# Ledger partitions are created for this number of months ahead
+LEDGER_PARTITIONS_AHEAD = int(os.environ.get("LEDGER_PARTITIONS_AHEAD", 3))
+LEDGER_PARTITIONS_CHECK_INTERVAL = float(os.environ.get("LEDGER_PARTITIONS_CHECK_INTERVAL", 86400))
+# Archived ledger partitions are written to this directory
+LEDGER_ARCHIVE_DIR = os.environ.get("LEDGER_ARCHIVE_DIR", 'archive')
@@ -0,0 +1,238 @@
+"""
+Asyncio counterpart of DBManager on asyncpg
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Optional, Union
+
+import asyncpg
+
+from config.settings import ASYNC_DB_POOL, DB_CONNECTION
+from runtime.metrics import QUERY_LATENCY
+from .exceptions import DBError, DBPoolTimeout, DBUniqueViolation
+from .queries import (Filter, Statement, _raw_label, as_filter, delete_statement,
+                      exists_statement, insert_statement, numbered_placeholders,
+                      select_statement, update_statement, upsert_statement)
+from .replicas import get_router
+
+_pool: Optional[asyncpg.Pool] = None
+_pool_lock = asyncio.Lock()
+_raw_texts: dict[str, str] = {}
+
+
+async def get_async_pool() -> asyncpg.Pool:
+    """
+    :raise DBPoolTimeout if connecting takes longer than pool timeout,
+           DBError if pool can't connect to db.
+    :return: asyncpg pool of primary configured in settings, created on
+             first call. Pool belongs to event loop it was created in.
+    """
+    global _pool  # pylint: disable=global-statement
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                try:
+                    _pool = await asyncpg.create_pool(
+                        database=DB_CONNECTION['dbname'], user=DB_CONNECTION['user'],
+                        password=DB_CONNECTION['password'],
+                        min_size=ASYNC_DB_POOL['min_size'], max_size=ASYNC_DB_POOL['max_size'],
+                        timeout=ASYNC_DB_POOL['timeout'],
+                    )
+                except asyncio.TimeoutError as error:
+                    raise DBPoolTimeout('Connecting to db takes too long') from error
+                except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as error:
+                    raise DBError(str(error)) from error
+    return _pool
+
+
+async def close_async_pool() -> None:
+    """
+    Close connections of pool, next `get_async_pool` creates new one.
+    """
+    global _pool  # pylint: disable=global-statement
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+class AsyncDBManager:
+    """
+    Class for working with db from coroutines. Table methods are the
+    same as DBManager ones and share its statement cache, asyncpg
+    prepares statements on every connection by itself.
+    Connection is borrowed from the pool for every query unless queries
+    run inside `transaction` block. All queries go to primary.
+    """
+    def __init__(self, pool: asyncpg.Pool = None) -> None:
+        """
+        :param pool: pool to use instead of configured one.
+        """
+        self.pool = pool
+        self.connection = None
+
+    @asynccontextmanager
+    async def _acquire(self) -> AsyncIterator[Any]:
+        pool = self.pool or await get_async_pool()
+        try:
+            connection = await pool.acquire(timeout=ASYNC_DB_POOL['timeout'])
+        except asyncio.TimeoutError as error:
+            raise DBPoolTimeout('No free db connection') from error
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as error:
+            raise DBError(str(error)) from error
+        try:
+            yield connection
+        finally:
+            await pool.release(connection)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator['AsyncDBManager']:
+        """
+        Run several queries on one connection in one transaction.
+        Commit on success, rollback if any exception is raised.
+        Nested blocks join the outer transaction.
+        """
+        if self.connection is not None:
+            yield self
+            return
+
+        async with self._acquire() as connection:
+            self.connection = connection
+            try:
+                async with connection.transaction():
+                    yield self
+            except (asyncpg.PostgresError, asyncpg.InterfaceError) as error:
+                raise DBError(str(error)) from error
+            finally:
+                self.connection = None
+        get_router().note_write()
+
+    async def _execute(self, query: Union[str, Statement], values: tuple = (),
+                       fetch: str = None, read_only: bool = False) -> Any:
+        """
+        :param query: sql query with `%s` placeholders or cached statement.
+        :param values: values to fill placeholders in query.
+        :param fetch: `one` or `all` to return fetched rows.
+        :param read_only: query does not change data.
+        :raise DBError in case of any error during query performing.
+        :return: fetched rows as tuples if `fetch` is specified else None.
+        """
+        if isinstance(query, Statement):
+            label, text = query.label, query.numbered_text()
+        else:
+            label, text = _raw_label(query), _raw_texts.get(query)
+            if text is None:
+                text = _raw_texts[query] = numbered_placeholders(query)[0]
+
+        if self.connection is not None:
+            return await self._run(self.connection, text, label, values, fetch)
+        async with self._acquire() as connection:
+            result = await self._run(connection, text, label, values, fetch)
+        if not read_only:
+            get_router().note_write()
+        return result
+
+    @staticmethod
+    async def _run(connection, text: str, label: str, values: tuple, fetch: str) -> Any:
+        started = time.perf_counter()
+        try:
+            if fetch == 'one':
+                row = await connection.fetchrow(text, *values)
+                result = tuple(row) if row is not None else None
+            elif fetch == 'all':
+                result = [tuple(row) for row in await connection.fetch(text, *values)]
+            else:
+                await connection.execute(text, *values)
+                result = None
+        except asyncpg.UniqueViolationError as error:
+            QUERY_LATENCY.observe(time.perf_counter() - started, label, 'error')
+            raise DBUniqueViolation('Value already exists') from error
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as error:
+            QUERY_LATENCY.observe(time.perf_counter() - started, label, 'error')
+            raise DBError(str(error)) from error
+        QUERY_LATENCY.observe(time.perf_counter() - started, label, 'ok')
+        return result
+
+    async def insert(self, table_name: str, data: dict) -> None:
+        """
+        Insert data into specified table.
+        :param table_name: table to perform query.
+        :param data: data to insert in format `{col_name: col_value}`.
+        """
+        await self._execute(insert_statement(table_name, tuple(data)), tuple(data.values()))
+
+    async def upsert(self, table_name: str, data: dict, conflict_cols: tuple,
+                     returning: tuple = ()) -> Optional[tuple[Any]]:
+        """
+        Insert row or update it if row with same `conflict_cols` values
+        already exists. Done in one query.
+        :return: tuple with `returning` columns values or None if
+                 nothing to return.
+        """
+        statement = upsert_statement(table_name, tuple(data), conflict_cols, returning)
+        return await self._execute(
+            statement, tuple(data.values()), fetch='one' if returning else None
+        )
+
+    async def select(self, table_name: str, cols: tuple, filters: Union[dict, Filter],
+                     order_by: tuple = (), descending: bool = False, limit: int = None
+                     ) -> list[tuple[Any]]:
+        """
+        Select data from specified table.
+        :return: list of tuples. Each tuple represent db row.
+        """
+        filters = as_filter(filters)
+        statement = select_statement(table_name, cols, filters, order_by, descending, limit)
+        values = filters.values + ((limit,) if limit else ())
+        return await self._execute(statement, values, fetch='all', read_only=True)
+
+    async def update(self, table_name: str, data: dict, filters: Union[dict, Filter],
+                     returning: tuple = ()) -> Optional[list[tuple[Any]]]:
+        """
+        Update data in specified table.
+        :return: list of tuples with `returning` columns of updated rows
+                 or None if nothing to return.
+        """
+        filters = as_filter(filters)
+        statement = update_statement(table_name, tuple(data), filters, returning)
+        return await self._execute(
+            statement, tuple(data.values()) + filters.values,
+            fetch='all' if returning else None,
+        )
+
+    async def delete(self, table_name: str, filters: Union[dict, Filter],
+                     returning: tuple = ()) -> Optional[list[tuple[Any]]]:
+        """
+        Delete data from specified table.
+        :return: list of tuples with `returning` columns of deleted rows
+                 or None if nothing to return.
+        """
+        filters = as_filter(filters)
+        statement = delete_statement(table_name, filters, returning)
+        return await self._execute(
+            statement, filters.values, fetch='all' if returning else None
+        )
+
+    async def exists(self, table_name: str, filters: Union[dict, Filter]) -> bool:
+        """
+        Check if row exists in database.
+        """
+        filters = as_filter(filters)
+        row = await self._execute(
+            exists_statement(table_name, filters), filters.values, fetch='one', read_only=True
+        )
+        return all(row)
+
+    async def notify(self, channel: str, payload: str = '') -> None:
+        """
+        Send postgres notification to all sessions listening to channel.
+        Inside transaction notification is delivered on commit.
+        """
+        await self._execute('SELECT pg_notify(%s, %s)', (channel, payload))
+
+    async def execute(self, query: str, values: tuple = (), fetch: str = None) -> Any:
+        """
+        Execute arbitrary query with `%s` placeholders.
+        :return: fetched rows if `fetch` is specified else None.
+        """
+        return await self._execute(query, values, fetch=fetch)
@@ -0,0 +1,170 @@
+"""
+Write-behind buffer grouping inserts from many threads into batches
+"""
+import logging
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from queue import Empty, Queue
+from typing import Any, Callable, Optional
+
+from .queries import DBManager
+from .replicas import get_router
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BatchWriter:
+    """
+    Rows submitted by any thread are buffered and inserted by a single
+    writer thread with multi-row INSERT in one transaction per batch.
+    Batch is flushed when it reaches `max_batch_size` rows or when its
+    oldest row waited `max_delay` seconds. Future returned by `submit`
+    is resolved only after the batch is committed.
+    """
+
+    def __init__(self, table_name: str, cols: tuple, returning: tuple = (),
+                 max_batch_size: int = 500, max_delay: float = 0.05,
+                 on_flush: Callable[[DBManager, list[tuple]], None] = None) -> None:
+        """
+        :param table_name: table to insert rows to.
+        :param cols: columns of submitted rows.
+        :param returning: columns of inserted rows to resolve futures with.
+        :param max_batch_size: max number of rows in one INSERT.
+        :param max_delay: max seconds row waits in buffer.
+        :param on_flush: called with db manager and inserted rows inside
+               batch transaction, used to maintain derived data.
+        """
+        self.table_name = table_name
+        self.cols = cols
+        self.returning = returning
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.on_flush = on_flush
+        self._queue: Queue = Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.stats = {'rows': 0, 'batches': 0, 'failed_rows': 0, 'cancelled_rows': 0}
+
+    def submit(self, row: tuple) -> Future:
+        """
+        Buffer row for insertion.
+        :param row: values in `cols` order.
+        :return: future resolved with tuple of `returning` values after
+                 row is committed or failed with db error. Row is not
+                 inserted if future is cancelled before its batch is flushed.
+        """
+        if self._thread is None:
+            self.start()
+        get_router().note_write()
+        future: Future = Future()
+        self._queue.put((row, future))
+        return future
+
+    def start(self) -> None:
+        """
+        Start writer thread. Called automatically on first submit.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=f'{self.table_name}-writer', daemon=True
+                )
+                self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Flush buffered rows and stop writer thread.
+        """
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        """
+        Writer thread loop.
+        """
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 \
+                        else self._queue.get_nowait()
+                except Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(self._start(batch))
+
+    def _start(self, batch: list[tuple[tuple, Future]]) -> list[tuple[tuple, Future]]:
+        """
+        Mark futures of batch running, so they can't be cancelled any more.
+        :return: items of batch which were not cancelled by submitters.
+        """
+        started = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        self.stats['cancelled_rows'] += len(batch) - len(started)
+        return started
+
+    def _flush(self, batch: list[tuple[tuple, Future]]) -> None:
+        """
+        Insert batch in one transaction. If batch fails, rows are retried
+        one by one, so a single invalid row fails only its own future.
+        """
+        if not batch:
+            return
+        try:
+            results = self._insert([row for row, _ in batch])
+        except Exception as error:  # pylint: disable=broad-except
+            if len(batch) == 1:
+                self.stats['failed_rows'] += 1
+                self._resolve(batch[0][1], error=error)
+                return
+            logger.warning('Batch of %s rows to %s failed, retrying one by one: %s',
+                           len(batch), self.table_name, error)
+            for item in batch:
+                self._flush([item])
+            return
+
+        self.stats['rows'] += len(batch)
+        self.stats['batches'] += 1
+        for (_, future), result in zip(batch, results):
+            self._resolve(future, result)
+
+    def _resolve(self, future: Future, result: Any = None,
+                 error: Optional[Exception] = None) -> None:
+        """
+        Set result or error of future, writer thread must not fail if
+        future was resolved or cancelled already.
+        """
+        try:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        except InvalidStateError:
+            logger.warning('Future of row inserted to %s was already resolved', self.table_name)
+
+    def _insert(self, rows: list[tuple]) -> list[Any]:
+        """
+        :return: `returning` values for every row, or Nones.
+        """
+        with DBManager().transaction() as db_manager:
+            results = db_manager.insert_many(
+                self.table_name, self.cols, rows, returning=self.returning
+            )
+            if self.on_flush:
+                self.on_flush(db_manager, rows)
+        return results if self.returning else [None] * len(rows)
@@ -15,3 +15,17 @@ class DBUniqueViolation(Exception):
     Exception raised on database unique violation error
     raised during sql query performing
     """
+
+
+class DBPoolTimeout(DBError):
+    """
+    Exception raised when no db connection got free
+    in the pool during checkout timeout
+    """
+
+
+class DBMigrationError(DBError):
+    """
+    Exception raised when migrations are inconsistent
+    with the database or fail to apply
+    """
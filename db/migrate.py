@@ -0,0 +1,212 @@
+"""
+Versioned schema migrations.
+Migrations are files `<version>_<name>.sql` in db/migrations. Every
+file is applied in its own transaction together with its record in
+`schema_migrations`, so a failed migration leaves no trace. Session
+TimeZone is REPORT_TIMEZONE while migrations run.
+Usage: `python -m db.migrate [--status]`
+"""
+import argparse
+import hashlib
+import logging
+import re
+from collections import namedtuple
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+import psycopg2
+
+from config.settings import DB_CONNECTION, REPORT_TIMEZONE
+from .exceptions import DBMigrationError
+from .queries import numbered_placeholders
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).parent / 'migrations'
+# tables which grow with users and must be read through indexes
+LARGE_TABLES = ('ledger', 'ledger_daily', 'ledger_monthly', 'telegram_user')
+
+Migration = namedtuple('Migration', 'version name path checksum')
+PlanProblem = namedtuple('PlanProblem', 'label table node query')
+
+# key of advisory lock serializing concurrent runs
+_LOCK_KEY = 0x6d696772
+_CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version integer PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        checksum CHAR(64) NOT NULL,
+        applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+    )
+'''
+_FILE_NAME = re.compile(r'(\d+)_(\w+)\.sql')
+_EXPLAINABLE = re.compile(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+_SCANS = ('Seq Scan', 'Index Scan', 'Index Only Scan')
+
+
+def discover(directory: Path = MIGRATIONS_DIR) -> list[Migration]:
+    """
+    :return: migrations found in directory ordered by version.
+    :raise DBMigrationError if file name is invalid or version is repeated.
+    """
+    migrations: dict[int, Migration] = {}
+    for path in sorted(directory.glob('*.sql')):
+        match = _FILE_NAME.fullmatch(path.name)
+        if match is None:
+            raise DBMigrationError(f'Invalid migration file name {path.name}')
+        version = int(match.group(1))
+        if version in migrations:
+            raise DBMigrationError(f'Migration version {version} is repeated')
+        migrations[version] = Migration(
+            version, match.group(2), path, hashlib.sha256(path.read_bytes()).hexdigest()
+        )
+    return [migrations[version] for version in sorted(migrations)]
+
+
+def applied(connection: Any) -> dict[int, str]:
+    """
+    :return: checksums of applied migrations by version.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_CREATE_TABLE)
+        cursor.execute('SELECT version, checksum FROM schema_migrations')
+        rows = cursor.fetchall()
+    connection.commit()
+    return dict(rows)
+
+
+def pending(connection: Any, migrations: list[Migration]) -> list[Migration]:
+    """
+    :return: migrations not applied yet.
+    :raise DBMigrationError if applied migration file was changed.
+    """
+    done = applied(connection)
+    for migration in migrations:
+        checksum = done.get(migration.version)
+        if checksum is not None and checksum != migration.checksum:
+            raise DBMigrationError(
+                f'Migration {migration.path.name} was changed after it was applied'
+            )
+    unknown = set(done) - {migration.version for migration in migrations}
+    if unknown:
+        logger.warning('Applied migrations %s are missing on disk', sorted(unknown))
+    return [migration for migration in migrations if migration.version not in done]
+
+
+def migrate(connection: Any, directory: Path = MIGRATIONS_DIR) -> list[Migration]:
+    """
+    Apply pending migrations in version order. Concurrent runs wait
+    for each other on advisory lock.
+    :param connection: psycopg2 connection, not in autocommit mode.
+    :param directory: directory with migration files.
+    :raise DBMigrationError if migration fails, migrations applied
+           before it stay applied.
+    :return: applied migrations.
+    """
+    migrations = discover(directory)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_lock(%s)', (_LOCK_KEY,))
+        cursor.execute('SET TIME ZONE %s', (REPORT_TIMEZONE,))
+    try:
+        done = []
+        for migration in pending(connection, migrations):
+            logger.info('Applying migration %s', migration.path.name)
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(migration.path.read_text())
+                    cursor.execute(
+                        'INSERT INTO schema_migrations (version, name, checksum) '
+                        'VALUES (%s, %s, %s)',
+                        (migration.version, migration.name, migration.checksum),
+                    )
+                connection.commit()
+            except psycopg2.Error as error:
+                connection.rollback()
+                raise DBMigrationError(
+                    f'Migration {migration.path.name} failed: {error}'
+                ) from error
+            done.append(migration)
+        return done
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (_LOCK_KEY,))
+        connection.commit()
+
+
+def _nodes(plan: dict) -> Iterator[dict]:
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _nodes(child)
+
+
+def check_plans(connection: Any, queries: Iterable[tuple[str, str]],
+                tables: tuple = LARGE_TABLES) -> tuple[list[PlanProblem], list[str]]:
+    """
+    Explain generic plan of every query with sequential scans disabled.
+    Scan of large table which still reads it whole, Seq Scan or index
+    scan without index condition, means no index serves the query.
+    Nothing is executed, transaction is rolled back.
+    :param connection: psycopg2 connection.
+    :param queries: metrics labels and texts with `%s` placeholders,
+           see `recorded_queries`.
+    :param tables: tables which must not be read whole.
+    :return: problems found and labels of queries which can't be explained.
+    """
+    problems: list[PlanProblem] = []
+    skipped: list[str] = []
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL plan_cache_mode = force_generic_plan')
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        for label, query in queries:
+            if not _EXPLAINABLE.match(query):
+                continue
+            body, count = numbered_placeholders(query)
+            arguments = f' ({", ".join(["NULL"] * count)})' if count else ''
+            cursor.execute('SAVEPOINT plan_check')
+            try:
+                cursor.execute(f'PREPARE plan_check AS {body}')
+                cursor.execute(f'EXPLAIN (FORMAT JSON) EXECUTE plan_check{arguments}')
+                plan = cursor.fetchone()[0][0]['Plan']
+                cursor.execute('DEALLOCATE plan_check')
+            except psycopg2.Error as error:
+                cursor.execute('ROLLBACK TO SAVEPOINT plan_check')
+                skipped.append(f'{label}: {str(error).splitlines()[0]}')
+                continue
+            for node in _nodes(plan):
+                if node['Node Type'] in _SCANS and node.get('Relation Name') in tables \
+                        and 'Index Cond' not in node:
+                    problems.append(PlanProblem(
+                        label, node['Relation Name'], node['Node Type'], ' '.join(query.split())
+                    ))
+    connection.rollback()
+    return problems, skipped
+
+
+def main() -> None:
+    """
+    Apply pending migrations or print their status.
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--status', action='store_true',
+                            help='list migrations and whether they are applied')
+    args = arg_parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+
+    connection = psycopg2.connect(**DB_CONNECTION)
+    try:
+        if args.status:
+            migrations = discover()
+            waiting = {migration.version for migration in pending(connection, migrations)}
+            for migration in migrations:
+                state = 'pending' if migration.version in waiting else 'applied'
+                print(f'{migration.path.name:<40} {state}')
+            return
+        done = migrate(connection)
+        logger.info('Applied %s migrations', len(done))
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
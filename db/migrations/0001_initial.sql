@@ -0,0 +1,64 @@
+-- Schema created by db_init.sql before migrations were introduced
+CREATE TABLE IF NOT EXISTS telegram_user(
+    chat_id integer NOT NULL UNIQUE,
+    is_bot BOOLEAN NOT NULL,
+    first_name VARCHAR(64) NOT NULL,
+    last_name VARCHAR(64),
+    username VARCHAR(32),
+    language_code VARCHAR(35)
+);
+-- databases created by db_init.py already have the type
+DO $$ BEGIN
+    CREATE TYPE category_type AS ENUM ('expense', 'income');
+EXCEPTION WHEN duplicate_object THEN NULL;
+END $$;
+CREATE TABLE IF NOT EXISTS category(
+    codename VARCHAR(15) PRIMARY KEY,
+    title VARCHAR(30) UNIQUE NOT NULL,
+    description VARCHAR(50) NOT NULL,
+    type category_type
+);
+CREATE TABLE IF NOT EXISTS ledger(
+    id BIGSERIAL PRIMARY KEY,
+    chat_id integer NOT NULL REFERENCES telegram_user(chat_id),
+    codename VARCHAR(15) NOT NULL REFERENCES category(codename) ON UPDATE CASCADE,
+    amount NUMERIC(12, 2) NOT NULL CHECK (amount > 0),
+    currency CHAR(3) NOT NULL,
+    note VARCHAR(255),
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS ledger_daily(
+    chat_id integer NOT NULL,
+    codename VARCHAR(15) NOT NULL REFERENCES category(codename) ON UPDATE CASCADE,
+    type category_type NOT NULL,
+    currency CHAR(3) NOT NULL,
+    day DATE NOT NULL,
+    total NUMERIC(14, 2) NOT NULL,
+    entries integer NOT NULL,
+    PRIMARY KEY (chat_id, day, codename, type, currency)
+);
+CREATE TABLE IF NOT EXISTS ledger_monthly(
+    chat_id integer NOT NULL,
+    codename VARCHAR(15) NOT NULL REFERENCES category(codename) ON UPDATE CASCADE,
+    type category_type NOT NULL,
+    currency CHAR(3) NOT NULL,
+    month DATE NOT NULL,
+    total NUMERIC(14, 2) NOT NULL,
+    entries integer NOT NULL,
+    PRIMARY KEY (chat_id, month, codename, type, currency)
+);
+CREATE TABLE IF NOT EXISTS category_alias(
+    alias VARCHAR(30) PRIMARY KEY,
+    codename VARCHAR(15) NOT NULL REFERENCES category(codename)
+        ON UPDATE CASCADE ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS budget(
+    chat_id integer NOT NULL REFERENCES telegram_user(chat_id),
+    codename VARCHAR(15) NOT NULL REFERENCES category(codename)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    currency CHAR(3) NOT NULL,
+    amount NUMERIC(12, 2) NOT NULL CHECK (amount > 0),
+    alert_month DATE,
+    alert_level SMALLINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, codename, currency)
+);
@@ -0,0 +1,10 @@
+-- telegram_user.chat_id and category.codename are already indexed by
+-- their UNIQUE and PRIMARY KEY constraints
+
+-- entries listing: WHERE chat_id = ? ORDER BY created_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS ledger_chat_id_created_at_idx ON ledger (chat_id, created_at, id);
+-- catalog groups and admin listings by type
+CREATE INDEX IF NOT EXISTS category_type_idx ON category (type);
+-- cascades from category
+CREATE INDEX IF NOT EXISTS category_alias_codename_idx ON category_alias (codename);
+CREATE INDEX IF NOT EXISTS budget_codename_idx ON budget (codename);
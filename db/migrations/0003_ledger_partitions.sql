@@ -0,0 +1,68 @@
+-- Ledger becomes range partitioned by month of created_at. Month
+-- boundaries are in session TimeZone, which the migration runner sets
+-- to REPORT_TIMEZONE, so every report day and month is in one partition.
+
+-- partitions of archived months, they are not created again
+CREATE TABLE IF NOT EXISTS ledger_archive(
+    partition_name VARCHAR(63) PRIMARY KEY,
+    range_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    range_end TIMESTAMP WITH TIME ZONE NOT NULL,
+    entries bigint NOT NULL,
+    path VARCHAR(255) NOT NULL,
+    archived_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+-- create missing partitions `ledger_YYYY_MM` for months from `since` to `until`
+-- in timezone `tz`, return number of created partitions
+CREATE OR REPLACE FUNCTION ledger_create_partitions(
+    since TIMESTAMP WITH TIME ZONE, until TIMESTAMP WITH TIME ZONE, tz TEXT
+) RETURNS integer AS $$
+DECLARE
+    month DATE := date_trunc('month', since AT TIME ZONE tz)::date;
+    name TEXT;
+    created integer := 0;
+BEGIN
+    WHILE (month::timestamp AT TIME ZONE tz) <= until LOOP
+        name := 'ledger_' || to_char(month, 'YYYY_MM');
+        IF to_regclass(name) IS NULL AND NOT EXISTS (
+            SELECT 1 FROM ledger_archive a WHERE a.partition_name = name
+        ) THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF ledger FOR VALUES FROM (%L) TO (%L)',
+                name,
+                month::timestamp AT TIME ZONE tz,
+                (month + interval '1 month')::timestamp AT TIME ZONE tz
+            );
+            created := created + 1;
+        END IF;
+        month := month + interval '1 month';
+    END LOOP;
+    RETURN created;
+END
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE ledger RENAME TO ledger_unpartitioned;
+ALTER TABLE ledger_unpartitioned RENAME CONSTRAINT ledger_pkey TO ledger_unpartitioned_pkey;
+ALTER INDEX ledger_chat_id_created_at_idx RENAME TO ledger_unpartitioned_chat_id_created_at_idx;
+
+-- partition key must be part of primary key
+CREATE TABLE ledger(
+    id bigint NOT NULL DEFAULT nextval('ledger_id_seq'),
+    chat_id integer NOT NULL REFERENCES telegram_user(chat_id),
+    codename VARCHAR(15) NOT NULL REFERENCES category(codename) ON UPDATE CASCADE,
+    amount NUMERIC(12, 2) NOT NULL CHECK (amount > 0),
+    currency CHAR(3) NOT NULL,
+    note VARCHAR(255),
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+ALTER SEQUENCE ledger_id_seq OWNED BY ledger.id;
+CREATE INDEX ledger_chat_id_created_at_idx ON ledger (chat_id, created_at, id);
+
+SELECT ledger_create_partitions(
+    COALESCE((SELECT min(created_at) FROM ledger_unpartitioned), now()),
+    now() + interval '3 months',
+    current_setting('TimeZone')
+);
+INSERT INTO ledger SELECT * FROM ledger_unpartitioned;
+DROP TABLE ledger_unpartitioned;
@@ -0,0 +1,17 @@
+-- Pickled user_data, chat_data and bot_data of the bot, see PostgresPersistence.
+-- Rows are written only for changed data, empty data has no row.
+CREATE TABLE IF NOT EXISTS persistence_data(
+    kind VARCHAR(4) NOT NULL CHECK (kind IN ('user', 'chat', 'bot')),
+    id bigint NOT NULL,
+    data bytea NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (kind, id)
+);
+-- states of conversations in progress, finished ones are deleted
+CREATE TABLE IF NOT EXISTS persistence_conversation(
+    name VARCHAR(100) NOT NULL,
+    key VARCHAR(100) NOT NULL,
+    state bytea NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (name, key)
+);
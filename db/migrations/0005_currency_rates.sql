@@ -0,0 +1,8 @@
+-- Rates of currencies to DEFAULT_CURRENCY: one unit of `currency` costs
+-- `rate` units of default currency from `day` until the next known rate.
+CREATE TABLE IF NOT EXISTS currency_rate(
+    currency CHAR(3) NOT NULL,
+    day DATE NOT NULL,
+    rate NUMERIC(20, 10) NOT NULL CHECK (rate > 0),
+    PRIMARY KEY (currency, day)
+);
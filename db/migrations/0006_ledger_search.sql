@@ -0,0 +1,6 @@
+-- search over entry notes: to_tsvector('simple', coalesce(note, '')) @@ <query>,
+-- see `Matches`. `simple` configuration doesn't stem words, so notes in any
+-- language are matched by word prefixes. Index of partitioned table is
+-- created on every partition, including ones attached later.
+CREATE INDEX IF NOT EXISTS ledger_note_search_idx
+    ON ledger USING GIN (to_tsvector('simple', coalesce(note, '')));
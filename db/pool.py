@@ -0,0 +1,308 @@
+"""
+Thread-safe pool of db connections shared by dispatcher workers
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from psycopg2 import connect, extensions
+
+from config.settings import DB_CONNECTION, DB_POOL
+from runtime.metrics import POOL_CHECKOUT
+from .exceptions import DBError, DBPoolTimeout
+
+
+class PooledConnection(extensions.connection):
+    """
+    Connection remembering names of statements prepared on it.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared: set[str] = set()
+
+
+class ConnectionPool:
+    """
+    Pool of reusable db connections.
+    At least `min_size` and at most `max_size` connections are kept open.
+    Connection checked out with `getconn` must be returned with `putconn`,
+    `connection` context manager does it automatically.
+    """
+
+    def __init__(self, dsn: dict, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 5.0, max_idle: float = 300.0,
+                 health_check_interval: float = 30.0) -> None:
+        """
+        :param dsn: psycopg2 connection parameters.
+        :param min_size: connections kept open even when pool is idle.
+        :param max_size: max number of simultaneously open connections.
+        :param timeout: seconds to wait for free connection on checkout.
+        :param max_idle: seconds after which unused connection above
+               `min_size` is closed.
+        :param health_check_interval: connection idle for longer than this
+               is pinged with `SELECT 1` before it is handed out.
+        """
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError('Pool size must satisfy 0 <= min_size <= max_size, max_size >= 1')
+
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+
+        self._condition = threading.Condition()
+        self._idle: deque = deque()  # (connection, returned_at), newest on the right
+        self._in_use: set = set()
+        self._size = 0
+        self._closed = False
+        self._reaper: Optional[threading.Thread] = None
+        self._counters = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'opened': 0,
+            'discarded': 0,
+            'reaped': 0,
+            'health_check_failures': 0,
+            'wait_seconds_total': 0.0,
+        }
+
+        for _ in range(min_size):
+            with self._condition:
+                self._size += 1
+            self._idle.append((self._open(), time.monotonic()))
+
+    def _open(self) -> extensions.connection:
+        """
+        Open new connection. Slot for it must be already reserved in `_size`.
+        :raise DBError if connection can not be established.
+        """
+        try:
+            connection = connect(**self.dsn, connection_factory=PooledConnection)
+        except Exception as error:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise DBError(str(error)) from error
+
+        with self._condition:
+            self._counters['opened'] += 1
+        return connection
+
+    def _is_alive(self, connection: extensions.connection, returned_at: float) -> bool:
+        """
+        Check connection before handing it out. Connections used recently
+        are trusted, others are pinged.
+        """
+        if connection.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+        except Exception:  # pylint: disable=broad-except
+            return False
+        return True
+
+    def _discard(self, connection: extensions.connection) -> None:
+        """
+        Close connection and free its slot.
+        """
+        try:
+            connection.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+        with self._condition:
+            self._size -= 1
+            self._counters['discarded'] += 1
+            self._condition.notify()
+
+    def _reserve(self, deadline: float) -> tuple[Optional[extensions.connection], float]:
+        """
+        Wait until idle connection or free slot is available.
+        :return: idle connection with time it was returned to the pool, or
+                 `(None, 0)` when a slot for new connection was reserved.
+        :raise DBPoolTimeout if nothing got free before deadline.
+        """
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise DBError('Connection pool is closed')
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None, 0.0
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise DBPoolTimeout(
+                        f'No free db connection after {self.timeout} seconds'
+                    )
+                self._condition.wait(remaining)
+
+    def getconn(self, timeout: float = None) -> extensions.connection:
+        """
+        Check out connection from the pool.
+        :param timeout: seconds to wait, pool `timeout` by default.
+        :raise DBPoolTimeout if all connections are busy for too long.
+        :raise DBError if new connection can not be opened.
+        :return: psycopg2 connection.
+        """
+        started = time.monotonic()
+        deadline = started + (self.timeout if timeout is None else timeout)
+        while True:
+            connection, returned_at = self._reserve(deadline)
+            if connection is None:
+                connection = self._open()
+                break
+            if self._is_alive(connection, returned_at):
+                break
+            with self._condition:
+                self._counters['health_check_failures'] += 1
+            self._discard(connection)
+
+        waited = time.monotonic() - started
+        with self._condition:
+            self._in_use.add(connection)
+            self._counters['checkouts'] += 1
+            self._counters['wait_seconds_total'] += waited
+        POOL_CHECKOUT.observe(waited)
+        return connection
+
+    def putconn(self, connection: extensions.connection, discard: bool = False) -> None:
+        """
+        Return connection to the pool. Unfinished transaction is rolled back.
+        :param connection: connection previously checked out by `getconn`.
+        :param discard: close connection instead of reusing it.
+        """
+        if not (discard or connection.closed):
+            try:
+                status = connection.get_transaction_status()
+                if status != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except Exception:  # pylint: disable=broad-except
+                discard = True
+
+        with self._condition:
+            self._in_use.discard(connection)
+            if not (discard or connection.closed or self._closed):
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+                return
+
+        self._discard(connection)
+
+    @contextmanager
+    def connection(self, timeout: float = None) -> Iterator[extensions.connection]:
+        """
+        Borrow connection for the duration of `with` block.
+        Broken connections are discarded instead of being reused.
+        """
+        connection = self.getconn(timeout)
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def reap_idle(self) -> int:
+        """
+        Close connections which were idle for longer than `max_idle`,
+        keeping at least `min_size` connections open.
+        :return: number of closed connections.
+        """
+        expired = []
+        now = time.monotonic()
+        with self._condition:
+            while (self._idle and self._size - len(expired) > self.min_size
+                   and now - self._idle[0][1] > self.max_idle):
+                expired.append(self._idle.popleft()[0])
+            self._size -= len(expired)
+            self._counters['reaped'] += len(expired)
+
+        for connection in expired:
+            try:
+                connection.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+        return len(expired)
+
+    def start_reaper(self, interval: float = None) -> None:
+        """
+        Start daemon thread which periodically calls `reap_idle`.
+        :param interval: seconds between runs, half of `max_idle` by default.
+        """
+        if self._reaper is not None:
+            return
+        interval = interval or max(self.max_idle / 2, 1.0)
+
+        def reap() -> None:
+            while not self._closed:
+                time.sleep(interval)
+                self.reap_idle()
+
+        self._reaper = threading.Thread(target=reap, name='db-pool-reaper', daemon=True)
+        self._reaper.start()
+
+    @property
+    def busy(self) -> int:
+        """
+        :return: number of checked out connections.
+        """
+        return len(self._in_use)
+
+    def stats(self) -> dict[str, Any]:
+        """
+        :return: snapshot of pool state and counters for monitoring.
+        """
+        with self._condition:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                **self._counters,
+            }
+
+    def close(self) -> None:
+        """
+        Close all idle connections and refuse new checkouts.
+        Connections in use are closed when returned.
+        """
+        with self._condition:
+            self._closed = True
+            idle = [connection for connection, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+
+        for connection in idle:
+            try:
+                connection.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    :return: process wide connection pool configured from settings.
+             Pool is created on first call.
+    """
+    global _pool  # pylint: disable=global-statement
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_CONNECTION, **DB_POOL)
+                _pool.start_reaper()
+    return _pool
@@ -1,66 +1,743 @@
 """
 Working with db related staff
 """
-from typing import Any
+import itertools
+import re
+import time
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import IO, Any, Callable, Hashable, Iterable, Iterator, Optional, Union
+from uuid import uuid4
 
 import psycopg2
-from psycopg2 import connect
+from psycopg2 import sql
+from psycopg2.extras import execute_values
 
-from config.settings import DB_CONNECTION
-from .exceptions import DBError, DBUniqueViolation
+from config.settings import DB_ITERSIZE, DB_PREPARE_THRESHOLD, DB_STATEMENT_CACHE_SIZE
+from runtime.metrics import QUERY_LATENCY
+from .exceptions import DBError, DBPoolTimeout, DBUniqueViolation
+from .pool import ConnectionPool, get_pool
+from .replicas import get_router
 
+# unit of work of current update, see `UnitOfWork`
+current_unit: ContextVar[Optional['UnitOfWork']] = ContextVar('current_unit', default=None)
 
-class WhereInput:
+
+class Condition:
+    """
+    Condition on single column. Plain values in filters mean equality.
+    """
+    operator = '='
+
+    def __init__(self, value: Any) -> None:
+        self.value = value
+
+    @property
+    def shape(self) -> Hashable:
+        """
+        :return: part of statement cache key. Conditions of the same
+                 shape produce the same sql text.
+        """
+        return self.operator
+
+    @property
+    def values(self) -> tuple[Any, ...]:
+        """
+        :return: values for condition placeholders.
+        """
+        return (self.value,)
+
+    def compose(self, column: sql.Identifier) -> sql.Composable:
+        """
+        :return: sql of condition with placeholders.
+        """
+        return sql.SQL('{} %s %%s' % self.operator).format(column)
+
+
+class Compare(Condition):
+    """
+    Comparison of column with value. Example: `Compare('>=', 10)`.
+    """
+    operators = ('=', '<>', '<', '<=', '>', '>=')
+
+    def __init__(self, operator: str, value: Any) -> None:
+        if operator not in self.operators:
+            raise ValueError(f'Unsupported operator {operator}')
+        super().__init__(value)
+        self.operator = operator
+
+
+class In(Condition):
+    """
+    Column value is one of values. Rendered as `= ANY(%s)`, so lists of
+    any length share one statement.
+    """
+    operator = 'in'
+
+    @property
+    def values(self) -> tuple[Any, ...]:
+        return (list(self.value),)
+
+    def compose(self, column: sql.Identifier) -> sql.Composable:
+        return sql.SQL('{} = ANY(%s)').format(column)
+
+
+class Range(Condition):
     """
-    Class representing where clause in sql query.
+    Column value is between low (inclusive) and high (exclusive).
+    Missing bound is not checked.
     """
+
+    def __init__(self, low: Any = None, high: Any = None) -> None:
+        super().__init__((low, high))
+        self.low = low
+        self.high = high
+
+    @property
+    def shape(self) -> Hashable:
+        return 'range', self.low is not None, self.high is not None
+
+    @property
+    def values(self) -> tuple[Any, ...]:
+        return tuple(value for value in (self.low, self.high) if value is not None)
+
+    def compose(self, column: sql.Identifier) -> sql.Composable:
+        parts = []
+        if self.low is not None:
+            parts.append(sql.SQL('{} >= %s').format(column))
+        if self.high is not None:
+            parts.append(sql.SQL('{} < %s').format(column))
+        return sql.SQL(' AND ').join(parts) if parts else sql.SQL('TRUE')
+
+
+class Matches(Condition):
+    """
+    Full-text match of text column: every word is a prefix of some word of
+    column. Uses `simple` configuration, so index on
+    `to_tsvector('simple', coalesce(column, ''))` is used.
+    Example: `Matches(['taxi', 'airp'])`.
+    """
+    operator = 'matches'
+
+    def __init__(self, words: Iterable[str]) -> None:
+        # quoted lexemes, so words can't add tsquery operators
+        super().__init__(' & '.join(
+            "'%s':*" % word.replace('\\', '\\\\').replace("'", "''") for word in words
+        ))
+
+    def compose(self, column: sql.Identifier) -> sql.Composable:
+        return sql.SQL(
+            "to_tsvector('simple', coalesce({}, '')) @@ to_tsquery('simple', %s)"
+        ).format(column)
+
+
+class IsNull(Condition):
+    """
+    Column is NULL. None values in filters mean IsNull.
+    """
+    operator = 'is null'
+
+    def __init__(self) -> None:
+        super().__init__(None)
+
+    @property
+    def values(self) -> tuple[Any, ...]:
+        return ()
+
+    def compose(self, column: sql.Identifier) -> sql.Composable:
+        return sql.SQL('{} IS NULL').format(column)
+
+
+class Filter:
+    """
+    Base class of WHERE clause parts.
+    """
+
+    @property
+    def shape(self) -> Hashable:
+        """
+        :return: part of statement cache key.
+        """
+        raise NotImplementedError
+
+    @property
+    def values(self) -> tuple[Any, ...]:
+        """
+        :return: values for placeholders in `compose` order.
+        """
+        raise NotImplementedError
+
+    def compose(self) -> Optional[sql.Composable]:
+        """
+        :return: sql condition with placeholders or None if empty.
+        """
+        raise NotImplementedError
+
+
+class Where(Filter):
+    """
+    Conditions on columns joined with AND.
+    Example: `Where({'chat_id': 1, 'codename': In(['food', 'cafe'])})`.
+    """
+
     def __init__(self, data: dict) -> None:
         self.data = data
 
+    @property
+    def shape(self) -> Hashable:
+        return ('where',) + tuple(
+            (key, value.shape if isinstance(value, Condition)
+             else IsNull.operator if value is None else Condition.operator)
+            for key, value in self.data.items()
+        )
+
     @property
     def values(self) -> tuple[Any, ...]:
+        values: list[Any] = []
+        for value in self.data.values():
+            if isinstance(value, Condition):
+                values.extend(value.values)
+            elif value is not None:
+                values.append(value)
+        return tuple(values)
+
+    def compose(self) -> Optional[sql.Composable]:
+        if not self.data:
+            return None
+        return sql.SQL(' AND ').join(
+            (value if isinstance(value, Condition)
+             else IsNull() if value is None else Condition(value)
+             ).compose(sql.Identifier(key))
+            for key, value in self.data.items()
+        )
+
+
+class _Junction(Filter):
+    """
+    Filters joined with AND or OR.
+    """
+    junction = ''
+
+    def __init__(self, *filters: Union[dict, Filter]) -> None:
+        self.filters = [as_filter(item) for item in filters]
+
+    @property
+    def shape(self) -> Hashable:
+        return (self.junction,) + tuple(item.shape for item in self.filters)
+
+    @property
+    def values(self) -> tuple[Any, ...]:
+        return tuple(itertools.chain.from_iterable(item.values for item in self.filters))
+
+    def compose(self) -> Optional[sql.Composable]:
+        parts = [part for part in (item.compose() for item in self.filters) if part is not None]
+        if not parts:
+            return None
+        return sql.SQL('(') + sql.SQL(f' {self.junction} ').join(parts) + sql.SQL(')')
+
+
+class And(_Junction):
+    """
+    All filters match. Example: `And({'chat_id': 1}, Or({'a': 1}, {'b': 2}))`.
+    """
+    junction = 'AND'
+
+
+class Or(_Junction):
+    """
+    Any of filters matches. Example: `Or({'codename': 'food'}, {'note': None})`.
+    """
+    junction = 'OR'
+
+
+class Keyset(Filter):
+    """
+    Rows after given row in `cols` order, used for keyset pagination.
+    Example: `Keyset(('created_at', 'id'), (created_at, 10), descending=True)`.
+    """
+
+    def __init__(self, cols: tuple, after: tuple, descending: bool = False) -> None:
+        self.cols = tuple(cols)
+        self.after = tuple(after)
+        self.descending = descending
+
+    @property
+    def shape(self) -> Hashable:
+        return 'keyset', self.cols, self.descending
+
+    @property
+    def values(self) -> tuple[Any, ...]:
+        return self.after
+
+    def compose(self) -> Optional[sql.Composable]:
+        return sql.SQL('({}) {} ({})').format(
+            _columns(self.cols),
+            sql.SQL('<' if self.descending else '>'),
+            sql.SQL(', ').join(sql.Placeholder() for _ in self.cols),
+        )
+
+
+def as_filter(filters: Union[dict, Filter, None]) -> Filter:
+    """
+    :return: Filter from dict of column conditions or filter itself.
+    """
+    if isinstance(filters, Filter):
+        return filters
+    return Where(filters or {})
+
+
+def _columns(cols: tuple) -> sql.Composable:
+    """
+    :return: comma separated quoted column names.
+    """
+    return sql.SQL(', ').join(sql.Identifier(col) for col in cols)
+
+
+def _where(filters: Filter) -> sql.Composable:
+    """
+    :return: WHERE clause or empty sql if there are no conditions.
+    """
+    condition = filters.compose()
+    return sql.SQL(' WHERE {}').format(condition) if condition is not None else sql.SQL('')
+
+
+def _returning(cols: tuple) -> sql.Composable:
+    return sql.SQL(' RETURNING {}').format(_columns(cols)) if cols else sql.SQL('')
+
+
+def _label(key: Hashable) -> str:
+    """
+    :return: metrics label of statement shape: operation, table
+             and checksum of shape, stable between restarts.
+    """
+    checksum = zlib.crc32(repr(key).encode())
+    if isinstance(key, tuple) and len(key) > 1:
+        return f'{key[0]}:{key[1]}:{checksum:08x}'
+    return f'{str(key).split(None, 1)[0].lower()}:{checksum:08x}'
+
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+def numbered_placeholders(query: str) -> tuple[str, int]:
+    """
+    :return: query with `%s` and `%(name)s` placeholders replaced
+             by `$n` and number of parameters.
+    """
+    numbers: dict[Any, int] = {}
+
+    def replace(match: re.Match) -> str:
+        if match.group(0) == '%%':
+            return '%'
+        key = match.group(1) or len(numbers)
+        if key not in numbers:
+            numbers[key] = len(numbers) + 1
+        return f'${numbers[key]}'
+
+    return _PLACEHOLDER.sub(replace, query), len(numbers)
+
+
+def _render(composable: sql.Composable) -> str:
+    """
+    Render statement sql without connection. Statements are built of
+    SQL, Identifier and Placeholder parts only, identifiers are quoted
+    the way libpq does.
+    """
+    if isinstance(composable, sql.Composed):
+        return ''.join(_render(part) for part in composable.seq)
+    if isinstance(composable, sql.Identifier):
+        return '.'.join('"%s"' % name.replace('"', '""') for name in composable.strings)
+    if isinstance(composable, sql.Placeholder):
+        return f'%({composable.name})s' if composable.name else '%s'
+    if isinstance(composable, sql.SQL):
+        return composable.string
+    raise TypeError(f'Can not render {composable!r} without connection')
+
+
+class Statement:
+    """
+    Query of one shape. Text is rendered once and reused for all
+    queries of the shape. After `DB_PREPARE_THRESHOLD` executions
+    statement is prepared on server with PREPARE on every connection
+    it runs on and executed with EXECUTE, skipping parsing and planning.
+    """
+    _names = itertools.count()
+
+    def __init__(self, key: Hashable, composed: sql.Composable, preparable: bool = True) -> None:
         """
-        :return: tuple of passed values used separately in
-        sql prepared statement.
+        :param key: shape of statement.
+        :param composed: statement sql.
+        :param preparable: False for statements which can't be prepared,
+               like multi-row `VALUES %s` inserts.
         """
-        return tuple(self.data.values())
+        self.key = key
+        self.composed = composed
+        self.preparable = preparable and DB_PREPARE_THRESHOLD > 0
+        self.name = f'stmt_{next(self._names)}'
+        self.label = _label(key)
+        self.executions = 0
+        self._text: Optional[str] = None
+        self._prepare_text: Optional[str] = None
+        self._numbered_text: Optional[str] = None
 
-    def __str__(self) -> str:
+    def text(self, connection) -> str:
         """
-        String representation of sql WHERE  clause
-        :return: Example:
-        `WHERE val1=%s, val2=%s`
+        :return: statement text with `%s` placeholders.
         """
-        if not self.data:
-            return ''
+        if self._text is None:
+            self._text = self.composed.as_string(connection)
+        return self._text
+
+    def prepare_text(self, connection) -> str:
+        """
+        :return: PREPARE statement, placeholders are replaced with `$n`.
+        """
+        if self._prepare_text is None:
+            numbers = itertools.count(1)
+            body = re.sub(r'%s', lambda _: f'${next(numbers)}', self.text(connection))
+            self._prepare_text = f'PREPARE {self.name} AS {body.replace("%%", "%")}'
+        return self._prepare_text
+
+    def numbered_text(self) -> str:
+        """
+        :return: statement text with `$n` placeholders, used by asyncpg.
+        """
+        if self._numbered_text is None:
+            self._numbered_text = numbered_placeholders(_render(self.composed))[0]
+        return self._numbered_text
+
+    def execute(self, connection, cursor, values: tuple) -> None:
+        """
+        Execute statement, preparing it on connection if it is hot.
+        """
+        self.executions += 1
+        prepared = getattr(connection, 'prepared', None)
+        if not self.preparable or prepared is None \
+                or self.executions < DB_PREPARE_THRESHOLD:
+            cursor.execute(self.text(connection), values)
+            return
+
+        if self.name not in prepared:
+            cursor.execute(self.prepare_text(connection))
+            prepared.add(self.name)
+        placeholders = ', '.join('%s' for _ in values)
+        cursor.execute(
+            f'EXECUTE {self.name} ({placeholders})' if values else f'EXECUTE {self.name}',
+            values,
+        )
+
+
+_statements: dict[Hashable, Statement] = {}
 
-        str_repr = 'WHERE'
-        for key in self.data.keys():
-            str_repr += f' {key}=%s,'
 
-        return str_repr.strip(',')
+def get_statement(key: Hashable, build: Callable[[], sql.Composable],
+                  preparable: bool = True) -> Statement:
+    """
+    :param key: statement shape.
+    :param build: builds statement sql, called only on cache miss.
+    :param preparable: statement can be prepared on server.
+    :return: cached statement of given shape.
+    """
+    statement = _statements.get(key)
+    if statement is None:
+        statement = Statement(key, build(), preparable)
+        if len(_statements) < DB_STATEMENT_CACHE_SIZE:
+            statement = _statements.setdefault(key, statement)
+    return statement
+
+
+def insert_statement(table_name: str, cols: tuple) -> Statement:
+    """
+    :return: cached INSERT of one row.
+    """
+    return get_statement(
+        ('insert', table_name, cols),
+        lambda: sql.SQL('INSERT INTO {} ({}) VALUES ({})').format(
+            sql.Identifier(table_name), _columns(cols),
+            sql.SQL(', ').join(sql.Placeholder() for _ in cols),
+        ),
+    )
+
+
+def upsert_statement(table_name: str, cols: tuple, conflict_cols: tuple,
+                     returning: tuple) -> Statement:
+    """
+    :return: cached INSERT of one row updating existing one on conflict.
+    """
+    return get_statement(
+        ('upsert', table_name, cols, tuple(conflict_cols), tuple(returning)),
+        lambda: sql.SQL(
+            'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}{}'
+        ).format(
+            sql.Identifier(table_name), _columns(cols),
+            sql.SQL(', ').join(sql.Placeholder() for _ in cols),
+            _columns(conflict_cols),
+            sql.SQL(', ').join(
+                sql.SQL('{col}=EXCLUDED.{col}').format(col=sql.Identifier(col))
+                for col in cols if col not in conflict_cols
+            ),
+            _returning(returning),
+        ),
+    )
+
+
+def select_statement(table_name: str, cols: tuple, filters: Filter, order_by: tuple,
+                     descending: bool, limit: Optional[int],
+                     for_update: bool = False) -> Statement:
+    """
+    :param for_update: lock selected rows until end of transaction.
+    :return: cached SELECT statement of given shape.
+    """
+    def build() -> sql.Composable:
+        query = sql.SQL('SELECT {} FROM {}{}').format(
+            _columns(cols), sql.Identifier(table_name), _where(filters)
+        )
+        if order_by:
+            direction = sql.SQL(' DESC' if descending else ' ASC')
+            query += sql.SQL(' ORDER BY ') + sql.SQL(', ').join(
+                sql.Identifier(col) + direction for col in order_by
+            )
+        if limit:
+            query += sql.SQL(' LIMIT %s')
+        if for_update:
+            query += sql.SQL(' FOR UPDATE')
+        return query
+
+    return get_statement(
+        ('select', table_name, tuple(cols), filters.shape, tuple(order_by),
+         descending, bool(limit), for_update),
+        build,
+    )
+
+
+def update_statement(table_name: str, cols: tuple, filters: Filter,
+                     returning: tuple) -> Statement:
+    """
+    :return: cached UPDATE setting given columns.
+    """
+    return get_statement(
+        ('update', table_name, cols, filters.shape, tuple(returning)),
+        lambda: sql.SQL('UPDATE {} SET {}{}{}').format(
+            sql.Identifier(table_name),
+            sql.SQL(', ').join(
+                sql.SQL('{}=%s').format(sql.Identifier(col)) for col in cols
+            ),
+            _where(filters), _returning(returning),
+        ),
+    )
+
+
+def delete_statement(table_name: str, filters: Filter, returning: tuple) -> Statement:
+    """
+    :return: cached DELETE statement.
+    """
+    return get_statement(
+        ('delete', table_name, filters.shape, tuple(returning)),
+        lambda: sql.SQL('DELETE FROM {}{}{}').format(
+            sql.Identifier(table_name), _where(filters), _returning(returning),
+        ),
+    )
+
+
+def exists_statement(table_name: str, filters: Filter) -> Statement:
+    """
+    :return: cached query returning one row with True if rows match filters.
+    """
+    return get_statement(
+        ('exists', table_name, filters.shape),
+        lambda: sql.SQL('SELECT EXISTS (SELECT 1 FROM {}{})').format(
+            sql.Identifier(table_name), _where(filters),
+        ),
+    )
+
+
+def _is_connection_error(error: DBError) -> bool:
+    """
+    :return: True if error means server is unreachable rather than query is wrong.
+    """
+    return isinstance(error, DBPoolTimeout) or isinstance(
+        error.__cause__, (psycopg2.OperationalError, psycopg2.InterfaceError)
+    )
+
+
+_raw_labels: dict[str, str] = {}
+
+
+def _raw_label(query: str) -> str:
+    """
+    :return: cached metrics label of raw sql query.
+    """
+    label = _raw_labels.get(query)
+    if label is None:
+        label = _label(query)
+        if len(_raw_labels) < DB_STATEMENT_CACHE_SIZE:
+            _raw_labels[query] = label
+    return label
+
+
+def recorded_queries(connection) -> Iterator[tuple[str, str]]:
+    """
+    Queries run by this process so far, used to check their plans.
+    :return: metrics label and text with `%s` placeholders of every
+             statement shape and raw query.
+    """
+    for statement in list(_statements.values()):
+        yield statement.label, statement.text(connection)
+    for query, label in list(_raw_labels.items()):
+        yield label, query
 
 
 class DBManager:
     """
     Class for working with db.
+    Connection is borrowed from the pool for every query and returned
+    right after it, unless queries run inside `transaction` block.
+    Filters passed to methods are dicts `{col_name: value_or_condition}`
+    or Filter instances.
+    Reads outside transactions go to replicas if they are configured,
+    see `ReplicaRouter`.
+    Instances created while unit of work is active join it, see `UnitOfWork`.
     """
-    def __init__(self):
-        self.connection = connect(**DB_CONNECTION)
-        self.cursor = self.connection.cursor()
+    def __init__(self, pool: ConnectionPool = None, use_replicas: bool = True,
+                 join_unit: bool = True) -> None:
+        """
+        :param pool: pool to use instead of configured primary and replicas.
+        :param use_replicas: False to read from primary only, for data
+               which must be fresh, like catalogs reloaded on notification.
+        :param join_unit: False to work outside active unit of work, for
+               data shared between updates which must see only committed rows.
+        """
+        self.pool = pool or get_pool()
+        self.use_replicas = use_replicas and pool is None
+        self.connection = None
+        self.unit = current_unit.get() if join_unit and pool is None else None
+
+    @contextmanager
+    def transaction(self, savepoint: bool = False) -> Iterator['DBManager']:
+        """
+        Run several queries on one connection in one transaction.
+        Commit on success, rollback if any exception is raised.
+        Nested blocks join the outer transaction. Inside unit of work
+        block joins unit transaction, which is committed with the unit.
+        :param savepoint: inside unit of work run block in a savepoint, so
+               its error doesn't abort the unit. Used by callers which
+               handle db errors of the block, e.g. unique violations.
+        """
+        if self.connection is not None:
+            yield self
+            return
+
+        if self.unit is not None:
+            self.connection = self.unit.begin()
+            try:
+                if savepoint:
+                    with self.unit.savepoint():
+                        yield self
+                else:
+                    yield self
+            finally:
+                self.connection = None
+            return
+
+        with self.pool.connection() as connection:
+            self.connection = connection
+            try:
+                yield self
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                self.connection = None
+        if self.use_replicas:
+            get_router().note_write()
 
-    def _execute_or_rollback(self, query: str, values: tuple = ()) -> None:
+    def _execute_or_rollback(self, query: Union[str, Statement], values: tuple = (),
+                             fetch: str = None, many: bool = False,
+                             read_only: bool = False) -> Any:
         """
-        :param query: sql query
+        :param query: sql query or cached statement.
         :param values: values to fill placeholders in query.
+        :param fetch: `one` or `all` to return fetched rows.
+        :param many: `values` is a sequence of rows expanded
+               into single `VALUES %s` placeholder of query.
+        :param read_only: query can run on replica.
         :raise DBException in case of any error during query
             performing.
+        :return: fetched rows if `fetch` is specified else None.
+        """
+        if self.connection is not None:
+            return self._execute(self.connection, query, values, fetch, many)
+
+        if self.unit is not None:
+            if not read_only:
+                return self._execute(self.unit.begin(), query, values, fetch, many)
+            # reads see writes of the unit
+            if self.unit.connection is not None:
+                return self._execute(self.unit.connection, query, values, fetch, many)
+
+        if read_only and self.use_replicas:
+            router = get_router()
+            pool = router.read_pool()
+            if pool is not self.pool:
+                try:
+                    return self._execute_on(pool, query, values, fetch, many)
+                except DBError as error:
+                    if not _is_connection_error(error):
+                        raise
+                    router.report_failure(pool, error)
+
+        result = self._execute_on(self.pool, query, values, fetch, many)
+        if self.use_replicas and not read_only:
+            get_router().note_write()
+        return result
+
+    def _execute_on(self, pool: ConnectionPool, query: Union[str, Statement],
+                    values: tuple, fetch: str = None, many: bool = False) -> Any:
+        """
+        Execute query on connection borrowed from pool and commit.
+        """
+        with pool.connection() as connection:
+            result = self._execute(connection, query, values, fetch, many)
+            connection.commit()
+            return result
+
+    @staticmethod
+    def _execute(connection, query: Union[str, Statement], values: tuple,
+                 fetch: str = None, many: bool = False) -> Any:
+        """
+        Execute query on given connection. Transaction is rolled back
+        on error by its owner: `transaction`, savepoint of unit of work
+        or the pool when connection is returned.
         """
+        label = query.label if isinstance(query, Statement) else _raw_label(query)
+        started = time.perf_counter()
         try:
-            self.cursor.execute(query, values)
-        except psycopg2.errors.UniqueViolation as error:
-            raise DBUniqueViolation('Value already exists') from error
+            with connection.cursor() as cursor:
+                if many:
+                    result = execute_values(
+                        cursor, query.text(connection), values,
+                        page_size=max(len(values), 1), fetch=fetch == 'all',
+                    )
+                else:
+                    if isinstance(query, Statement):
+                        query.execute(connection, cursor, values)
+                    else:
+                        cursor.execute(query, values)
+                    result = None
+                    if fetch == 'one':
+                        result = cursor.fetchone()
+                    elif fetch == 'all':
+                        result = cursor.fetchall()
+            QUERY_LATENCY.observe(time.perf_counter() - started, label, 'ok')
+            return result
         except Exception as error:
+            QUERY_LATENCY.observe(time.perf_counter() - started, label, 'error')
+            if isinstance(error, psycopg2.errors.InvalidSqlStatementName):
+                getattr(connection, 'prepared', set()).clear()
+            if isinstance(error, psycopg2.errors.UniqueViolation):
+                raise DBUniqueViolation('Value already exists') from error
             raise DBError(str(error)) from error
 
     def insert(self, table_name: str, data: dict) -> None:
@@ -69,29 +746,198 @@ class DBManager:
         :param table_name: table to perform query.
         :param data: data to insert in format `{col_name: col_value}`.
         """
-        columns = ', '.join(key for key in data.keys())
-        values = tuple(data.values())
-        placeholders = ', '.join('%s' for _ in values)
-        query = f'INSERT INTO {table_name} ({columns}) VALUES ({placeholders})'
-        self._execute_or_rollback(query, values)
-        self.connection.commit()
+        statement = insert_statement(table_name, tuple(data))
+        self._execute_or_rollback(statement, tuple(data.values()))
 
-    def select(self, table_name: str, cols: tuple, filters: dict
-               ) -> list[tuple[Any]]:
+    def insert_many(self, table_name: str, cols: tuple, rows: list[tuple],
+                    returning: tuple = ()) -> Optional[list[tuple[Any]]]:
+        """
+        Insert several rows into specified table with single
+        multi-row INSERT query.
+        :param table_name: table to perform query.
+        :param cols: columns to insert.
+        :param rows: list of tuples with values in `cols` order.
+        :param returning: columns of inserted rows to return.
+        :return: list of tuples with `returning` columns values in
+                 `rows` order or None if nothing to return.
+        """
+        if not rows:
+            return [] if returning else None
+        statement = get_statement(
+            ('insert_many', table_name, tuple(cols), tuple(returning)),
+            lambda: sql.SQL('INSERT INTO {} ({}) VALUES %s{}').format(
+                sql.Identifier(table_name), _columns(cols), _returning(returning),
+            ),
+            preparable=False,
+        )
+        return self._execute_or_rollback(
+            statement, rows, fetch='all' if returning else None, many=True
+        )
+
+    def increment_many(self, table_name: str, key_cols: tuple, value_cols: tuple,
+                       rows: list[tuple]) -> None:
+        """
+        Add values to counters of rows with given keys, creating
+        missing rows. Done in one query.
+        :param table_name: table to perform query.
+        :param key_cols: columns of unique constraint identifying row.
+        :param value_cols: numeric columns to increment.
+        :param rows: list of tuples with key values followed by increments.
+        """
+        if not rows:
+            return
+        table = sql.Identifier(table_name)
+        statement = get_statement(
+            ('increment_many', table_name, tuple(key_cols), tuple(value_cols)),
+            lambda: sql.SQL(
+                'INSERT INTO {} ({}) VALUES %s ON CONFLICT ({}) DO UPDATE SET {}'
+            ).format(
+                table, _columns(key_cols + value_cols), _columns(key_cols),
+                sql.SQL(', ').join(
+                    sql.SQL('{col}={table}.{col}+EXCLUDED.{col}').format(
+                        col=sql.Identifier(col), table=table,
+                    ) for col in value_cols
+                ),
+            ),
+            preparable=False,
+        )
+        self._execute_or_rollback(statement, rows, many=True)
+
+    def upsert_many(self, table_name: str, cols: tuple, conflict_cols: tuple,
+                    rows: list[tuple]) -> None:
+        """
+        Insert rows or update existing rows with same `conflict_cols`
+        values. Done in one query, rows must have distinct keys.
+        :param table_name: table to perform query.
+        :param cols: columns to insert, including `conflict_cols`.
+        :param conflict_cols: columns of unique constraint to check.
+        :param rows: list of tuples with values in `cols` order.
+        """
+        if not rows:
+            return
+        statement = get_statement(
+            ('upsert_many', table_name, tuple(cols), tuple(conflict_cols)),
+            lambda: sql.SQL(
+                'INSERT INTO {} ({}) VALUES %s ON CONFLICT ({}) DO UPDATE SET {}'
+            ).format(
+                sql.Identifier(table_name), _columns(cols), _columns(conflict_cols),
+                sql.SQL(', ').join(
+                    sql.SQL('{col}=EXCLUDED.{col}').format(col=sql.Identifier(col))
+                    for col in cols if col not in conflict_cols
+                ),
+            ),
+            preparable=False,
+        )
+        self._execute_or_rollback(statement, rows, many=True)
+
+    def upsert(self, table_name: str, data: dict, conflict_cols: tuple,
+               returning: tuple = ()) -> Optional[tuple[Any]]:
+        """
+        Insert row or update it if row with same `conflict_cols` values
+        already exists. Done in one query.
+        :param table_name: table to perform query.
+        :param data: data to insert in format `{col_name: col_value}`.
+        :param conflict_cols: columns of unique constraint to check.
+        :param returning: columns of inserted or updated row to return.
+        :return: tuple with `returning` columns values or None if
+                 nothing to return.
+        """
+        statement = upsert_statement(table_name, tuple(data), conflict_cols, returning)
+        return self._execute_or_rollback(
+            statement, tuple(data.values()), fetch='one' if returning else None
+        )
+
+    def select(self, table_name: str, cols: tuple, filters: Union[dict, Filter],
+               order_by: tuple = (), descending: bool = False, limit: int = None,
+               for_update: bool = False) -> list[tuple[Any]]:
         """
         Select data from specified table.
         :param table_name: table to perform query.
         :param cols: columns to select from table.
         :param filters: data to form WHERE clause.
+        :param order_by: columns to sort rows by.
+        :param descending: sort in descending order.
+        :param limit: max number of rows.
+        :param for_update: lock selected rows until end of transaction,
+               query runs on primary.
         :return: list of tuples. Each tuple represent db row.
         """
-        columns = ', '.join(cols)
-        where = WhereInput(filters)
-        query = f'SELECT {columns} FROM {table_name} {where}'
-        self._execute_or_rollback(query, where.values)
-        return self.cursor.fetchall()
+        filters = as_filter(filters)
+        statement = select_statement(
+            table_name, cols, filters, order_by, descending, limit, for_update
+        )
+        values = filters.values + ((limit,) if limit else ())
+        return self._execute_or_rollback(
+            statement, values, fetch='all', read_only=not for_update
+        )
 
-    def update(self, table_name: str, data: dict, filters: dict) -> None:
+    def select_iter(self, table_name: str, cols: tuple, filters: Union[dict, Filter],
+                    order_by: tuple = (), after: tuple = (), descending: bool = False,
+                    limit: int = None, itersize: int = DB_ITERSIZE) -> Iterator[tuple[Any]]:
+        """
+        Stream rows from specified table with server-side cursor.
+        Rows are fetched from db by `itersize` rows, so result is never
+        held in memory whole. Connection is held until iterator is
+        exhausted or closed. If replica is unreachable before the first
+        row, rows are read from primary.
+        :param table_name: table to perform query.
+        :param cols: columns to select from table.
+        :param filters: data to form WHERE clause.
+        :param order_by: columns to sort rows by.
+        :param after: values of `order_by` columns of the last row of
+               previous page. Only rows after it are returned (keyset pagination).
+        :param descending: sort in descending order.
+        :param limit: max number of rows.
+        :param itersize: number of rows fetched from db at once.
+        :return: iterator over tuples. Each tuple represent db row.
+        """
+        filters = as_filter(filters)
+        if after:
+            filters = And(filters, Keyset(order_by, after, descending))
+        statement = select_statement(
+            table_name, cols, filters, order_by, descending, limit
+        )
+        values = filters.values + ((limit,) if limit else ())
+
+        connection = self.connection or (self.unit and self.unit.connection)
+        if connection is not None:
+            yield from self._iterate(connection, statement, values, itersize)
+            return
+        pool = get_router().read_pool() if self.use_replicas else self.pool
+        if pool is not self.pool:
+            fetched = False
+            try:
+                with pool.connection() as connection:
+                    for row in self._iterate(connection, statement, values, itersize):
+                        fetched = True
+                        yield row
+                return
+            except DBError as error:
+                # rows already yielded can't be fetched again
+                if fetched or not _is_connection_error(error):
+                    raise
+                get_router().report_failure(pool, error)
+        with self.pool.connection() as connection:
+            yield from self._iterate(connection, statement, values, itersize)
+
+    @staticmethod
+    def _iterate(connection, statement: Statement, values: tuple,
+                 itersize: int) -> Iterator[tuple[Any]]:
+        """
+        Execute statement with named cursor and yield its rows.
+        Named cursors can't EXECUTE prepared statements, so plain
+        statement text is used.
+        """
+        try:
+            with connection.cursor(name=f'select_iter_{uuid4().hex}') as cursor:
+                cursor.itersize = itersize
+                cursor.execute(statement.text(connection), values)
+                yield from cursor
+        except Exception as error:
+            raise DBError(str(error)) from error
+
+    def update(self, table_name: str, data: dict, filters: Union[dict, Filter],
+               returning: tuple = ()) -> Optional[list[tuple[Any]]]:
         """
         Update data in specified table.
         :param table_name: table to perform query.
@@ -99,29 +945,35 @@ class DBManager:
                values - new values.
         :param filters: data to form WHERE clause.
                Key - column name, value - column value.
-        :return: None.
+        :param returning: columns of updated rows to return.
+        :return: list of tuples with `returning` columns of updated rows
+                 or None if nothing to return.
         """
-        columns = ','.join(f'{key}=%s' for key in data)
-        values = tuple(data.values())
-        where = WhereInput(filters)
-        query = f'UPDATE {table_name} SET {columns} {where}'
-        self._execute_or_rollback(query, values + where.values)
-        self.connection.commit()
+        filters = as_filter(filters)
+        statement = update_statement(table_name, tuple(data), filters, returning)
+        return self._execute_or_rollback(
+            statement, tuple(data.values()) + filters.values,
+            fetch='all' if returning else None,
+        )
 
-    def delete(self, table_name: str, filters: dict) -> None:
+    def delete(self, table_name: str, filters: Union[dict, Filter],
+               returning: tuple = ()) -> Optional[list[tuple[Any]]]:
         """
         Delete data from specified table.
         :param table_name: table to perform query.
         :param filters: data to form WHERE clause.
                Key - column name, value - column value.
-        :return: None.
+        :param returning: columns of deleted rows to return.
+        :return: list of tuples with `returning` columns of deleted rows
+                 or None if nothing to return.
         """
-        where = WhereInput(filters)
-        query = f'DELETE FROM {table_name} {where}'
-        self._execute_or_rollback(query, where.values)
-        self.connection.commit()
+        filters = as_filter(filters)
+        statement = delete_statement(table_name, filters, returning)
+        return self._execute_or_rollback(
+            statement, filters.values, fetch='all' if returning else None
+        )
 
-    def exists(self, table_name: str, filters: dict) -> bool:
+    def exists(self, table_name: str, filters: Union[dict, Filter]) -> bool:
         """
         Check if row exists in database.
         :param table_name: table to perform query.
@@ -129,8 +981,288 @@ class DBManager:
                Key - column name, value - column value.
         :return: True if row exists else False.
         """
-        where = WhereInput(filters)
-        query = f'SELECT EXISTS (SELECT 1 FROM {table_name} {where})'
-        self._execute_or_rollback(query, where.values)
-        self.connection.commit()
-        return all(self.cursor.fetchone())
+        filters = as_filter(filters)
+        statement = exists_statement(table_name, filters)
+        return all(self._execute_or_rollback(
+            statement, filters.values, fetch='one', read_only=True
+        ))
+
+    def notify(self, channel: str, payload: str = '') -> None:
+        """
+        Send postgres notification to all sessions listening to channel.
+        Inside transaction notification is delivered on commit.
+        :param channel: channel name.
+        :param payload: notification text.
+        """
+        self._execute_or_rollback('SELECT pg_notify(%s, %s)', (channel, payload))
+
+    def execute(self, query: str, values: tuple = (), fetch: str = None) -> Any:
+        """
+        Execute arbitrary query. Used for set-based statements which
+        don't fit table methods above.
+        :param query: sql query.
+        :param values: values to fill placeholders in query.
+        :param fetch: `one` or `all` to return fetched rows.
+        :return: fetched rows if `fetch` is specified else None.
+        """
+        return self._execute_or_rollback(query, values, fetch=fetch)
+
+    @contextmanager
+    def _borrow(self, read_only: bool = False) -> Iterator[Any]:
+        """
+        Connection of current transaction, or connection borrowed from
+        the pool and committed after `with` block.
+        :param read_only: connection may be borrowed from replica.
+        """
+        if self.connection is not None:
+            yield self.connection
+            return
+        if self.unit is not None and (not read_only or self.unit.connection is not None):
+            with self.transaction():
+                yield self.connection
+            return
+        pool = get_router().read_pool() if read_only and self.use_replicas else self.pool
+        with pool.connection() as connection:
+            yield connection
+            connection.commit()
+
+    def _copy(self, build: Callable[[Any], str], file: IO, read_only: bool,
+              label: str) -> int:
+        """
+        Run COPY query with file as STDIN or STDOUT.
+        :param build: returns query text for connection.
+        :param label: metrics label of query.
+        :return: number of copied rows.
+        """
+        started = time.perf_counter()
+        with self._borrow(read_only) as connection:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(build(connection), file)
+                    rows = cursor.rowcount
+            except Exception as error:
+                QUERY_LATENCY.observe(time.perf_counter() - started, label, 'error')
+                raise DBError(str(error)) from error
+        QUERY_LATENCY.observe(time.perf_counter() - started, label, 'ok')
+        return rows
+
+    def copy_out(self, query: sql.Composable, file: IO[bytes], label: str = 'copy_out') -> int:
+        """
+        Stream result of SELECT query to file as CSV with header.
+        Rows are written as they come from db, result is never held
+        in memory whole.
+        :param query: SELECT query with values already composed in,
+               COPY does not support placeholders.
+        :param file: binary file to write to.
+        :param label: metrics label of query.
+        :return: number of rows.
+        """
+        return self._copy(
+            lambda connection: sql.SQL('COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)').format(
+                query
+            ).as_string(connection),
+            file, read_only=True, label=label,
+        )
+
+    def copy_in(self, table_name: str, cols: tuple, file: IO) -> int:
+        """
+        Load CSV rows without header from file into table.
+        :param table_name: table to load rows to.
+        :param cols: columns of CSV rows.
+        :param file: file to read from.
+        :return: number of rows.
+        """
+        return self._copy(
+            lambda connection: sql.SQL('COPY {} ({}) FROM STDIN WITH (FORMAT csv)').format(
+                sql.Identifier(table_name), _columns(cols),
+            ).as_string(connection),
+            file, read_only=False, label=f'copy_in:{table_name}',
+        )
+
+
+def after_commit(callback: Callable[[], None]) -> None:
+    """
+    Run callback after active unit of work commits, right away without unit.
+    """
+    unit = current_unit.get()
+    if unit is None:
+        callback()
+    else:
+        unit.after_commit(callback)
+
+
+class UnitOfWork:
+    """
+    Database work of one update done in one transaction.
+    Loaded models are kept in identity map, so repeated lookups return
+    the same instance, and their changed attributes are flushed together
+    when unit commits. Models are `services.model.Model` instances.
+    Connection is borrowed on first write and held until the unit ends:
+    DBManager instances created while unit is active run writes and
+    following reads on it, failed write aborts the unit unless it runs in
+    `transaction(savepoint=True)` block. Reads before the first write go
+    to replicas as usual.
+    Usage: `with UnitOfWork(): ...`, commit on success, rollback on exception.
+    """
+
+    def __init__(self, pool: ConnectionPool = None) -> None:
+        """
+        :param pool: pool of primary, configured one by default.
+        """
+        self.pool = pool or get_pool()
+        self.connection = None
+        self._identity: dict[tuple, Any] = {}
+        self._tracked: list[Any] = []
+        self._dirty: dict[int, Any] = {}
+        self._after_commit: list[Callable[[], None]] = []
+        self._savepoints = itertools.count()
+        self._token = None
+
+    def __enter__(self) -> 'UnitOfWork':
+        self._token = current_unit.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            current_unit.reset(self._token)
+
+    @classmethod
+    @contextmanager
+    def join(cls) -> Iterator['UnitOfWork']:
+        """
+        Active unit, or new one committed at the end of `with` block.
+        """
+        unit = current_unit.get()
+        if unit is not None:
+            yield unit
+            return
+        with cls() as unit:
+            yield unit
+
+    def get(self, model_class: type, key: tuple) -> Optional[Any]:
+        """
+        :return: model loaded by this unit or None.
+        """
+        return self._identity.get((model_class, key))
+
+    def add(self, model: Any, track: bool = True) -> Any:
+        """
+        Put loaded model to identity map.
+        :param track: track changes of model, False for instances shared
+               with other threads through caches.
+        :return: model already loaded with the same key, or given one.
+        """
+        loaded = self._identity.setdefault((type(model), model.key), model)
+        if loaded is model and track:
+            model.attach(self)
+            self._tracked.append(model)
+        return loaded
+
+    def discard(self, model_class: type, key: tuple) -> None:
+        """
+        Forget model deleted from db.
+        """
+        model = self._identity.pop((model_class, key), None)
+        if model is not None:
+            self._dirty.pop(id(model), None)
+
+    def mark_dirty(self, model: Any) -> None:
+        """
+        Flush model on commit. Called by model when its attribute changes.
+        """
+        self._dirty[id(model)] = model
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """
+        Run callback after unit is committed, it is dropped on rollback.
+        """
+        self._after_commit.append(callback)
+
+    def begin(self) -> Any:
+        """
+        :return: connection of unit transaction, borrowed on first call.
+        """
+        if self.connection is None:
+            self.connection = self.pool.getconn()
+        return self.connection
+
+    @contextmanager
+    def savepoint(self) -> Iterator[None]:
+        """
+        Run `with` block in savepoint, its work is undone on exception
+        without aborting the unit.
+        """
+        name = f'unit_{next(self._savepoints)}'
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'SAVEPOINT {name}')
+        try:
+            yield
+        except Exception:
+            if not self.connection.closed:
+                with self.connection.cursor() as cursor:
+                    cursor.execute(f'ROLLBACK TO SAVEPOINT {name}')
+            raise
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'RELEASE SAVEPOINT {name}')
+
+    def flush(self) -> None:
+        """
+        Write changed attributes of loaded models.
+        :raise DBError in case of db errors.
+        """
+        db_manager = DBManager(self.pool)
+        db_manager.unit = self
+        while self._dirty:
+            models = list(self._dirty.values())
+            self._dirty.clear()
+            with db_manager.transaction():
+                for model in models:
+                    model.flush(db_manager)
+
+    def commit(self) -> None:
+        """
+        Flush changes and commit unit transaction, then run after commit
+        callbacks. Unit is rolled back if commit fails.
+        :raise DBError in case of db errors.
+        """
+        try:
+            self.flush()
+            if self.connection is not None:
+                status = self.connection.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                    raise DBError('Transaction was aborted by failed query')
+                try:
+                    self.connection.commit()
+                except psycopg2.Error as error:
+                    raise DBError(str(error)) from error
+                get_router().note_write()
+        except Exception:
+            self.rollback()
+            raise
+        self._release()
+        for model in self._tracked:
+            model.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self) -> None:
+        """
+        Roll back unit transaction and restore loaded values of models.
+        """
+        # the pool rolls back unfinished transaction of returned connection
+        self._release()
+        for model in self._tracked:
+            model.revert()
+        self._dirty.clear()
+        self._after_commit = []
+
+    def _release(self) -> None:
+        if self.connection is not None:
+            self.pool.putconn(self.connection)
+            self.connection = None
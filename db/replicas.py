@@ -0,0 +1,206 @@
+"""
+Routing of read-only queries to replicas
+"""
+import itertools
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from cachetools import TTLCache
+
+from config.settings import (DB_CONNECTION, DB_POOL, DB_REPLICA_CHECK_INTERVAL,
+                             DB_REPLICA_MAX_LAG, DB_REPLICAS, DB_STICKY_SECONDS)
+from .pool import ConnectionPool, get_pool
+
+logger = logging.getLogger(__name__)
+
+# chat whose update is being processed, set by `user_required`
+current_chat: ContextVar[Optional[int]] = ContextVar('current_chat', default=None)
+
+# replay lag in seconds, 0 when replica replayed everything it received
+# or when server is not in recovery
+_LAG_QUERY = """
+SELECT COALESCE(CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END, 0)
+"""
+
+
+class Replica:
+    """
+    Replica pool with its health state.
+    """
+
+    def __init__(self, name: str, pool: ConnectionPool) -> None:
+        self.name = name
+        self.pool = pool
+        self.lag = 0.0
+        self.down_until = 0.0
+        self.last_error: Optional[str] = None
+
+    def available(self, now: float, max_lag: float) -> bool:
+        return now >= self.down_until and self.lag <= max_lag
+
+
+class ReplicaRouter:
+    """
+    Chooses pool for read-only query. Least busy available replica is
+    used, ties are resolved round-robin. Primary is used when
+    - no replica is configured or available: all are down or lag
+      more than `max_lag` seconds,
+    - current chat wrote less than `sticky_seconds` ago, so the chat
+      always reads its own writes.
+    """
+
+    def __init__(self, primary: ConnectionPool, replicas: list[Replica],
+                 sticky_seconds: float = 5.0, max_lag: float = 5.0,
+                 check_interval: float = 5.0) -> None:
+        """
+        :param primary: pool of primary server.
+        :param replicas: replica pools.
+        :param sticky_seconds: reads of chat go to primary for this time after it writes.
+        :param max_lag: replica lagging more seconds is not used.
+        :param check_interval: seconds between lag checks, failed replica
+               is not used for this time.
+        """
+        self.primary = primary
+        self.replicas = replicas
+        self.sticky_seconds = sticky_seconds
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        # chat is removed when its window is over
+        self._writes = TTLCache(maxsize=1_000_000, ttl=sticky_seconds) \
+            if sticky_seconds > 0 else None
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self._monitor: Optional[threading.Thread] = None
+        self.stats = {'replica_reads': 0, 'primary_reads': 0, 'sticky_reads': 0, 'failovers': 0}
+
+    def note_write(self, chat_id: int = None) -> None:
+        """
+        Remember that chat wrote, current chat by default.
+        """
+        if not self.replicas or self._writes is None:
+            return
+        chat_id = current_chat.get() if chat_id is None else chat_id
+        if chat_id is not None:
+            with self._lock:
+                self._writes[chat_id] = True
+
+    def read_pool(self) -> ConnectionPool:
+        """
+        :return: pool to run read-only query on.
+        """
+        if not self.replicas:
+            return self.primary
+        chat_id = current_chat.get()
+        with self._lock:
+            if chat_id is not None and self._writes is not None and chat_id in self._writes:
+                self.stats['sticky_reads'] += 1
+                return self.primary
+            now = time.monotonic()
+            available = [
+                replica for replica in self.replicas if replica.available(now, self.max_lag)
+            ]
+            if not available:
+                self.stats['primary_reads'] += 1
+                return self.primary
+            turn = next(self._turn)
+            available = available[turn % len(available):] + available[:turn % len(available)]
+            self.stats['replica_reads'] += 1
+        return min(available, key=lambda replica: replica.pool.busy).pool
+
+    def report_failure(self, pool: ConnectionPool, error: Exception) -> None:
+        """
+        Stop using replica until next successful check.
+        """
+        for replica in self.replicas:
+            if replica.pool is pool:
+                logger.warning('Replica %s failed: %s', replica.name, error)
+                with self._lock:
+                    replica.down_until = time.monotonic() + self.check_interval
+                    replica.last_error = str(error)
+                    self.stats['failovers'] += 1
+
+    def check(self) -> None:
+        """
+        Measure lag of every replica, mark unreachable ones as down.
+        """
+        for replica in self.replicas:
+            try:
+                with replica.pool.connection(timeout=self.check_interval) as connection:
+                    with connection.cursor() as cursor:
+                        cursor.execute(_LAG_QUERY)
+                        lag = float(cursor.fetchone()[0])
+                    connection.rollback()
+            except Exception as error:  # pylint: disable=broad-except
+                self.report_failure(replica.pool, error)
+                continue
+            with self._lock:
+                replica.lag = lag
+                replica.down_until = 0.0
+                replica.last_error = None
+            if lag > self.max_lag:
+                logger.warning('Replica %s lags %.1f seconds', replica.name, lag)
+
+    def start_monitor(self) -> None:
+        """
+        Start daemon thread checking replicas every `check_interval` seconds.
+        """
+        if self._monitor is not None or not self.replicas:
+            return
+
+        def monitor() -> None:
+            while True:
+                self.check()
+                time.sleep(self.check_interval)
+
+        self._monitor = threading.Thread(target=monitor, name='db-replica-monitor', daemon=True)
+        self._monitor.start()
+
+    def replica_stats(self) -> dict[str, Any]:
+        """
+        :return: routing counters and number of available replicas.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'replicas': len(self.replicas),
+                'available': sum(
+                    replica.available(now, self.max_lag) for replica in self.replicas
+                ),
+                'max_lag_seconds': max((replica.lag for replica in self.replicas), default=0.0),
+                **self.stats,
+            }
+
+
+_router: Optional[ReplicaRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ReplicaRouter:
+    """
+    :return: process wide router over primary pool and replicas
+             configured in settings. Router is created on first call.
+    """
+    global _router  # pylint: disable=global-statement
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                replicas = []
+                for number, dsn in enumerate(DB_REPLICAS):
+                    # replica may be down at start, connections are opened on demand
+                    pool = ConnectionPool(
+                        {**DB_CONNECTION, 'dsn': dsn}, **{**DB_POOL, 'min_size': 0}
+                    )
+                    pool.start_reaper()
+                    replicas.append(Replica(f'replica{number}', pool))
+                _router = ReplicaRouter(
+                    get_pool(), replicas, sticky_seconds=DB_STICKY_SECONDS,
+                    max_lag=DB_REPLICA_MAX_LAG, check_interval=DB_REPLICA_CHECK_INTERVAL,
+                )
+                _router.start_monitor()
+    return _router
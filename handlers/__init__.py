@@ -1,3 +1,5 @@
 """Imports for convince"""
 from .admin import register_admin_handlers  # noqa F401
 from .handlers import register_handlers  # noqa F401
+from .flood import flood_control  # noqa F401
+from .jobs import register_jobs  # noqa F401
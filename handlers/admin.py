@@ -1,21 +1,32 @@
 """
 Callback functions for admin commands
 """
-from telegram.ext import CommandHandler, CallbackContext, Dispatcher
+from itertools import islice
+from tempfile import SpooledTemporaryFile
+from typing import Iterator, Optional
+
+from telegram.ext import CommandHandler, CallbackContext, Dispatcher, Filters, MessageHandler
 from telegram.update import Update
 
-from services import User, Category, CategoryError, user_required
+from config.settings import SPOOL_MAX_SIZE
+from services import (User, Category, CategoryError, RateError, Rates, ReportError, Rollup,
+                      user_required)
+from runtime.sender import outbox
 from .filters import AdminFilter
+from .handlers import MAX_DOWNLOAD_SIZE
+from .pagination import Pager
+
+LOAD_RATES_USAGE = 'Send CSV file with `/load_rates` caption. Columns: date,currency,rate'
 
 
 @user_required
-def admin_help(user: User, update: Update, context: CallbackContext):
+async def admin_help(user: User, update: Update, context: CallbackContext):
     """
     Handler for `/admin_help` command. Send list of admin commands.
     """
     text = f"""Hello, {user.first_name}. Admin commands"""
-    context.bot.send_message(
-        chat_id=update.effective_chat.id, text=text
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=text
     )
 
 
@@ -28,35 +39,50 @@ def admin_create_category(user: User, update: Update, context: CallbackContext):
     try:
         category = Category.add_category(context.args)
     except CategoryError as error:
-        context.bot.send_message(
-            chat_id=update.effective_chat.id, text=str(error)
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
         )
         return
 
-    context.bot.send_message(
-        chat_id=update.effective_chat.id, text=f'Category added.\n{category}'
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=f'Category added.\n{category}'
     )
 
 
+def _fetch_categories(update: Update, context: CallbackContext, cursor: Optional[str],
+                      limit: int) -> Iterator[tuple[str, str]]:
+    """
+    Page of categories sorted by codename. Cursor is `<type>|<codename>`.
+    """
+    if cursor is None:
+        category_type = context.args[0] if context.args else 'expense'
+        after = ''
+    else:
+        category_type, after = cursor.split('|', 1)
+
+    categories = sorted(Category.get_all(category_type), key=lambda category: category.codename)
+    page = (category for category in categories if category.codename > after)
+    for category in islice(page, limit):
+        yield category.admin_str(), f'{category_type}|{category.codename}'
+
+
+categories_pager = Pager(
+    'admin_categories', _fetch_categories, admin_only=True, empty_text='No categories'
+)
+
+
 @user_required
 def admin_categories(user: User, update: Update, context: CallbackContext):
     """
-    Handler for `/admin_categories` command. Sends message with categories list.
+    Handler for `/admin_categories` command. Sends categories list by pages.
     Command example: `/admin_categories <category_type>`
     """
     try:
-        category_type = context.args[0] if context.args else 'expense'
-        categories = Category.get_all(category_type)
+        categories_pager.send(update, context)
     except CategoryError as error:
-        context.bot.send_message(
-            chat_id=update.effective_chat.id, text=str(error)
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
         )
-        return
-
-    text = '\n'.join(category.admin_str() for category in categories)
-    context.bot.send_message(
-        chat_id=update.effective_chat.id, text=str(text)
-    )
 
 
 @user_required
@@ -66,21 +92,23 @@ def admin_update_category(user: User, update: Update, context: CallbackContext):
     Command example: `/update_category <codename> <key>=<value> <key>=<value>`
     """
     if not context.args:
-        context.bot.send_message(
-            chat_id=update.effective_chat.id, text='Invalid command. See `/admin_help`'
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id,
+            text='Invalid command. See `/admin_help`'
         )
         return
 
     try:
         category = Category.update(context_args=context.args)
     except CategoryError as error:
-        context.bot.send_message(
-            chat_id=update.effective_chat.id, text=str(error)
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
         )
         return
 
-    context.bot.send_message(
-        chat_id=update.effective_chat.id, text=f'Category updated\n{category.admin_str()}'
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id,
+        text=f'Category updated\n{category.admin_str()}'
     )
 
 
@@ -95,13 +123,148 @@ def admin_delete_category(user: User, update: Update, context: CallbackContext):
     try:
         Category.delete(codename)
     except CategoryError as error:
-        context.bot.send_message(
-            chat_id=update.effective_chat.id, text=str(error)
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+        return
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=f'Category {codename} deleted'
+    )
+
+
+@user_required
+def admin_add_alias(user: User, update: Update, context: CallbackContext):
+    """
+    Handler for `/add_alias` command.
+    Command example: `/add_alias <codename> <alias>`
+    """
+    try:
+        alias, codename = Category.add_alias(context.args)
+    except CategoryError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+        return
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=f'Alias {alias} added to {codename}'
+    )
+
+
+@user_required
+def admin_delete_alias(user: User, update: Update, context: CallbackContext):
+    """
+    Handler for `/delete_alias` command.
+    Command example: `/delete_alias <alias>`
+    """
+    try:
+        alias = Category.delete_alias(context.args)
+    except CategoryError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+        return
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=f'Alias {alias} deleted'
+    )
+
+
+@user_required
+def admin_rebuild_rollups(user: User, update: Update, context: CallbackContext):
+    """
+    Handler for `/rebuild_rollups` command.
+    Recompute report aggregates from the ledger, all months
+    or months starting from given one.
+    Command example: `/rebuild_rollups`, `/rebuild_rollups 2021-09`
+    """
+    try:
+        since = Rollup.parse_period(context.args)[1] if context.args else None
+        Rollup.rebuild(since)
+    except ReportError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+        return
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text='Rollups rebuilt'
+    )
+
+
+@user_required
+def admin_check_rollups(user: User, update: Update, context: CallbackContext):
+    """
+    Handler for `/check_rollups` command.
+    Compare report aggregates with the ledger.
+    """
+    try:
+        mismatches = Rollup.check()
+    except ReportError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
         )
         return
 
-    context.bot.send_message(
-        chat_id=update.effective_chat.id, text=f'Category {codename} deleted'
+    if not mismatches:
+        text = 'Rollups are consistent'
+    else:
+        text = '\n'.join(
+            [f'Found {len(mismatches)} mismatches. Run `/rebuild_rollups`'] + [
+                f'{item.table}: chat {item.chat_id} {item.codename} {item.type} '
+                f'{item.currency} {item.period}: expected {item.expected}, got {item.actual}'
+                for item in mismatches
+            ]
+        )
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=text
+    )
+
+
+@user_required
+def admin_set_rate(user: User, update: Update, context: CallbackContext):
+    """
+    Handler for `/set_rate` command. Set rate of currency to default
+    currency from given day, today by default.
+    Command example: `/set_rate EUR 1.08`, `/set_rate EUR 1.08 2021-07-28`
+    """
+    try:
+        rate = Rates.set(context.args)
+    except RateError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+        return
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id,
+        text=f'Rate of {rate.currency} from {rate.day} set to {rate.rate}'
+    )
+
+
+@user_required
+def admin_load_rates(user: User, update: Update, context: CallbackContext):
+    """
+    Handler for `/load_rates` command and CSV file with `/load_rates` caption.
+    Insert or replace rates from file and reply with summary.
+    """
+    document = update.message.document if update.message else None
+    if document is None:
+        text = LOAD_RATES_USAGE
+    elif document.file_size and document.file_size > MAX_DOWNLOAD_SIZE:
+        text = 'File is too big, split it into files up to 20 MB'
+    else:
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as file:
+            context.bot.get_file(document.file_id).download(out=file)
+            file.seek(0)
+            try:
+                text = Rates.summary_str(Rates.load(file))
+            except RateError as error:
+                text = str(error)
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=text
     )
 
 
@@ -118,9 +281,32 @@ def register_admin_handlers(dispatcher: Dispatcher) -> None:
     dispatcher.add_handler(
         CommandHandler(['admin_categories'], admin_categories, filters=AdminFilter())
     )
+    dispatcher.add_handler(categories_pager.handler)
     dispatcher.add_handler(
         CommandHandler(['update_category'], admin_update_category, filters=AdminFilter())
     )
     dispatcher.add_handler(
         CommandHandler(['delete_category'], admin_delete_category, filters=AdminFilter())
     )
+    dispatcher.add_handler(
+        CommandHandler(['add_alias'], admin_add_alias, filters=AdminFilter())
+    )
+    dispatcher.add_handler(
+        CommandHandler(['delete_alias'], admin_delete_alias, filters=AdminFilter())
+    )
+    dispatcher.add_handler(
+        CommandHandler(['rebuild_rollups'], admin_rebuild_rollups, filters=AdminFilter())
+    )
+    dispatcher.add_handler(
+        CommandHandler(['check_rollups'], admin_check_rollups, filters=AdminFilter())
+    )
+    dispatcher.add_handler(
+        CommandHandler(['set_rate'], admin_set_rate, filters=AdminFilter())
+    )
+    dispatcher.add_handler(
+        CommandHandler(['load_rates'], admin_load_rates, filters=AdminFilter())
+    )
+    dispatcher.add_handler(MessageHandler(
+        Filters.document & Filters.caption_regex(r'^/load_rates\b') & AdminFilter(),
+        admin_load_rates,
+    ))
@@ -0,0 +1,240 @@
+"""
+Flood control applied to every update before handlers
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Hashable, Optional
+
+from cachetools import TTLCache
+from telegram.ext import CallbackContext, Dispatcher, DispatcherHandlerStop, TypeHandler
+from telegram.update import Update
+
+from config.settings import (ADMIN_CHATS, FLOOD_ADMIN_BURST, FLOOD_ADMIN_RATE, FLOOD_BURST,
+                             FLOOD_EXPENSIVE_BURST, FLOOD_EXPENSIVE_COMMANDS,
+                             FLOOD_EXPENSIVE_RATE, FLOOD_MAX_DEFERRED, FLOOD_MAX_DELAY,
+                             FLOOD_RATE, FLOOD_SHED_DEPTH)
+from runtime.scheduler import update_key
+from runtime.sender import TokenBucket, outbox
+
+logger = logging.getLogger(__name__)
+
+CHEAP, EXPENSIVE, ADMIN = 'cheap', 'expensive', 'admin'
+FLOOD_TEXT = 'Too many requests. Please slow down'
+# chat is told about dropped updates at most once in this number of seconds
+NOTICE_INTERVAL = 60
+
+
+class FloodControl:
+    """
+    Admits updates of every chat within token bucket budget of their
+    kind: cheap updates, expensive commands or updates of admin chats.
+    Update over budget is deferred and put to update queue again when
+    it fits in budget, later updates of its chat wait behind it, so
+    chat updates keep their order. Update which would wait too long is
+    dropped. Deferred updates are dropped on stop.
+    While dispatcher queue is too deep updates of all chats except
+    admin ones are dropped, so handlers and db serve updates in progress.
+    Handler is registered in group -1, so it runs before all handlers.
+    """
+
+    def __init__(self, budgets: dict[str, tuple[float, float]], expensive_commands: list[str],
+                 admin_chats: list[int], max_delay: float = 5, max_deferred: int = 5,
+                 shed_depth: int = 1000) -> None:
+        """
+        :param budgets: `(rate, burst)` of every update kind: CHEAP,
+               EXPENSIVE and ADMIN. Chat gets `burst` updates at once and
+               `rate` updates per second on average.
+        :param expensive_commands: commands using EXPENSIVE budget.
+        :param admin_chats: chats using ADMIN budget for all updates. List
+               is read on every check, so chats added later are admins too.
+        :param max_delay: max seconds update is deferred.
+        :param max_deferred: max number of deferred updates of one chat,
+               0 disables deferring.
+        :param shed_depth: number of updates not processed yet above which
+               updates are dropped, 0 disables load shedding.
+        """
+        self.budgets = budgets
+        self.expensive_commands = frozenset(expensive_commands)
+        self.admin_chats = admin_chats
+        self.max_delay = max_delay
+        self.max_deferred = max_deferred
+        self.shed_depth = shed_depth
+        self.handler = TypeHandler(Update, self.check)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # idle bucket is full again after `burst / rate` seconds, so it is forgotten
+        self._buckets = TTLCache(
+            maxsize=1_000_000, ttl=max(burst / rate for rate, burst in budgets.values())
+        )
+        # deferred updates with their kind and update queue by chat
+        self._deferred: dict[Hashable, deque] = {}
+        # (due time, sequence, chat) of chats whose first deferred update is due
+        self._due: list[tuple[float, int, Hashable]] = []
+        self._sequence = itertools.count()
+        # ids of released updates, forgotten if update never comes back
+        self._released = TTLCache(maxsize=100_000, ttl=NOTICE_INTERVAL)
+        self._notified = TTLCache(maxsize=100_000, ttl=NOTICE_INTERVAL)
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self._counters = {'allowed': 0, 'deferred': 0, 'released': 0, 'dropped': 0, 'shed': 0}
+
+    def kind(self, update: Update) -> str:
+        """
+        :return: kind of update budget.
+        """
+        if update.effective_chat is not None and update.effective_chat.id in self.admin_chats:
+            return ADMIN
+        message = update.effective_message
+        text = (message.text or message.caption or '') if message is not None else ''
+        if text.startswith('/'):
+            command = (text[1:].split() or [''])[0].split('@')[0].lower()
+            if command in self.expensive_commands:
+                return EXPENSIVE
+        return CHEAP
+
+    def _bucket(self, key: Hashable, kind: str, now: float) -> TokenBucket:
+        """
+        :return: bucket of chat and update kind. Must be called under lock.
+        """
+        bucket = self._buckets.get((key, kind))
+        if bucket is None:
+            bucket = TokenBucket(*self.budgets[kind])
+            # full bucket must have no delay at `now`
+            bucket.updated = now
+        return bucket
+
+    def _take(self, key: Hashable, kind: str, bucket: TokenBucket, now: float) -> None:
+        """
+        Consume token of update. Must be called under lock.
+        """
+        bucket.take(now)
+        # reinsert to restart TTL, bucket expires only when it is full
+        self._buckets[(key, kind)] = bucket
+
+    def check(self, update: Update, context: CallbackContext) -> None:
+        """
+        Callback of handler. Returns if update is admitted.
+        :raise DispatcherHandlerStop if update is deferred or dropped,
+               so no other handler gets it.
+        """
+        kind = self.kind(update)
+        queue_depth = getattr(context.dispatcher, 'queue_depth', None)
+        overloaded = bool(
+            self.shed_depth and kind != ADMIN and queue_depth is not None
+            and queue_depth() > self.shed_depth
+        )
+        key = update_key(update)
+        with self._lock:
+            now = time.monotonic()
+            if self._released.pop(update.update_id, False):
+                return
+            if overloaded:
+                self._counters['shed'] += 1
+                raise DispatcherHandlerStop()
+
+            deferred = self._deferred.get(key)
+            if deferred is None:
+                bucket = self._bucket(key, kind, now)
+                delay = bucket.delay(now)
+                if not delay:
+                    self._take(key, kind, bucket, now)
+                    self._counters['allowed'] += 1
+                    return
+                if delay <= self.max_delay and self.max_deferred:
+                    self._defer(key, update, kind, context.dispatcher, now + delay)
+                    raise DispatcherHandlerStop()
+            elif len(deferred) < self.max_deferred:
+                deferred.append((update, kind, context.dispatcher.update_queue))
+                self._counters['deferred'] += 1
+                raise DispatcherHandlerStop()
+
+            self._counters['dropped'] += 1
+            notify = update.effective_chat is not None and key not in self._notified
+            if notify:
+                self._notified[key] = True
+        if notify:
+            outbox.send_message(context.bot, chat_id=update.effective_chat.id, text=FLOOD_TEXT)
+        raise DispatcherHandlerStop()
+
+    def _defer(self, key: Hashable, update: Update, kind: str, dispatcher: Dispatcher,
+               due: float) -> None:
+        """
+        Defer the first update of chat until due time. Must be called under lock.
+        """
+        self._deferred[key] = deque([(update, kind, dispatcher.update_queue)])
+        heapq.heappush(self._due, (due, next(self._sequence), key))
+        self._counters['deferred'] += 1
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='flood-control', daemon=True)
+            self._thread.start()
+        self._wakeup.notify()
+
+    def _run(self) -> None:
+        """
+        Put deferred updates to update queue again when they fit in budget.
+        Released update passes the check once without taking a token again.
+        """
+        with self._wakeup:
+            while not self._stopped:
+                now = time.monotonic()
+                if not self._due or self._due[0][0] > now:
+                    self._wakeup.wait(self._due[0][0] - now if self._due else None)
+                    continue
+                _, _, key = heapq.heappop(self._due)
+                deferred = self._deferred[key]
+                update, kind, update_queue = deferred[0]
+                bucket = self._bucket(key, kind, now)
+                delay = bucket.delay(now)
+                if delay:
+                    heapq.heappush(self._due, (now + delay, next(self._sequence), key))
+                    continue
+                self._take(key, kind, bucket, now)
+                deferred.popleft()
+                if deferred:
+                    heapq.heappush(self._due, (now, next(self._sequence), key))
+                else:
+                    del self._deferred[key]
+                self._released[update.update_id] = True
+                self._counters['released'] += 1
+                update_queue.put(update)
+
+    def stop(self) -> None:
+        """
+        Stop releasing deferred updates, they are dropped.
+        """
+        with self._wakeup:
+            self._stopped = True
+            dropped = sum(map(len, self._deferred.values()))
+            self._deferred.clear()
+            self._due.clear()
+            self._counters['dropped'] += dropped
+            self._wakeup.notify()
+        if dropped:
+            logger.warning('%s deferred updates dropped on stop', dropped)
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self) -> dict[str, Any]:
+        """
+        :return: limited chats, deferred updates and counters for monitoring.
+        """
+        with self._lock:
+            return {
+                'buckets': len(self._buckets),
+                'deferred_now': sum(map(len, self._deferred.values())),
+                **self._counters,
+            }
+
+
+flood_control = FloodControl(
+    {
+        CHEAP: (FLOOD_RATE, FLOOD_BURST),
+        EXPENSIVE: (FLOOD_EXPENSIVE_RATE, FLOOD_EXPENSIVE_BURST),
+        ADMIN: (FLOOD_ADMIN_RATE, FLOOD_ADMIN_BURST),
+    },
+    FLOOD_EXPENSIVE_COMMANDS, ADMIN_CHATS, FLOOD_MAX_DELAY, FLOOD_MAX_DEFERRED, FLOOD_SHED_DEPTH,
+)
@@ -1,25 +1,331 @@
 """
 Callback functions for commands and messages
 """
-from telegram.ext import CommandHandler, CallbackContext, Dispatcher
+from datetime import datetime, timedelta, timezone
+from tempfile import SpooledTemporaryFile
+from typing import Iterator, Optional
+
+from telegram.ext import CommandHandler, CallbackContext, Dispatcher, Filters, MessageHandler
 from telegram.update import Update
 
-from services import User, user_required
+from config.settings import SPOOL_MAX_SIZE
+from services import (User, Budget, BudgetError, LedgerCSV, LedgerEntry, LedgerError, RateError,
+                      Rates, ReportError, Rollup, user_required)
+from runtime.sender import outbox
+from .flood import flood_control
+from .pagination import Pager
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# telegram limits of files bots can upload and download
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024
+IMPORT_USAGE = 'Send CSV file with `/import` caption. ' \
+               'Columns: date,amount,currency,category,note'
 
 
 @user_required
-def start(user: User, update: Update, context: CallbackContext) -> None:
+async def start(user: User, update: Update, context: CallbackContext) -> None:
     """
     Handler for `/start` command
     """
     text = f'Hello, {user.first_name}. I am your accounting bot.'
-    context.bot.send_message(
-        chat_id=update.effective_chat.id, text=text
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=text
+    )
+
+
+@user_required
+def add_entry(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for text messages. Save expense or income.
+    Message example: `120.50 USD food lunch with team`
+    """
+    try:
+        entry = LedgerEntry.add_entry(
+            user.chat_id, update.message.text, update.message.date
+        )
+    except LedgerError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+        return
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=f'Saved {entry.ref_str()}: {entry}'
+    )
+
+
+@user_required
+def edit_entry(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for `/edit_entry` command.
+    Command example: `/edit_entry <id> [<YYYY-MM-DD>] amount=<amount> category=<category>
+    note=<note>`
+    """
+    try:
+        entry = LedgerEntry.update(user.chat_id, context.args)
+    except LedgerError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+        return
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=f'Updated {entry.ref_str()}: {entry}'
+    )
+
+
+@user_required
+def delete_entry(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for `/delete_entry` command.
+    Command example: `/delete_entry <id> [<YYYY-MM-DD>]`, date of entry
+    limits lookup to its partition.
+    """
+    try:
+        entry_id, period, _ = LedgerEntry.parse_entry_ref(context.args)
+        entry = LedgerEntry.delete(user.chat_id, entry_id, period)
+    except LedgerError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+        return
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=f'Deleted {entry.ref_str()}: {entry}'
+    )
+
+
+def _entry_cursor(entry: LedgerEntry) -> str:
+    """
+    :return: `<created_at in microseconds since epoch>_<id>` cursor of entry.
+    """
+    microseconds = (entry.created_at - EPOCH) // timedelta(microseconds=1)
+    return f'{microseconds}_{entry.id}'
+
+
+def _parse_entry_cursor(cursor: Optional[str]) -> tuple:
+    """
+    :return: `(created_at, id)` of entry cursor, empty for the first page.
+    """
+    if not cursor:
+        return ()
+    microseconds, entry_id = cursor.split('_')
+    return EPOCH + timedelta(microseconds=int(microseconds)), int(entry_id)
+
+
+def _fetch_entries(update: Update, context: CallbackContext, cursor: Optional[str],
+                   limit: int) -> Iterator[tuple[str, str]]:
+    """
+    Page of user entries from newest to oldest.
+    """
+    page = LedgerEntry.iter_entries(
+        update.effective_chat.id, after=_parse_entry_cursor(cursor), limit=limit
+    )
+    for entry in page:
+        yield entry.list_str(), _entry_cursor(entry)
+
+
+entries_pager = Pager('entries', _fetch_entries, empty_text='No entries yet')
+
+
+@user_required
+def entries(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for `/entries` command. Send user entries by pages, newest first.
+    """
+    try:
+        entries_pager.send(update, context)
+    except LedgerError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+
+
+def _fetch_found(update: Update, context: CallbackContext, cursor: Optional[str],
+                 limit: int) -> Iterator[tuple[str, str]]:
+    """
+    Page of user entries found by the last `/search` command of chat.
+    """
+    if 'search' not in context.chat_data:
+        return
+    words, since, until = context.chat_data['search']
+    page = LedgerEntry.search(
+        update.effective_chat.id, words, since, until,
+        after=_parse_entry_cursor(cursor), limit=limit,
+    )
+    for entry in page:
+        yield entry.list_str(), _entry_cursor(entry)
+
+
+search_pager = Pager('search', _fetch_found, empty_text='Nothing found')
+
+
+@user_required
+def search(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for `/search` command. Send user entries with notes or
+    categories matching words by pages, newest first.
+    Command example: `/search taxi`, `/search taxi airport 2021-07`,
+    `/search coffee 2021-07-01 2021-08`
+    """
+    try:
+        context.chat_data['search'] = LedgerEntry.parse_search(context.args)
+        search_pager.send(update, context)
+    except LedgerError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+
+
+@user_required
+def report(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for `/report` command. Send totals by category for day or month,
+    converted to one currency if it is given.
+    Command example: `/report`, `/report today`, `/report 2021-07`, `/report 2021-07-28`,
+    `/report 2021-07 EUR`
+    """
+    try:
+        args, currency = Rollup.parse_currency(context.args)
+        period, period_start, label = Rollup.parse_period(args)
+        rows = Rollup.get_report(user.chat_id, period, period_start, currency)
+    except ReportError as error:
+        outbox.send_message(
+            context.bot, chat_id=update.effective_chat.id, text=str(error)
+        )
+        return
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=Rollup.format_report(label, rows)
+    )
+
+
+@user_required
+def rates(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for `/rates` command. Send currency rates of day.
+    Command example: `/rates`, `/rates 2021-07-28`
+    """
+    try:
+        text = Rates.list_str(Rates.parse_day(context.args))
+    except RateError as error:
+        text = str(error)
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=text
+    )
+
+
+@user_required
+def budget(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for `/budget` command. Set monthly budget of category
+    or list budgets if called without arguments.
+    Command example: `/budget`, `/budget food 300`, `/budget food 300 EUR`
+    """
+    try:
+        if context.args:
+            text = f'Budget set. {Budget.set(user.chat_id, context.args)}'
+        else:
+            text = Budget.list_str(Budget.get_all(user.chat_id))
+    except BudgetError as error:
+        text = str(error)
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=text
+    )
+
+
+@user_required
+def delete_budget(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for `/delete_budget` command.
+    Command example: `/delete_budget food`, `/delete_budget food EUR`
+    """
+    try:
+        text = f'Budget deleted. {Budget.delete(user.chat_id, context.args)}'
+    except BudgetError as error:
+        text = str(error)
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=text
+    )
+
+
+@user_required
+def export_entries(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for `/export` command. Send all entries of user as CSV file.
+    """
+    file = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        rows = LedgerCSV.export(user.chat_id, file)
+    except LedgerError as error:
+        file.close()
+        outbox.send_message(context.bot, chat_id=update.effective_chat.id, text=str(error))
+        return
+
+    if not rows or file.tell() > MAX_UPLOAD_SIZE:
+        file.close()
+        text = 'No entries to export' if not rows else 'Ledger is too big to send as one file'
+        outbox.send_message(context.bot, chat_id=update.effective_chat.id, text=text)
+        return
+    file.seek(0)
+    sent = outbox.send_document(
+        context.bot, chat_id=update.effective_chat.id, document=file,
+        filename='ledger.csv', caption=f'{rows} entries',
+    )
+    sent.add_done_callback(lambda _: file.close())
+
+
+@user_required
+def import_entries(user: User, update: Update, context: CallbackContext) -> None:
+    """
+    Handler for `/import` command and CSV file with `/import` caption.
+    Add entries from file to ledger and reply with summary.
+    """
+    document = update.message.document if update.message else None
+    if document is None:
+        text = IMPORT_USAGE
+    elif document.file_size and document.file_size > MAX_DOWNLOAD_SIZE:
+        text = 'File is too big, split it into files up to 20 MB'
+    else:
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as file:
+            context.bot.get_file(document.file_id).download(out=file)
+            file.seek(0)
+            try:
+                text = LedgerCSV.summary_str(LedgerCSV.import_(user.chat_id, file))
+            except LedgerError as error:
+                text = str(error)
+
+    outbox.send_message(
+        context.bot, chat_id=update.effective_chat.id, text=text
     )
 
 
 def register_handlers(dispatcher: Dispatcher) -> None:
     """
-    Link handlers with corresponding commands
+    Link handlers with corresponding commands. Flood control runs
+    before them and before admin handlers.
     """
+    dispatcher.add_handler(flood_control.handler, group=-1)
     dispatcher.add_handler(CommandHandler(['start', 'help'], start))
+    dispatcher.add_handler(CommandHandler(['edit_entry'], edit_entry))
+    dispatcher.add_handler(CommandHandler(['delete_entry'], delete_entry))
+    dispatcher.add_handler(CommandHandler(['report'], report))
+    dispatcher.add_handler(CommandHandler(['rates'], rates))
+    dispatcher.add_handler(CommandHandler(['entries'], entries))
+    dispatcher.add_handler(CommandHandler(['search'], search))
+    dispatcher.add_handler(CommandHandler(['budget'], budget))
+    dispatcher.add_handler(CommandHandler(['delete_budget'], delete_budget))
+    dispatcher.add_handler(CommandHandler(['export'], export_entries))
+    dispatcher.add_handler(CommandHandler(['import'], import_entries))
+    dispatcher.add_handler(MessageHandler(
+        Filters.document & Filters.caption_regex(r'^/import\b'), import_entries
+    ))
+    dispatcher.add_handler(entries_pager.handler)
+    dispatcher.add_handler(search_pager.handler)
+    dispatcher.add_handler(MessageHandler(
+        Filters.update.message & Filters.text & ~Filters.command, add_entry
+    ))
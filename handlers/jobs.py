@@ -0,0 +1,66 @@
+"""
+Periodic jobs run by job queue
+"""
+import logging
+import time
+
+from telegram.ext import CallbackContext, JobQueue
+
+from config.settings import BUDGET_CHECK_INTERVAL, LEDGER_PARTITIONS_CHECK_INTERVAL
+from services import Budget, BudgetError, LedgerError, LedgerPartitions
+from runtime.metrics import JOB_LATENCY
+from runtime.sender import outbox
+
+logger = logging.getLogger(__name__)
+
+
+def check_budgets(context: CallbackContext) -> None:
+    """
+    Evaluate budgets of all users with one query and queue alerts.
+    Run time is logged and recorded to metrics.
+    """
+    started = time.perf_counter()
+    try:
+        alerts = Budget.check()
+    except BudgetError as error:
+        JOB_LATENCY.observe(time.perf_counter() - started, 'check_budgets', 'error')
+        logger.error('Budget check failed: %s', error)
+        return
+
+    for alert in alerts:
+        outbox.send_message(context.bot, chat_id=alert.chat_id, text=Budget.format_alert(alert))
+    elapsed = time.perf_counter() - started
+    JOB_LATENCY.observe(elapsed, 'check_budgets', 'ok')
+    logger.info('Budgets checked in %.3f seconds, %s alerts queued', elapsed, len(alerts))
+
+
+def create_partitions(context: CallbackContext) -> None:
+    """
+    Create ledger partitions of upcoming months, so inserts never
+    miss their partition.
+    """
+    started = time.perf_counter()
+    try:
+        created = LedgerPartitions.create_upcoming()
+    except LedgerError as error:
+        JOB_LATENCY.observe(time.perf_counter() - started, 'create_partitions', 'error')
+        logger.error('Creating ledger partitions failed: %s', error)
+        return
+
+    JOB_LATENCY.observe(time.perf_counter() - started, 'create_partitions', 'ok')
+    if created:
+        logger.info('Created %s ledger partitions', created)
+
+
+def register_jobs(job_queue: JobQueue) -> None:
+    """
+    Schedule periodic jobs
+    """
+    job_queue.run_repeating(
+        create_partitions, interval=LEDGER_PARTITIONS_CHECK_INTERVAL, first=0,
+        name='create_partitions',
+    )
+    job_queue.run_repeating(
+        check_budgets, interval=BUDGET_CHECK_INTERVAL, first=BUDGET_CHECK_INTERVAL,
+        name='check_budgets',
+    )
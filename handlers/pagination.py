@@ -0,0 +1,147 @@
+"""
+Sending long listings: rows are streamed into messages no longer than
+telegram limit, pages are navigated with inline "Next" button
+"""
+from contextlib import closing
+from typing import Callable, Iterator, Optional
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.ext import CallbackContext, CallbackQueryHandler
+from telegram.update import Update
+
+from config.settings import ADMIN_CHATS
+from runtime.sender import outbox
+from services import CategoryError, LedgerError, User, user_required
+
+
+class ChunkedMessage:
+    """
+    Collect lines and send them as soon as they fill a message. Messages
+    are queued at once, even inside `outbox.hold`, so rows are delivered
+    while they stream.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int,
+                 max_length: int = MAX_MESSAGE_LENGTH) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.max_length = max_length
+        self.sent = 0
+        self._lines: list[str] = []
+        self._length = 0
+
+    def add(self, line: str) -> None:
+        """
+        Add line to message. Send collected lines first if line does not fit.
+        Line longer than the limit is split.
+        """
+        while len(line) > self.max_length:
+            self.add(line[:self.max_length])
+            line = line[self.max_length:]
+        if self._length + len(line) + len(self._lines) > self.max_length:
+            self._send()
+        self._lines.append(line)
+        self._length += len(line)
+
+    def close(self, reply_markup: InlineKeyboardMarkup = None,
+              empty_text: str = 'Nothing found') -> None:
+        """
+        Send remaining lines, attaching reply markup to the last message.
+        :param empty_text: sent if no lines were added.
+        """
+        if not self._lines and not self.sent:
+            self._lines.append(empty_text)
+        if self._lines:
+            self._send(reply_markup)
+        elif reply_markup:
+            outbox.send_message(
+                self.bot, chat_id=self.chat_id, text='...', reply_markup=reply_markup
+            )
+
+    def _send(self, reply_markup: InlineKeyboardMarkup = None) -> None:
+        outbox.send_message(
+            self.bot, chat_id=self.chat_id, text='\n'.join(self._lines), reply_markup=reply_markup
+        )
+        outbox.flush()
+        self.sent += 1
+        self._lines = []
+        self._length = 0
+
+
+PageFetcher = Callable[[Update, CallbackContext, Optional[str], int], Iterator[tuple[str, str]]]
+
+
+class Pager:
+    """
+    Listing split into pages with keyset pagination. Cursor of the last
+    row is put into callback data of "Next" button, next page starts
+    right after it, so no rows are skipped with OFFSET.
+    """
+
+    def __init__(self, name: str, fetch: PageFetcher, page_size: int = 50,
+                 admin_only: bool = False, empty_text: str = 'Nothing found') -> None:
+        """
+        :param name: prefix of callback data, must be unique.
+        :param fetch: called with update, context, cursor of previous
+               page last row (None for the first page) and max number of rows.
+               Returns iterator over `(line, cursor)` pairs. Cursor is a short
+               string, callback data is limited to 64 bytes.
+        :param page_size: rows per page.
+        :param admin_only: ignore "Next" button from chats not in ADMIN_CHATS.
+        :param empty_text: text sent if there are no rows.
+        """
+        self.name = name
+        self.fetch = fetch
+        self.page_size = page_size
+        self.admin_only = admin_only
+        self.empty_text = empty_text
+
+    def send(self, update: Update, context: CallbackContext, cursor: str = None) -> None:
+        """
+        Stream one page to chat.
+        """
+        message = ChunkedMessage(context.bot, update.effective_chat.id)
+        last_cursor = None
+        has_next = False
+        with closing(self.fetch(update, context, cursor, self.page_size + 1)) as rows:
+            for number, (line, row_cursor) in enumerate(rows):
+                if number == self.page_size:
+                    has_next = True
+                    break
+                message.add(line)
+                last_cursor = row_cursor
+
+        reply_markup = None
+        if has_next:
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
+                'Next »', callback_data=f'{self.name}:{last_cursor}'
+            )]])
+        message.close(reply_markup, empty_text=self.empty_text)
+
+    def _next_page(self, user: User, update: Update, context: CallbackContext) -> None:
+        """
+        Callback of "Next" button.
+        """
+        query = update.callback_query
+        chat_id = update.effective_chat.id
+        outbox.answer_callback_query(context.bot, chat_id, query.id)
+        if self.admin_only and user.chat_id not in ADMIN_CHATS:
+            return
+        # fails with BadRequest if message is too old to edit, sender logs it
+        outbox.edit_message_reply_markup(
+            context.bot, chat_id, query.message.message_id, reply_markup=None
+        )
+        try:
+            self.send(update, context, query.data.split(':', 1)[1])
+        except (CategoryError, LedgerError, ValueError) as error:
+            # cursor of callback data is malformed
+            text = 'Page is not available.' if isinstance(error, ValueError) else str(error)
+            outbox.send_message(context.bot, chat_id=chat_id, text=text)
+
+    @property
+    def handler(self) -> CallbackQueryHandler:
+        """
+        :return: handler of "Next" button to add to dispatcher.
+        """
+        return CallbackQueryHandler(user_required(self._next_page), pattern=f'^{self.name}:')
@@ -0,0 +1,40 @@
+"""
+Script for ledger partitions management
+Usage: `python partitions.py [list | create | archive --before YYYY-MM [--dir DIR]]`
+"""
+import argparse
+from datetime import datetime
+from pathlib import Path
+
+from config.settings import LEDGER_ARCHIVE_DIR
+from services import LedgerPartitions
+
+
+def main() -> None:
+    """
+    List, create or archive partitions.
+    """
+    arg_parser = argparse.ArgumentParser()
+    commands = arg_parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='list attached partitions')
+    commands.add_parser('create', help='create partitions of upcoming months')
+    archive_parser = commands.add_parser('archive', help='archive old partitions')
+    archive_parser.add_argument('--before', required=True,
+                                type=lambda value: datetime.strptime(value, '%Y-%m').date(),
+                                help='first month to keep, YYYY-MM')
+    archive_parser.add_argument('--dir', type=Path, default=Path(LEDGER_ARCHIVE_DIR),
+                                help='directory for archive files')
+    args = arg_parser.parse_args()
+
+    if args.command == 'create':
+        print(f'Created {LedgerPartitions.create_upcoming()} partitions')
+    elif args.command == 'archive':
+        for partition in LedgerPartitions.archive(args.before, args.dir):
+            print(f'{partition.name}: {partition.entries} entries archived to {partition.path}')
+    else:
+        for partition in LedgerPartitions.get_all():
+            print(partition.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+"""Bot runtime: update ingestion and processing infrastructure"""
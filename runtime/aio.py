@@ -0,0 +1,63 @@
+"""
+Event loop of asyncio mode running in its own thread. Coroutines of
+async handlers and async db layer run on it, sync code waits for them.
+"""
+import asyncio
+import functools
+import threading
+from typing import Any, Awaitable, Callable, Optional
+
+from db.async_queries import close_async_pool
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_thread: Optional[threading.Thread] = None
+_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    :return: event loop running in daemon thread, started on first call.
+    """
+    global _loop, _thread  # pylint: disable=global-statement
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=_loop.run_forever, name='event-loop', daemon=True)
+            _thread.start()
+        return _loop
+
+
+def run(coroutine: Awaitable, timeout: float = None) -> Any:
+    """
+    Run coroutine on event loop and wait for its result.
+    Must not be called from event loop thread.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result(timeout)
+
+
+def blocking(function: Callable[..., Awaitable]) -> Callable:
+    """
+    :return: sync function running coroutine function on event loop
+             and returning its result, used to call async handlers
+             from worker threads of sync dispatcher.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs) -> Any:
+        return run(function(*args, **kwargs))
+    return wrapper
+
+
+def stop_loop(timeout: float = None) -> None:
+    """
+    Close async db pool and stop event loop.
+    """
+    global _loop, _thread  # pylint: disable=global-statement
+    with _lock:
+        loop, thread, _loop, _thread = _loop, _thread, None, None
+    if loop is None:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(close_async_pool(), loop).result(timeout)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
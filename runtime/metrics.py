@@ -0,0 +1,313 @@
+"""
+Latency histograms and counters exposed in prometheus text format
+"""
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    """
+    :return: prometheus label set like `{a="1",b="2"}`.
+    """
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """
+    Base class of metrics. Series are kept per tuple of label values.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def render(self) -> Iterator[str]:
+        """
+        :return: lines of prometheus text format.
+        """
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count.
+    """
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield f'{self.name}{_labels(self.labels, label_values)} {value}'
+
+
+class _Series:
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self, size: int) -> None:
+        self.buckets = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, seconds for latencies.
+    Observation costs a binary search and a few additions under lock.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        self._series: dict[tuple, _Series] = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = _Series(len(self.buckets) + 1)
+            series.buckets[index] += 1
+            series.sum += value
+            series.count += 1
+
+    @contextmanager
+    def time(self, *label_values) -> Iterator[None]:
+        """
+        Observe duration of `with` block.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def _snapshot(self) -> list[tuple[tuple, list[int], float, int]]:
+        with self._lock:
+            return [
+                (label_values, list(series.buckets), series.sum, series.count)
+                for label_values, series in self._series.items()
+            ]
+
+    def total(self) -> int:
+        """
+        :return: number of observations in all series.
+        """
+        with self._lock:
+            return sum(series.count for series in self._series.values())
+
+    def quantile(self, buckets: list[int], count: int, quantile: float) -> float:
+        """
+        Estimate quantile by linear interpolation inside bucket.
+        """
+        rank = quantile * count
+        seen = 0
+        low = 0.0
+        for bound, bucket in zip(self.buckets, buckets):
+            if bucket and seen + bucket >= rank:
+                return low + (bound - low) * (rank - seen) / bucket
+            seen += bucket
+            low = bound
+        return self.buckets[-1]
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        for label_values, buckets, total, count in self._snapshot():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, buckets):
+                cumulative += bucket
+                labels = _labels(self.labels, label_values, f'le="{bound}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _labels(self.labels, label_values, 'le="+Inf"')
+            yield f'{self.name}_bucket{labels} {count}'
+            yield f'{self.name}_sum{_labels(self.labels, label_values)} {total}'
+            yield f'{self.name}_count{_labels(self.labels, label_values)} {count}'
+
+    def summary(self) -> Iterator[str]:
+        """
+        :return: human readable lines with count, average and p95 per series.
+        """
+        for label_values, buckets, total, count in sorted(self._snapshot()):
+            if not count:
+                continue
+            yield '{} {}: n={} avg={:.1f}ms p95={:.1f}ms'.format(
+                self.name, '/'.join(map(str, label_values)), count,
+                total / count * 1000, self.quantile(buckets, count, 0.95) * 1000,
+            )
+
+
+class StatsGauge(Metric):
+    """
+    Gauges read on every scrape from function returning stats dict,
+    like `ConnectionPool.stats`. Every numeric key becomes a metric
+    `<name>_<key>`.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str,
+                 collect: Callable[[], dict]) -> None:
+        super().__init__(name, documentation)
+        self.collect = collect
+
+    def render(self) -> Iterator[str]:
+        try:
+            stats = self.collect()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Collecting %s failed', self.name)
+            return
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                yield f'# HELP {self.name}_{key} {self.documentation}'
+                yield f'# TYPE {self.name}_{key} gauge'
+                yield f'{self.name}_{key} {value}'
+
+
+class Registry:
+    """
+    Collection of metrics rendered together.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Add metric. Metric with the same name is replaced.
+        """
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """
+        :return: all metrics in prometheus text format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+    def summary(self) -> str:
+        """
+        :return: latency summary of all histograms for logging.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(
+            line for metric in metrics if isinstance(metric, Histogram)
+            for line in metric.summary()
+        )
+
+
+class MetricsHandler(RequestHandler):  # pylint: disable=abstract-method
+    """
+    Serve registry in prometheus text format.
+    """
+
+    def initialize(self, registry: Registry) -> None:  # pylint: disable=arguments-differ
+        self.registry = registry
+
+    def get(self) -> None:
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.registry.render())
+
+
+def start_http_server(port: int, listen: str = '127.0.0.1',
+                      metrics: Registry = None) -> threading.Thread:
+    """
+    Serve `/metrics` in daemon thread.
+    :param port: port to listen.
+    :param listen: address to listen.
+    :param metrics: registry to serve, module registry by default.
+    """
+    application = Application([('/metrics', MetricsHandler, {'registry': metrics or registry})])
+    ready = threading.Event()
+
+    def run() -> None:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        HTTPServer(application).listen(port, listen)
+        ready.set()
+        IOLoop.current().start()
+
+    thread = threading.Thread(target=run, name='metrics', daemon=True)
+    thread.start()
+    ready.wait()
+    logger.info('Serving metrics on %s:%s/metrics', listen, port)
+    return thread
+
+
+def start_log_summary(interval: float, metrics: Registry = None) -> threading.Thread:
+    """
+    Log latency summary every `interval` seconds in daemon thread.
+    """
+    metrics = metrics or registry
+
+    def run() -> None:
+        while True:
+            time.sleep(interval)
+            summary = metrics.summary()
+            if summary:
+                logger.info('Latency summary:\n%s', summary)
+
+    thread = threading.Thread(target=run, name='metrics-summary', daemon=True)
+    thread.start()
+    return thread
+
+
+registry = Registry()
+
+HANDLER_LATENCY: Histogram = registry.register(Histogram(
+    'bot_handler_seconds', 'Handler latency.', ('handler', 'status'),
+))
+UPDATE_WAIT: Histogram = registry.register(Histogram(
+    'bot_update_wait_seconds', 'Time update waited in chat queue.',
+))
+QUERY_LATENCY: Histogram = registry.register(Histogram(
+    'bot_db_query_seconds', 'Query latency by statement shape.', ('statement', 'status'),
+))
+POOL_CHECKOUT: Histogram = registry.register(Histogram(
+    'bot_db_pool_checkout_seconds', 'Time to check out db connection.',
+))
+JOB_LATENCY: Histogram = registry.register(Histogram(
+    'bot_job_seconds', 'Scheduled job run time.', ('job', 'status'),
+    buckets=DEFAULT_BUCKETS + (30.0, 60.0, 300.0),
+))
+SEND_LATENCY: Histogram = registry.register(Histogram(
+    'bot_send_seconds', 'Outbound telegram request latency.', ('result',),
+))
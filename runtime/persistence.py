@@ -0,0 +1,293 @@
+"""
+Persistence of user_data, chat_data, bot_data and conversation states
+in db. Data of a user or chat is loaded on first access, only changed
+data is written, in batches by a background thread.
+"""
+import json
+import logging
+import pickle
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional
+
+from telegram.ext import BasePersistence
+
+from config.settings import (PERSISTENCE_BATCH_SIZE, PERSISTENCE_FLUSH_INTERVAL,
+                             PERSISTENCE_IDLE_SECONDS)
+from db.exceptions import DBError
+from db.queries import DBManager, In
+
+logger = logging.getLogger(__name__)
+
+DATA_TABLE = 'persistence_data'
+CONVERSATION_TABLE = 'persistence_conversation'
+
+_BOT_ID = 0
+_EMPTY = pickle.dumps({}, pickle.HIGHEST_PROTOCOL)
+
+
+class LazyData(defaultdict):
+    """
+    Data of users or chats by id. Data of id is loaded on first access.
+    """
+
+    def __init__(self, load: Callable[[int], dict]) -> None:
+        super().__init__(dict)
+        self.load = load
+
+    def __missing__(self, key: int) -> dict:
+        return self.setdefault(key, self.load(key))
+
+
+class PostgresPersistence(BasePersistence):
+    """
+    Persistence storing pickled data of every user and chat in its own
+    row. Data passed by dispatcher after every update is pickled and
+    compared with the last written one, so unchanged data costs no
+    writes. Changed rows are upserted and emptied ones deleted every
+    `flush_interval` seconds in one transaction. Users and chats idle
+    for `idle_seconds` are dropped from memory.
+    Conversation states of every handler are loaded at start, there
+    are only states of conversations in progress.
+    In sharded mode chat_data stays in one process, but user_data of
+    users writing to several chats and bot_data are written by every
+    process, the last write wins.
+    """
+
+    def __init__(self, flush_interval: float = 1, idle_seconds: float = 600,
+                 batch_size: int = 500, store_user_data: bool = True,
+                 store_chat_data: bool = True, store_bot_data: bool = True) -> None:
+        """
+        :param flush_interval: seconds between writes of changed data.
+        :param idle_seconds: seconds after last update of user or chat
+               after which its data is dropped from memory.
+        :param batch_size: max number of rows in one upsert.
+        Other parameters are passed to BasePersistence.
+        """
+        super().__init__(store_user_data, store_chat_data, store_bot_data)
+        self.flush_interval = flush_interval
+        self.idle_seconds = idle_seconds
+        self.batch_size = batch_size
+        self.user_data: Optional[LazyData] = None
+        self.chat_data: Optional[LazyData] = None
+        self._lock = threading.Lock()
+        # pickled data written to db or waiting in `_dirty` by (kind, id)
+        self._known: dict[tuple[str, int], bytes] = {}
+        self._dirty: dict[tuple[str, int], bytes] = {}
+        # pickled states by (name, key), None for finished conversations
+        self._dirty_states: dict[tuple[str, str], Optional[bytes]] = {}
+        self._used: dict[tuple[str, int], float] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {'loaded': 0, 'written': 0, 'deleted': 0, 'evicted': 0, 'failed_flushes': 0}
+
+    def insert_bot(self, obj: object) -> object:
+        """
+        Data loaded lazily is returned as is, its rows get bot
+        inserted when they are loaded.
+        """
+        if isinstance(obj, LazyData):
+            return obj
+        return super().insert_bot(obj)
+
+    def _load(self, kind: str, id_: int) -> dict:
+        """
+        :raise DBError in case of db errors, so data is not overwritten
+               with empty one.
+        :return: data of user, chat or bot.
+        """
+        rows = DBManager(use_replicas=False, join_unit=False).select(
+            DATA_TABLE, ('data',), {'kind': kind, 'id': id_}
+        )
+        raw = bytes(rows[0][0]) if rows else _EMPTY
+        with self._lock:
+            self._known.setdefault((kind, id_), raw)
+            self._used[(kind, id_)] = time.monotonic()
+            self.stats['loaded'] += 1
+        return self.insert_bot(pickle.loads(raw))
+
+    def get_user_data(self) -> LazyData:
+        if self.user_data is None:
+            self.user_data = LazyData(lambda user_id: self._load('user', user_id))
+        return self.user_data
+
+    def get_chat_data(self) -> LazyData:
+        if self.chat_data is None:
+            self.chat_data = LazyData(lambda chat_id: self._load('chat', chat_id))
+        return self.chat_data
+
+    def get_bot_data(self) -> dict:
+        return self._load('bot', _BOT_ID)
+
+    def get_conversations(self, name: str) -> dict:
+        rows = DBManager(use_replicas=False, join_unit=False).select(
+            CONVERSATION_TABLE, ('key', 'state'), {'name': name}
+        )
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    def _touch(self, kind: str, id_: int) -> None:
+        with self._lock:
+            self._used[(kind, id_)] = time.monotonic()
+
+    def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self._touch('user', user_id)
+
+    def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        self._touch('chat', chat_id)
+
+    def _stage(self, kind: str, id_: int, data: dict) -> None:
+        """
+        Queue data to be written if it differs from the last written one.
+        """
+        raw = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        key = (kind, id_)
+        with self._lock:
+            self._used[key] = time.monotonic()
+            if self._known.get(key, _EMPTY) != raw:
+                self._known[key] = self._dirty[key] = raw
+        self.start()
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage('user', user_id, data)
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._stage('chat', chat_id, data)
+
+    def update_bot_data(self, data: dict) -> None:
+        self._stage('bot', _BOT_ID, data)
+
+    def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        state = None if new_state is None else pickle.dumps(new_state, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._dirty_states[(name, json.dumps(key))] = state
+        self.start()
+
+    def flush(self) -> None:
+        """
+        Write changed data and conversation states in one transaction.
+        Failed changes are written on next flush.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            states, self._dirty_states = self._dirty_states, {}
+        if not dirty and not states:
+            return
+        try:
+            self._write(dirty, states)
+        except DBError as error:
+            logger.warning('Writing persistence data failed: %s', error)
+            with self._lock:
+                self.stats['failed_flushes'] += 1
+                # changes staged meanwhile are newer
+                for key, raw in dirty.items():
+                    self._dirty.setdefault(key, raw)
+                for key, state in states.items():
+                    self._dirty_states.setdefault(key, state)
+
+    def _write(self, dirty: dict[tuple[str, int], bytes],
+               states: dict[tuple[str, str], Optional[bytes]]) -> None:
+        now = datetime.now(timezone.utc)
+        rows = [(kind, id_, raw, now) for (kind, id_), raw in dirty.items() if raw != _EMPTY]
+        emptied: dict[str, list[int]] = defaultdict(list)
+        for (kind, id_), raw in dirty.items():
+            if raw == _EMPTY:
+                emptied[kind].append(id_)
+        state_rows = [
+            (name, key, state, now) for (name, key), state in states.items() if state is not None
+        ]
+        finished: dict[str, list[str]] = defaultdict(list)
+        for (name, key), state in states.items():
+            if state is None:
+                finished[name].append(key)
+
+        with DBManager(use_replicas=False, join_unit=False).transaction() as db_manager:
+            for start in range(0, len(rows), self.batch_size):
+                db_manager.upsert_many(
+                    DATA_TABLE, ('kind', 'id', 'data', 'updated_at'), ('kind', 'id'),
+                    rows[start:start + self.batch_size],
+                )
+            for kind, ids in emptied.items():
+                db_manager.delete(DATA_TABLE, {'kind': kind, 'id': In(ids)})
+            for start in range(0, len(state_rows), self.batch_size):
+                db_manager.upsert_many(
+                    CONVERSATION_TABLE, ('name', 'key', 'state', 'updated_at'),
+                    ('name', 'key'), state_rows[start:start + self.batch_size],
+                )
+            for name, keys in finished.items():
+                db_manager.delete(CONVERSATION_TABLE, {'name': name, 'key': In(keys)})
+        with self._lock:
+            self.stats['written'] += len(rows) + len(state_rows)
+            self.stats['deleted'] += sum(map(len, emptied.values())) + sum(
+                map(len, finished.values())
+            )
+
+    def evict(self) -> int:
+        """
+        Drop data of users and chats idle for `idle_seconds` from memory,
+        their changes must be written already.
+        :return: number of dropped users and chats.
+        """
+        deadline = time.monotonic() - self.idle_seconds
+        tables: dict[str, Optional[LazyData]] = {'user': self.user_data, 'chat': self.chat_data}
+        with self._lock:
+            cold = [
+                key for key, used in self._used.items()
+                if used < deadline and key not in self._dirty and key[0] in tables
+            ]
+            for key in cold:
+                del self._used[key]
+                self._known.pop(key, None)
+                data = tables[key[0]]
+                if data is not None:
+                    data.pop(key[1], None)
+            self.stats['evicted'] += len(cold)
+        return len(cold)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.evict()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Persistence flush failed')
+
+    def start(self) -> None:
+        """
+        Start writer thread. Called automatically on first change.
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='persistence', daemon=True
+                )
+                self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop writer thread and write remaining changes.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def memory_stats(self) -> dict[str, Any]:
+        """
+        :return: cached and pending data and counters for monitoring.
+        """
+        with self._lock:
+            return {
+                'users': len(self.user_data or ()),
+                'chats': len(self.chat_data or ()),
+                'dirty': len(self._dirty) + len(self._dirty_states),
+                **self.stats,
+            }
+
+
+persistence = PostgresPersistence(
+    PERSISTENCE_FLUSH_INTERVAL, PERSISTENCE_IDLE_SECONDS, PERSISTENCE_BATCH_SIZE
+)
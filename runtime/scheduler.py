@@ -0,0 +1,419 @@
+"""
+Concurrent update processing with strict ordering within one chat
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from typing import Any, Callable, Hashable, Optional
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, DispatcherHandlerStop, Handler
+
+from .aio import blocking, get_loop
+from .metrics import UPDATE_WAIT
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ChatScheduler:
+    """
+    Pool of workers processing updates of different chats in parallel.
+    Updates of one chat are processed one at a time in arrival order:
+    chat is handed to a worker only when its previous update is done.
+    Chats take turns, so a busy chat does not starve others.
+    """
+
+    def __init__(self, process: Callable[[Any], None], workers: int = 8,
+                 max_chat_queue: int = 100) -> None:
+        """
+        :param process: called with every update in worker thread.
+        :param workers: number of worker threads.
+        :param max_chat_queue: max number of queued updates of one chat,
+               further updates of the chat are dropped.
+        """
+        self.process = process
+        self.workers = workers
+        self.max_chat_queue = max_chat_queue
+        self._lock = threading.Lock()
+        self._pending: dict[Hashable, deque] = {}
+        self._ready: Queue = Queue()
+        self._threads: list[threading.Thread] = []
+        self._queued = 0
+        self._busy = 0
+        self._counters = {
+            'processed': 0,
+            'dropped': 0,
+            'failed': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    def submit(self, key: Hashable, update: Any) -> bool:
+        """
+        Queue update of chat.
+        :param key: chat identifier.
+        :param update: update to process.
+        :return: False if update was dropped because chat queue is full.
+        """
+        with self._lock:
+            chat_queue = self._pending.get(key)
+            if chat_queue is None:
+                chat_queue = self._pending[key] = deque()
+                schedule = True
+            else:
+                schedule = False
+            if len(chat_queue) >= self.max_chat_queue:
+                self._counters['dropped'] += 1
+                return False
+            chat_queue.append((update, time.monotonic()))
+            self._queued += 1
+
+        # chat already in `_pending` is either waiting in `_ready`
+        # or being processed, its worker schedules it again when done
+        if schedule:
+            self._ready.put(key)
+        return True
+
+    def _work(self) -> None:
+        """
+        Worker loop: take ready chat, process its oldest update,
+        put chat back to the end of ready queue if it has more updates.
+        """
+        while True:
+            key = self._ready.get()
+            if key is _STOP:
+                return
+            with self._lock:
+                update, queued_at = self._pending[key].popleft()
+                self._queued -= 1
+                self._busy += 1
+                wait = time.monotonic() - queued_at
+                self._counters['wait_seconds_total'] += wait
+                self._counters['wait_seconds_max'] = max(self._counters['wait_seconds_max'], wait)
+            UPDATE_WAIT.observe(wait)
+
+            try:
+                self.process(update)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Update processing failed')
+                self._counters['failed'] += 1
+
+            with self._lock:
+                self._busy -= 1
+                self._counters['processed'] += 1
+                if self._pending[key]:
+                    reschedule = True
+                else:
+                    del self._pending[key]
+                    reschedule = False
+            if reschedule:
+                self._ready.put(key)
+
+    def start(self) -> None:
+        """
+        Start worker threads.
+        """
+        if self._threads:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f'chat-worker-{number}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Process already queued updates and stop workers.
+        :param timeout: max seconds to wait for queued updates.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.depth() and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.05)
+        for _ in self._threads:
+            self._ready.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def depth(self) -> int:
+        """
+        :return: number of queued and in-progress updates.
+        """
+        with self._lock:
+            return self._queued + self._busy
+
+    def stats(self) -> dict[str, Any]:
+        """
+        :return: queue state and counters for monitoring.
+        """
+        with self._lock:
+            processed = self._counters['processed']
+            return {
+                'workers': self.workers,
+                'busy': self._busy,
+                'queued': self._queued,
+                'chats': len(self._pending),
+                'wait_seconds_avg': (
+                    self._counters['wait_seconds_total'] / processed if processed else 0.0
+                ),
+                **self._counters,
+            }
+
+
+def update_key(update: Update) -> Hashable:
+    """
+    :return: key updates are ordered by: chat, or user for updates
+             without chat (inline queries), or update itself.
+    """
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return 'user', update.effective_user.id
+    return 'update', update.update_id
+
+
+class OrderedDispatcher(Dispatcher):
+    """
+    Dispatcher passing updates to ChatScheduler instead of
+    processing them in its own thread.
+    """
+
+    def __init__(self, bot: Bot, update_queue: Queue, chat_workers: int = 8,
+                 max_chat_queue: int = 100, on_start: Callable[[Update], None] = None,
+                 on_done: Callable[[Update], None] = None, **kwargs) -> None:
+        """
+        :param chat_workers: number of scheduler workers.
+        :param max_chat_queue: max number of queued updates of one chat.
+        :param on_start: called with every update before it is processed.
+        :param on_done: called with every update when it is processed or dropped.
+        Other parameters are passed to Dispatcher.
+        """
+        super().__init__(bot, update_queue, **kwargs)
+        self.on_start = on_start
+        self.on_done = on_done
+        self.scheduler = ChatScheduler(
+            self._process_now, workers=chat_workers, max_chat_queue=max_chat_queue
+        )
+
+    def add_handler(self, handler: Handler, group: int = 0) -> None:
+        """
+        Register handler. Coroutine callbacks run on event loop of
+        asyncio mode while worker thread waits for them.
+        """
+        if asyncio.iscoroutinefunction(getattr(handler, 'callback', None)):
+            handler.callback = blocking(handler.callback)
+        super().add_handler(handler, group)
+
+    def _process_now(self, update: Any) -> None:
+        if self.on_start is not None:
+            self.on_start(update)
+        try:
+            super().process_update(update)
+        finally:
+            if self.on_done is not None:
+                self.on_done(update)
+
+    def process_update(self, update: Any) -> None:
+        """
+        Queue telegram update to its chat. Errors and other objects put
+        to update queue are processed right away.
+        """
+        if not isinstance(update, Update):
+            super().process_update(update)
+            return
+        if not self.scheduler.submit(update_key(update), update):
+            logger.warning('Chat queue is full, update %s dropped', update.update_id)
+            if self.on_done is not None:
+                self.on_done(update)
+
+    def start(self, ready: Optional[threading.Event] = None) -> None:
+        self.scheduler.start()
+        super().start(ready)
+
+    def stop(self) -> None:
+        super().stop()
+        self.scheduler.stop(timeout=10)
+
+    def queue_depth(self) -> int:
+        """
+        :return: number of updates not processed yet.
+        """
+        return self.update_queue.qsize() + self.scheduler.depth()
+
+
+class AsyncDispatcher(Dispatcher):
+    """
+    Dispatcher of asyncio mode. Every update is processed as a task of
+    event loop, so updates waiting on I/O don't hold threads. Updates
+    of one chat are processed one at a time in arrival order, at most
+    `max_updates` updates are processed at once. Updates of chat with
+    `max_chat_queue` updates waiting or in progress are dropped. Coroutine callbacks
+    are awaited on the loop, sync callbacks run in worker threads, so
+    handlers can be migrated one by one.
+    """
+
+    def __init__(self, bot: Bot, update_queue: Queue, max_updates: int = 1000,
+                 sync_workers: int = 8, max_chat_queue: int = 100,
+                 on_start: Callable[[Update], None] = None,
+                 on_done: Callable[[Update], None] = None, **kwargs) -> None:
+        """
+        :param max_updates: max number of updates processed at once.
+        :param sync_workers: number of threads running sync callbacks.
+        :param max_chat_queue: max number of pending updates of one chat,
+               further updates of the chat are dropped.
+        :param on_start: called with every update before it is processed.
+        :param on_done: called with every update when it is processed or dropped.
+        Other parameters are passed to Dispatcher.
+        """
+        super().__init__(bot, update_queue, **kwargs)
+        self.on_start = on_start
+        self.on_done = on_done
+        self.max_updates = max_updates
+        self.max_chat_queue = max_chat_queue
+        self.loop = get_loop()
+        self._executor = ThreadPoolExecutor(sync_workers, thread_name_prefix='sync-handler')
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._chats: dict[Hashable, asyncio.Task] = {}
+        # number of pending updates by chat, changed only in event loop
+        self._chat_pending: dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._counters = {'processed': 0, 'failed': 0, 'dropped': 0}
+
+    def process_update(self, update: Any) -> None:
+        """
+        Start task processing telegram update. Errors and other objects
+        put to update queue are processed right away.
+        """
+        if not isinstance(update, Update):
+            super().process_update(update)
+            return
+        with self._lock:
+            self._in_flight += 1
+        self.loop.call_soon_threadsafe(self._spawn, update, time.monotonic())
+
+    def _spawn(self, update: Update, queued_at: float) -> None:
+        """
+        Create task of update chained after previous task of its chat.
+        Called in event loop.
+        """
+        key = update_key(update)
+        pending = self._chat_pending.get(key, 0)
+        if pending >= self.max_chat_queue:
+            logger.warning('Chat queue is full, update %s dropped', update.update_id)
+            self._counters['dropped'] += 1
+            with self._lock:
+                self._in_flight -= 1
+            if self.on_done is not None:
+                self.on_done(update)
+            return
+        self._chat_pending[key] = pending + 1
+        task = self.loop.create_task(self._run(update, queued_at, self._chats.get(key)))
+        self._chats[key] = task
+        task.add_done_callback(functools.partial(self._forget, key))
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._chats.get(key) is task:
+            del self._chats[key]
+        pending = self._chat_pending.pop(key) - 1
+        if pending:
+            self._chat_pending[key] = pending
+
+    async def _run(self, update: Update, queued_at: float,
+                   previous: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_updates)
+        try:
+            async with self._slots:
+                UPDATE_WAIT.observe(time.monotonic() - queued_at)
+                if self.on_start is not None:
+                    self.on_start(update)
+                await self.process_update_async(update)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Update processing failed')
+            self._counters['failed'] += 1
+        finally:
+            self._counters['processed'] += 1
+            with self._lock:
+                self._in_flight -= 1
+            if self.on_done is not None:
+                self.on_done(update)
+
+    async def process_update_async(self, update: Update) -> None:
+        """
+        Pass update to the first matching handler of every group,
+        like `Dispatcher.process_update` does.
+        """
+        context = None
+        handled = False
+        for group in self.groups:
+            try:
+                for handler in self.handlers[group]:
+                    check = handler.check_update(update)
+                    if check is None or check is False:
+                        continue
+                    if context is None:
+                        context = self.context_types.context.from_update(update, self)
+                        context.refresh_data()
+                    handled = True
+                    if asyncio.iscoroutinefunction(getattr(handler, 'callback', None)):
+                        handler.collect_additional_context(context, update, self, check)
+                        await handler.callback(update, context)
+                    else:
+                        await self.loop.run_in_executor(self._executor, functools.partial(
+                            handler.handle_update, update, self, check, context
+                        ))
+                    break
+            except DispatcherHandlerStop:
+                break
+            except Exception as exc:  # pylint: disable=broad-except
+                try:
+                    self.dispatch_error(update, exc)
+                except DispatcherHandlerStop:
+                    break
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('An uncaught error was raised while handling the error.')
+        if handled and self.persistence:
+            await self.loop.run_in_executor(
+                self._executor, functools.partial(self.update_persistence, update=update)
+            )
+
+    def stop(self, timeout: float = 10) -> None:
+        """
+        Stop taking updates and wait for started ones.
+        """
+        super().stop()
+        deadline = time.monotonic() + timeout
+        while self.queue_depth() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._executor.shutdown(wait=False)
+
+    def queue_depth(self) -> int:
+        """
+        :return: number of updates not processed yet.
+        """
+        with self._lock:
+            return self.update_queue.qsize() + self._in_flight
+
+    def stats(self) -> dict[str, Any]:
+        """
+        :return: processing state and counters for monitoring.
+        """
+        with self._lock:
+            in_flight = self._in_flight
+        return {
+            'max_updates': self.max_updates,
+            'in_flight': in_flight,
+            'chats': len(self._chats),
+            **self._counters,
+        }
@@ -0,0 +1,473 @@
+"""
+Outbound messages: handlers enqueue messages and return, sender threads
+deliver them within telegram rate limits
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Hashable, Iterator, Optional
+
+from cachetools import TTLCache
+from telegram import Bot
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from config.settings import (SENDER_CHAT_BURST, SENDER_CHAT_RATE, SENDER_GLOBAL_RATE,
+                             SENDER_MAX_RETRIES, SENDER_WORKERS)
+from .metrics import SEND_LATENCY
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+# messages of current update waiting for its end, see `Sender.hold`
+_held: ContextVar[Optional[list]] = ContextVar('held_messages', default=None)
+
+
+class TokenBucket:
+    """
+    Allows `capacity` sends at once and `rate` sends per second on average.
+    Not thread-safe, used under sender lock.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """
+        :return: seconds until a token is available, 0 if it is available now.
+        """
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def set_rate(self, rate: float, now: float) -> None:
+        """
+        Change rate, tokens gained so far are kept.
+        """
+        self._refill(now)
+        self.rate = rate
+
+    def take(self, now: float) -> None:
+        """
+        Consume a token, should be called only when `delay` is 0.
+        """
+        self._refill(now)
+        self.tokens -= 1
+
+
+class OutboundMessage:
+    """
+    Message waiting in sender queue. Text is None for messages other
+    than text ones, they are never joined and their kwargs are all
+    arguments of bot method.
+    """
+
+    __slots__ = ('bot', 'chat_id', 'method', 'text', 'kwargs', 'future', 'attempts')
+
+    def __init__(self, bot: Bot, chat_id: Hashable, method: str, text: Optional[str],
+                 kwargs: dict) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.method = method
+        self.text = text
+        self.kwargs = kwargs
+        self.future: Future = Future()
+        self.attempts = 0
+
+    def joins(self, other: 'OutboundMessage', length: int, max_length: int) -> bool:
+        """
+        :param other: last message of batch.
+        :param length: length of batch text.
+        :return: True if message can be appended to batch ending with `other`.
+        """
+        if self.text is None or other.text is None:
+            return False
+        if other.kwargs.get('reply_markup') is not None or self.bot is not other.bot:
+            return False
+        if length + len(self.text) + 2 > max_length:
+            return False
+        return _options(self.kwargs) == _options(other.kwargs)
+
+
+def _options(kwargs: dict) -> dict:
+    """
+    :return: send options which must match for messages to be joined.
+    """
+    return {key: value for key, value in kwargs.items() if key != 'reply_markup'}
+
+
+class Sender:
+    """
+    Queue of outbound messages delivered by a pool of sender threads.
+    Delivery respects global and per-chat token buckets, messages of one
+    chat are sent one at a time in order. Messages of one chat waiting in
+    the queue are joined into one message when they fit. RetryAfter from
+    telegram pauses the chat for the requested time and the message is
+    sent again.
+    """
+
+    def __init__(self, workers: int = 4, global_rate: float = 30.0,
+                 chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 max_retries: int = 3, max_length: int = MAX_MESSAGE_LENGTH) -> None:
+        """
+        :param workers: number of sender threads.
+        :param global_rate: max messages per second for all chats.
+        :param chat_rate: max messages per second for one chat.
+        :param chat_burst: messages one chat can receive at once.
+        :param max_retries: network errors and RetryAfter tolerated per message.
+        :param max_length: max length of joined message.
+        """
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_length = max_length
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._condition = threading.Condition()
+        # no burst for global limit: sends are spread evenly over a second
+        self._global_bucket = TokenBucket(global_rate, 1)
+        # idle bucket is full again after `chat_burst / chat_rate` seconds,
+        # so it can be dropped and recreated instead
+        self._chat_buckets = TTLCache(maxsize=1_000_000, ttl=chat_burst / chat_rate)
+        self._pending: dict[Hashable, deque] = {}
+        self._paused: dict[Hashable, float] = {}
+        self._busy: set = set()
+        self._schedule: list = []  # heap of (ready_at, sequence, chat_id)
+        self._sequence = itertools.count()
+        self._threads: list[threading.Thread] = []
+        self._queued = 0
+        self.stats = {
+            'sent': 0,
+            'coalesced': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'failed': 0,
+        }
+
+    def send_message(self, bot: Bot, chat_id: Hashable, text: str, **kwargs) -> Future:
+        """
+        Queue message and return immediately.
+        :param bot: bot to send with.
+        Other parameters are passed to `Bot.send_message`.
+        :return: future resolved with sent message, or failed with
+                 TelegramError if message could not be delivered.
+        """
+        return self._enqueue(OutboundMessage(bot, chat_id, 'send_message', text, kwargs))
+
+    def send_document(self, bot: Bot, chat_id: Hashable, document: Any, **kwargs) -> Future:
+        """
+        Queue document and return immediately. File is read when document
+        is sent, so it must stay open until the future is done.
+        :param bot: bot to send with.
+        :param document: file object or file id.
+        Other parameters are passed to `Bot.send_document`.
+        :return: future resolved with sent message, or failed with
+                 TelegramError if document could not be delivered.
+        """
+        return self._enqueue(OutboundMessage(
+            bot, chat_id, 'send_document', None, dict(kwargs, chat_id=chat_id, document=document)
+        ))
+
+    def answer_callback_query(self, bot: Bot, chat_id: Hashable, callback_query_id: str,
+                              **kwargs) -> Future:
+        """
+        Queue answer to callback query, it is sent in order with messages to chat.
+        :param bot: bot to send with.
+        :param chat_id: chat of message with pressed button.
+        Other parameters are passed to `Bot.answer_callback_query`.
+        :return: future resolved with True, or failed with TelegramError.
+        """
+        return self._enqueue(OutboundMessage(
+            bot, chat_id, 'answer_callback_query', None,
+            dict(kwargs, callback_query_id=callback_query_id),
+        ))
+
+    def edit_message_reply_markup(self, bot: Bot, chat_id: Hashable, message_id: int,
+                                  **kwargs) -> Future:
+        """
+        Queue change of message reply markup.
+        :param bot: bot to send with.
+        Other parameters are passed to `Bot.edit_message_reply_markup`.
+        :return: future resolved with edited message, or failed with
+                 TelegramError, e.g. BadRequest if message is too old to edit.
+        """
+        return self._enqueue(OutboundMessage(
+            bot, chat_id, 'edit_message_reply_markup', None,
+            dict(kwargs, chat_id=chat_id, message_id=message_id),
+        ))
+
+    @contextmanager
+    def hold(self) -> Iterator[None]:
+        """
+        Keep messages sent in `with` block until it ends. They are queued
+        if block succeeds and cancelled if it raises, so replies are not
+        delivered for work which was rolled back.
+        """
+        held: list[OutboundMessage] = []
+        token = _held.set(held)
+        try:
+            yield
+        except BaseException:
+            for message in held:
+                message.future.cancel()
+            raise
+        finally:
+            _held.reset(token)
+        for message in held:
+            self._queue(message)
+
+    def flush(self) -> None:
+        """
+        Queue messages held so far by current `hold` block, so output of
+        long handler is delivered while it runs. Flushed messages are not
+        cancelled if the block raises later.
+        """
+        held = _held.get()
+        if not held:
+            return
+        messages = list(held)
+        held.clear()
+        for message in messages:
+            self._queue(message)
+
+    def _enqueue(self, message: OutboundMessage) -> Future:
+        held = _held.get()
+        if held is not None:
+            held.append(message)
+            return message.future
+        return self._queue(message)
+
+    def _queue(self, message: OutboundMessage) -> Future:
+        if not self._threads:
+            self.start()
+        chat_id = message.chat_id
+        with self._condition:
+            chat_queue = self._pending.get(chat_id)
+            if chat_queue is None:
+                chat_queue = self._pending[chat_id] = deque()
+            chat_queue.append(message)
+            self._queued += 1
+            if len(chat_queue) == 1 and chat_id not in self._busy:
+                self._push(chat_id, time.monotonic())
+        return message.future
+
+    def _chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _push(self, chat_id: Hashable, now: float) -> None:
+        """
+        Schedule chat with pending messages. Called under lock.
+        """
+        ready_at = max(
+            now + self._chat_bucket(chat_id).delay(now),
+            self._paused.get(chat_id, 0.0),
+        )
+        heapq.heappush(self._schedule, (ready_at, next(self._sequence), chat_id))
+        self._condition.notify()
+
+    def _next_batch(self) -> Optional[list[OutboundMessage]]:
+        """
+        Wait for chat allowed to receive message, take its oldest message
+        joined with following ones. Called under lock.
+        :return: messages to send as one, None to stop.
+        """
+        while True:
+            now = time.monotonic()
+            if self._schedule and self._schedule[0][2] is _STOP:
+                return None
+            if not self._schedule or self._schedule[0][0] > now:
+                self._condition.wait(self._schedule[0][0] - now if self._schedule else None)
+                continue
+            delay = self._global_bucket.delay(now)
+            if delay:
+                self._condition.wait(delay)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._schedule)
+            self._global_bucket.take(now)
+            bucket = self._chat_bucket(chat_id)
+            bucket.take(now)
+            # reinsert to restart TTL, bucket expires only when it is full
+            self._chat_buckets[chat_id] = bucket
+            self._paused.pop(chat_id, None)
+            self._busy.add(chat_id)
+
+            chat_queue = self._pending[chat_id]
+            batch = [chat_queue.popleft()]
+            length = len(batch[0].text or '')
+            while chat_queue and chat_queue[0].joins(batch[-1], length, self.max_length):
+                batch.append(chat_queue.popleft())
+                length += len(batch[-1].text) + 2
+            self._queued -= len(batch)
+            return batch
+
+    def _deliver(self, batch: list[OutboundMessage]) -> None:
+        """
+        Send batch as one message and resolve its futures.
+        Failed batch is put back to the front of chat queue if it can be retried.
+        """
+        first, last = batch[0], batch[-1]
+        chat_id = first.chat_id
+        if first.text is None:
+            kwargs = first.kwargs
+            # file is read again when sending is retried
+            if hasattr(kwargs.get('document'), 'seek'):
+                kwargs['document'].seek(0)
+        else:
+            kwargs = dict(
+                first.kwargs, chat_id=chat_id, text='\n\n'.join(message.text for message in batch),
+                reply_markup=last.kwargs.get('reply_markup'),
+            )
+        retry_at = None
+        started = time.perf_counter()
+        try:
+            result = getattr(first.bot, first.method)(**kwargs)
+        except RetryAfter as error:
+            SEND_LATENCY.observe(time.perf_counter() - started, 'rate_limited')
+            with self._condition:
+                self.stats['rate_limited'] += 1
+            retry_at = time.monotonic() + error.retry_after
+            failure = error
+        except BadRequest as error:
+            SEND_LATENCY.observe(time.perf_counter() - started, 'error')
+            failure = error
+        except NetworkError as error:
+            SEND_LATENCY.observe(time.perf_counter() - started, 'network_error')
+            retry_at = time.monotonic() + 2 ** first.attempts
+            failure = error
+        except TelegramError as error:
+            SEND_LATENCY.observe(time.perf_counter() - started, 'error')
+            failure = error
+        else:
+            SEND_LATENCY.observe(time.perf_counter() - started, 'ok')
+            with self._condition:
+                self.stats['sent'] += 1
+                self.stats['coalesced'] += len(batch) - 1
+            for message in batch:
+                message.future.set_result(result)
+            return
+
+        first.attempts += 1
+        if retry_at is not None and first.attempts <= self.max_retries:
+            logger.warning('Sending to %s failed, retrying: %s', chat_id, failure)
+            with self._condition:
+                self.stats['retries'] += 1
+                self._pending[chat_id].extendleft(reversed(batch))
+                self._queued += len(batch)
+                self._paused[chat_id] = retry_at
+            return
+
+        logger.error('Sending to %s failed: %s', chat_id, failure)
+        with self._condition:
+            self.stats['failed'] += len(batch)
+        for message in batch:
+            message.future.set_exception(failure)
+
+    def _run(self) -> None:
+        """
+        Sender thread loop.
+        """
+        while True:
+            with self._condition:
+                batch = self._next_batch()
+            if batch is None:
+                return
+            chat_id = batch[0].chat_id
+            try:
+                self._deliver(batch)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception('Sending to %s failed', chat_id)
+                for message in batch:
+                    if not message.future.done():
+                        message.future.set_exception(error)
+            with self._condition:
+                self._busy.discard(chat_id)
+                if self._pending[chat_id]:
+                    self._push(chat_id, time.monotonic())
+                else:
+                    del self._pending[chat_id]
+
+    def start(self) -> None:
+        """
+        Start sender threads. Called automatically on first message.
+        """
+        with self._condition:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f'sender-{number}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Deliver queued messages and stop sender threads.
+        :param timeout: max seconds to wait for queued messages.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.depth() and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.05)
+        with self._condition:
+            # stop marker is ordered before any chat in the heap
+            for _ in self._threads:
+                heapq.heappush(self._schedule, (float('-inf'), -1, _STOP))
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        with self._condition:
+            self._threads = []
+            self._schedule = [item for item in self._schedule if item[2] is not _STOP]
+            heapq.heapify(self._schedule)
+
+    def set_global_rate(self, rate: float) -> None:
+        """
+        Change max messages per second for all chats, e.g. when limit is
+        shared by more processes.
+        """
+        with self._condition:
+            self._global_bucket.set_rate(rate, time.monotonic())
+            self._condition.notify_all()
+
+    def depth(self) -> int:
+        """
+        :return: number of queued and in-flight messages.
+        """
+        with self._condition:
+            return self._queued + len(self._busy)
+
+    def queue_stats(self) -> dict[str, Any]:
+        """
+        :return: queue state and counters for monitoring.
+        """
+        with self._condition:
+            return {
+                'queued': self._queued,
+                'busy_chats': len(self._busy),
+                'pending_chats': len(self._pending),
+                **self.stats,
+            }
+
+
+outbox = Sender(
+    workers=SENDER_WORKERS,
+    global_rate=SENDER_GLOBAL_RATE,
+    chat_rate=SENDER_CHAT_RATE,
+    chat_burst=SENDER_CHAT_BURST,
+    max_retries=SENDER_MAX_RETRIES,
+)
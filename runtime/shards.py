@@ -0,0 +1,518 @@
+"""
+Sharded mode: front process receives updates and routes them by chat
+to worker processes. Every worker runs its own dispatcher, caches and
+db pools, so chats of different workers don't share one interpreter.
+"""
+import functools
+import hashlib
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from bisect import bisect
+from collections import Counter, OrderedDict, deque
+from multiprocessing.connection import Connection
+from queue import Queue
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, Updater
+
+from .scheduler import update_key
+
+logger = logging.getLogger(__name__)
+
+_STOP = b''
+# prefix of message telling worker how many workers run, see `serve_shard`
+_WORKERS = b'workers:'
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring of shards. Every shard owns `replicas` points of
+    the ring, key belongs to shard of the first point after key hash.
+    Adding or removing a shard moves only keys of its points, about
+    1/N of all keys. Hash does not depend on process, unlike `hash()`.
+    """
+
+    def __init__(self, shards: Iterable[int], replicas: int = 100) -> None:
+        points = sorted(
+            (_hash(f'{shard}:{replica}'), shard)
+            for shard in shards for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard(self, key: Hashable) -> int:
+        """
+        :return: shard of key.
+        """
+        index = bisect(self._hashes, _hash(repr(key))) % len(self._hashes)
+        return self._shards[index]
+
+
+def _worker_main(target: Callable[[int, Connection], None], index: int,
+                 connection: Connection) -> None:
+    # front process decides when workers stop, Ctrl+C reaches whole group
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_IGN)
+    target(index, connection)
+
+
+class ShardWorker:
+    """
+    Worker process of one shard as seen from front process. Updates sent
+    to worker stay pending until worker reports them done. Crashed worker
+    is restarted and gets its pending updates again, so update may be
+    processed twice. Update is dropped after `max_attempts` crashes
+    while it was processed.
+    """
+
+    def __init__(self, index: int, target: Callable[[int, Connection], None],
+                 restart_delay: float = 1, max_attempts: int = 3, workers: int = 1) -> None:
+        """
+        :param index: shard number passed to target.
+        :param target: function run in worker process with shard number and
+               connection to front process, see `serve_shard`. Must be
+               importable, worker processes are spawned.
+        :param restart_delay: seconds before restart, doubled on every
+               crash in a row.
+        :param max_attempts: number of crashes after which pending update
+               is dropped.
+        :param workers: number of running workers, see `set_workers`.
+        """
+        self.index = index
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_attempts = max_attempts
+        self.retiring = False
+        self.stopped = threading.Event()
+        self._context = multiprocessing.get_context('spawn')
+        self._condition = threading.Condition()
+        # update_id: [key, payload, attempts, started]
+        self._pending: OrderedDict[int, list] = OrderedDict()
+        self._unsent: deque = deque()
+        self._keys: Counter = Counter()
+        self._stopping = False
+        self._killed = False
+        self.workers = workers
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.connection: Optional[Connection] = None
+        self._counters = {'sent': 0, 'done': 0, 'restarts': 0, 'dropped': 0}
+
+    def start(self) -> None:
+        """
+        Start worker process and threads exchanging updates with it.
+        """
+        self._spawn()
+        for name, target in (('send', self._send), ('supervise', self._supervise)):
+            threading.Thread(
+                target=target, name=f'shard-{self.index}-{name}', daemon=True
+            ).start()
+
+    def _spawn(self) -> None:
+        connection, child_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, args=(self.target, self.index, child_connection),
+            name=f'shard-{self.index}', daemon=True,
+        )
+        process.start()
+        # worker end is closed here, so front gets EOF when worker exits
+        child_connection.close()
+        with self._condition:
+            self.process, self.connection = process, connection
+            self._unsent = deque([self._workers_payload(), *self._pending])
+            if self._stopping:
+                self._unsent.append(_STOP)
+            self._condition.notify_all()
+        logger.info('Shard %s worker started, pid %s', self.index, process.pid)
+
+    def _workers_payload(self) -> bytes:
+        return _WORKERS + str(self.workers).encode()
+
+    def set_workers(self, workers: int) -> None:
+        """
+        Tell worker process how many workers run, they share telegram limits.
+        """
+        with self._condition:
+            if workers == self.workers:
+                return
+            self.workers = workers
+            self._unsent.append(self._workers_payload())
+            self._condition.notify_all()
+
+    def submit(self, update: Update, key: Hashable) -> None:
+        """
+        Queue update to be sent to worker.
+        """
+        with self._condition:
+            self._pending[update.update_id] = [key, update.to_json().encode(), 0, False]
+            self._keys[key] += 1
+            self._unsent.append(update.update_id)
+            self._condition.notify_all()
+
+    def holds(self, key: Hashable) -> bool:
+        """
+        :return: True if worker has pending updates of key.
+        """
+        with self._condition:
+            return key in self._keys
+
+    def depth(self) -> int:
+        """
+        :return: number of updates not reported done yet.
+        """
+        with self._condition:
+            return len(self._pending)
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """
+        Wait until worker has no pending updates.
+        :return: True if worker is idle.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending, timeout)
+
+    def _forget(self, update_id: int) -> None:
+        key = self._pending.pop(update_id)[0]
+        self._keys[key] -= 1
+        if not self._keys[key]:
+            del self._keys[key]
+
+    def _send(self) -> None:
+        """
+        Sender loop: send queued updates to current worker process.
+        Updates sent to crashed worker are queued again on restart.
+        """
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._unsent or self.stopped.is_set())
+                if self.stopped.is_set():
+                    return
+                item = self._unsent.popleft()
+                if isinstance(item, int) and item not in self._pending:
+                    continue
+                payload = item if isinstance(item, bytes) else self._pending[item][1]
+                connection = self.connection
+            try:
+                connection.send_bytes(payload)
+            except (OSError, ValueError):
+                pass
+            else:
+                if isinstance(item, int):
+                    self._counters['sent'] += 1
+
+    def _receive(self, connection: Connection) -> None:
+        """
+        Track updates reported by worker started or done until worker exits.
+        """
+        while True:
+            try:
+                done, update_id = connection.recv()
+            except (EOFError, OSError):
+                return
+            with self._condition:
+                if update_id not in self._pending:
+                    continue
+                if done:
+                    self._forget(update_id)
+                    self._counters['done'] += 1
+                    self._condition.notify_all()
+                else:
+                    self._pending[update_id][3] = True
+
+    def _supervise(self) -> None:
+        """
+        Supervisor loop: restart worker process until it is stopped.
+        Worker crashed while stopping is restarted to process its
+        pending updates.
+        """
+        crashes = 0
+        while True:
+            process, connection = self.process, self.connection
+            started = time.monotonic()
+            self._receive(connection)
+            process.join()
+            connection.close()
+            with self._condition:
+                if self._killed or self._stopping and (
+                        not process.exitcode or not self._pending):
+                    break
+                crashes = crashes + 1 if time.monotonic() - started < 60 else 1
+                self._counters['restarts'] += 1
+                for update_id, entry in list(self._pending.items()):
+                    if not entry[3]:
+                        continue
+                    entry[2], entry[3] = entry[2] + 1, False
+                    if entry[2] >= self.max_attempts:
+                        logger.warning('Update %s dropped after %s crashes of shard %s',
+                                       update_id, entry[2], self.index)
+                        self._forget(update_id)
+                        self._counters['dropped'] += 1
+                self._condition.notify_all()
+            logger.error('Shard %s worker exited with code %s, %s pending updates',
+                         self.index, process.exitcode, self.depth())
+            time.sleep(min(self.restart_delay * 2 ** (crashes - 1), 60))
+            if self._killed or self._stopping and not self.depth():
+                break
+            self._spawn()
+        lost = self.depth()
+        if lost:
+            logger.warning('Shard %s stopped with %s unprocessed updates', self.index, lost)
+        with self._condition:
+            self.stopped.set()
+            self._condition.notify_all()
+
+    def stop(self) -> None:
+        """
+        Ask worker to process updates it received and exit.
+        Updates queued after this call are not sent.
+        """
+        with self._condition:
+            self._stopping = True
+            self._unsent.append(_STOP)
+            self._condition.notify_all()
+
+    def join(self, timeout: float = None) -> None:
+        """
+        Wait for stopped worker to exit, kill it after timeout.
+        """
+        if not self.stopped.wait(timeout):
+            logger.error('Shard %s worker did not stop in time, killing it', self.index)
+            with self._condition:
+                self._killed = True
+                process = self.process
+            process.kill()
+            self.stopped.wait()
+
+    def stats(self) -> dict[str, Any]:
+        """
+        :return: worker state and counters for monitoring.
+        """
+        with self._condition:
+            return {
+                'pending': len(self._pending),
+                'unsent': len(self._unsent),
+                'alive': int(self.process is not None and self.process.is_alive()),
+                **self._counters,
+            }
+
+
+class ShardedDispatcher(Dispatcher):
+    """
+    Dispatcher of front process. It doesn't process updates, every update
+    is sent to worker process of its shard chosen by consistent hash of
+    its chat, see `update_key`. So chat is always processed by one worker
+    and its updates are processed in order. While chat has pending updates
+    in a worker, its new updates go to the same worker even if the ring
+    changed, chats move to their new shard only when idle.
+    """
+
+    def __init__(self, bot: Bot, update_queue: Queue, shards: int,
+                 target: Callable[[int, Connection], None], restart_delay: float = 1,
+                 max_attempts: int = 3, drain_timeout: float = 30, **kwargs) -> None:
+        """
+        :param shards: number of worker processes.
+        :param target: function run in worker processes, see `ShardWorker`.
+        :param restart_delay: seconds before restarting crashed worker.
+        :param max_attempts: number of crashes after which update is dropped.
+        :param drain_timeout: max seconds stopped worker processes its updates.
+        Other parameters are passed to Dispatcher.
+        """
+        super().__init__(bot, update_queue, **kwargs)
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_attempts = max_attempts
+        self.drain_timeout = drain_timeout
+        self.shards = shards
+        self.ring = HashRing(range(shards))
+        self.shard_workers: dict[int, ShardWorker] = {}
+        self._lock = threading.Lock()
+        self._counters = {'routed': 0, 'held': 0}
+
+    def _worker(self, index: int, workers: int) -> ShardWorker:
+        worker = ShardWorker(index, self.target, self.restart_delay, self.max_attempts, workers)
+        worker.start()
+        return worker
+
+    def _share_limits(self) -> None:
+        """
+        Tell workers how many of them run, called under lock.
+        """
+        for worker in self.shard_workers.values():
+            worker.set_workers(len(self.shard_workers))
+
+    def start(self, ready: Optional[threading.Event] = None) -> None:
+        with self._lock:
+            workers = len(self.shard_workers.keys() | range(self.shards))
+            for index in range(self.shards):
+                if index not in self.shard_workers:
+                    self.shard_workers[index] = self._worker(index, workers)
+            self._share_limits()
+        super().start(ready)
+
+    def process_update(self, update: Any) -> None:
+        """
+        Send telegram update to worker of its shard. Errors and other
+        objects put to update queue are processed right away.
+        """
+        if not isinstance(update, Update):
+            super().process_update(update)
+            return
+        key = update_key(update)
+        with self._lock:
+            index = self.ring.shard(key)
+            for worker in self.shard_workers.values():
+                if worker.index != index and worker.holds(key):
+                    # chat moves to its new shard after its pending updates
+                    index = worker.index
+                    self._counters['held'] += 1
+                    break
+            self.shard_workers[index].submit(update, key)
+            self._counters['routed'] += 1
+
+    def resize(self, shards: int) -> None:
+        """
+        Change number of worker processes. New workers are started right
+        away. Removed workers get no new chats, they are stopped when
+        their pending updates are processed. Workers share telegram limits
+        equally, shares change when workers are started or stopped.
+        """
+        if shards < 1:
+            raise ValueError('At least one shard is required')
+        with self._lock:
+            logger.info('Resizing shards from %s to %s', self.shards, shards)
+            self.shards = shards
+            self.ring = HashRing(range(shards))
+            for index, worker in self.shard_workers.items():
+                worker.retiring = index >= shards
+            workers = len(self.shard_workers.keys() | range(shards))
+            for index in range(shards):
+                if index not in self.shard_workers:
+                    self.shard_workers[index] = self._worker(index, workers)
+            self._share_limits()
+            retiring = [worker for worker in self.shard_workers.values() if worker.retiring]
+        for worker in retiring:
+            threading.Thread(
+                target=self._retire, args=(worker,), name=f'shard-{worker.index}-retire',
+                daemon=True,
+            ).start()
+
+    def _retire(self, worker: ShardWorker) -> None:
+        while True:
+            worker.wait_idle()
+            with self._lock:
+                if not worker.retiring or self.shard_workers.get(worker.index) is not worker:
+                    return
+                # new updates are routed under the lock, so idle worker stays idle
+                if not worker.depth():
+                    del self.shard_workers[worker.index]
+                    self._share_limits()
+                    break
+        worker.stop()
+        worker.join(self.drain_timeout)
+
+    def stop(self) -> None:
+        """
+        Route updates left in update queue, then stop all workers after
+        they process updates they received.
+        """
+        deadline = time.monotonic() + self.drain_timeout
+        while self.update_queue.qsize() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        super().stop()
+        with self._lock:
+            workers = list(self.shard_workers.values())
+            self.shard_workers = {}
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join(max(deadline - time.monotonic(), 0) + self.drain_timeout)
+
+    def queue_depth(self) -> int:
+        """
+        :return: number of updates not processed yet.
+        """
+        with self._lock:
+            workers = list(self.shard_workers.values())
+        return self.update_queue.qsize() + sum(worker.depth() for worker in workers)
+
+    def stats(self) -> dict[str, Any]:
+        """
+        :return: routing state and counters for monitoring, totals of
+                 all workers and per worker ones prefixed by shard.
+        """
+        with self._lock:
+            workers = list(self.shard_workers.values())
+            stats = {'shards': self.shards, 'workers': len(workers), **self._counters}
+        for worker in workers:
+            for key, value in worker.stats().items():
+                stats[f'shard_{worker.index}_{key}'] = value
+                if key != 'alive':
+                    stats[key] = stats.get(key, 0) + value
+        return stats
+
+
+def serve_shard(connection: Connection, updater: Updater, drain_timeout: float = 30,
+                on_workers: Callable[[int], None] = None) -> None:
+    """
+    Worker loop of sharded mode: process updates received from front
+    process and report them started and done. Returns when front process asks to
+    stop or exits and received updates are processed.
+    :param connection: connection to front process.
+    :param updater: updater with registered handlers, its polling is not used.
+    :param drain_timeout: max seconds to process received updates on stop.
+    :param on_workers: called with number of running workers when it changes.
+    """
+    dispatcher = updater.dispatcher
+    lock = threading.Lock()
+
+    def report(done: bool, update: Update) -> None:
+        with lock:
+            try:
+                connection.send((done, update.update_id))
+            except (OSError, ValueError):
+                pass
+
+    dispatcher.on_start = functools.partial(report, False)
+    dispatcher.on_done = functools.partial(report, True)
+    ready = threading.Event()
+    thread = threading.Thread(
+        target=dispatcher.start, kwargs={'ready': ready}, name='dispatcher', daemon=True
+    )
+    thread.start()
+    while not ready.wait(1):
+        if not thread.is_alive():
+            raise RuntimeError('Dispatcher failed to start')
+    if updater.job_queue:
+        updater.job_queue.start()
+
+    while True:
+        try:
+            payload = connection.recv_bytes()
+        except (EOFError, OSError):
+            logger.warning('Front process is gone, stopping')
+            break
+        if payload == _STOP:
+            break
+        if payload.startswith(_WORKERS):
+            if on_workers:
+                on_workers(int(payload[len(_WORKERS):]))
+            continue
+        dispatcher.update_queue.put(Update.de_json(json.loads(payload), updater.bot))
+
+    if updater.job_queue:
+        updater.job_queue.stop()
+    deadline = time.monotonic() + drain_timeout
+    while dispatcher.queue_depth() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    dispatcher.stop()
+    thread.join()
+    with lock:
+        connection.close()
@@ -0,0 +1,188 @@
+"""
+Webhook mode: receive updates from telegram over HTTP
+and pass them to dispatcher without long polling
+"""
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import ssl
+import threading
+from queue import Queue
+from typing import Callable, Optional
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookHandler(RequestHandler):  # pylint: disable=abstract-method
+    """
+    Accept update sent by telegram, put it to the dispatcher queue
+    and acknowledge it right away. Update is processed later by
+    dispatcher workers.
+    """
+
+    def initialize(self, bot: Bot, update_queue: Queue,  # pylint: disable=arguments-differ
+                   secret_token: Optional[str], max_queue_size: int,
+                   queue_depth: Callable[[], int]) -> None:
+        self.bot = bot
+        self.update_queue = update_queue
+        self.queue_depth = queue_depth
+        self.secret_token = secret_token
+        self.max_queue_size = max_queue_size
+
+    def post(self) -> None:
+        """
+        Respond with:
+        403 if secret token is missing or wrong,
+        400 if body is not valid update,
+        503 if dispatcher queue is full, telegram retries delivery later,
+        200 if update is queued.
+        """
+        if self.secret_token and not hmac.compare_digest(
+                self.request.headers.get(SECRET_TOKEN_HEADER, ''), self.secret_token):
+            self.set_status(403)
+            return
+
+        if self.queue_depth() >= self.max_queue_size:
+            self.set_status(503)
+            self.set_header('Retry-After', '1')
+            return
+
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot)
+        except (ValueError, TypeError, KeyError) as error:
+            logger.warning('Invalid update received: %s', error)
+            self.set_status(400)
+            return
+
+        self.update_queue.put(update)
+        self.set_status(200)
+
+
+class WebhookServer:
+    """
+    HTTP(S) server receiving telegram updates.
+    """
+
+    def __init__(self, bot: Bot, update_queue: Queue, listen: str = '127.0.0.1',
+                 port: int = 8443, url_path: str = '', secret_token: str = None,
+                 max_queue_size: int = 1000, cert: str = None, key: str = None,
+                 queue_depth: Callable[[], int] = None) -> None:
+        """
+        :param bot: bot used to deserialize updates.
+        :param update_queue: dispatcher update queue.
+        :param listen: address to listen.
+        :param port: port to listen.
+        :param url_path: path telegram posts updates to.
+        :param secret_token: token expected in `X-Telegram-Bot-Api-Secret-Token`
+               header, requests are not checked if not set.
+        :param max_queue_size: queue size at which new updates are rejected
+               with 503 until dispatcher catches up.
+        :param cert: path to TLS certificate, plain HTTP is used if not set.
+        :param key: path to TLS private key.
+        :param queue_depth: returns number of unprocessed updates,
+               size of `update_queue` by default.
+        """
+        self.listen = listen
+        self.port = port
+        self.url_path = '/' + url_path.strip('/')
+        self.ssl_context = None
+        if cert:
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(cert, key)
+        self.application = Application([(
+            self.url_path, WebhookHandler, {
+                'bot': bot,
+                'update_queue': update_queue,
+                'secret_token': secret_token,
+                'max_queue_size': max_queue_size,
+                'queue_depth': queue_depth or update_queue.qsize,
+            },
+        )])
+        self.loop: Optional[IOLoop] = None
+        self._ready = threading.Event()
+
+    def run(self) -> None:
+        """
+        Serve in current thread until `stop` is called.
+        """
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.loop = IOLoop.current()
+        server = HTTPServer(self.application, ssl_options=self.ssl_context)
+        server.listen(self.port, self.listen)
+        self._ready.set()
+        try:
+            self.loop.start()
+        finally:
+            server.stop()
+            self.loop.close(all_fds=True)
+
+    def start(self) -> threading.Thread:
+        """
+        Serve in daemon thread. Return when server accepts connections.
+        """
+        thread = threading.Thread(target=self.run, name='webhook', daemon=True)
+        thread.start()
+        self._ready.wait()
+        return thread
+
+    def stop(self) -> None:
+        """
+        Stop serving. Safe to call from any thread or signal handler.
+        """
+        if self.loop is not None:
+            self.loop.add_callback_from_signal(self.loop.stop)
+
+
+def run_webhook(updater: Updater, url: str, listen: str, port: int,
+                secret_token: str = None, max_queue_size: int = 1000,
+                cert: str = None, key: str = None) -> None:
+    """
+    Register webhook in telegram, start dispatcher and job queue
+    and serve webhook in current thread until SIGINT or SIGTERM.
+    :param updater: updater with registered handlers.
+    :param url: public url telegram sends updates to.
+    Other parameters are passed to `WebhookServer`.
+    """
+    dispatcher = updater.dispatcher
+    url_path = url.split('/', 3)[3] if url.count('/') >= 3 else ''
+    server = WebhookServer(
+        updater.bot, dispatcher.update_queue, listen=listen, port=port,
+        url_path=url_path, secret_token=secret_token,
+        max_queue_size=max_queue_size, cert=cert, key=key,
+        queue_depth=getattr(dispatcher, 'queue_depth', None),
+    )
+
+    dispatcher_thread = threading.Thread(
+        target=dispatcher.start, name='dispatcher', daemon=True
+    )
+    dispatcher_thread.start()
+    if updater.job_queue:
+        updater.job_queue.start()
+
+    api_kwargs = {'secret_token': secret_token} if secret_token else None
+    if cert:
+        with open(cert, 'rb') as certificate:
+            updater.bot.set_webhook(url=url, certificate=certificate, api_kwargs=api_kwargs)
+    else:
+        updater.bot.set_webhook(url=url, api_kwargs=api_kwargs)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: server.stop())
+    logger.info('Serving webhook on %s:%s%s', listen, port, server.url_path)
+    try:
+        server.run()
+    finally:
+        if updater.job_queue:
+            updater.job_queue.stop()
+        dispatcher.stop()
+        dispatcher_thread.join()
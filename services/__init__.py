@@ -1,4 +1,11 @@
 """Imports for convince"""
-from .user import User  # noqa F401
+from .user import User, user_cache  # noqa F401
 from .decorators import user_required  # noqa F401
-from .category import Category, CategoryError  # noqa F401
+from .category import Category, CategoryError, alias_catalog, catalog  # noqa F401
+from .exceptions import BudgetError, LedgerError, RateError, ReportError  # noqa F401
+from .ledger import LedgerEntry, search_cache  # noqa F401
+from .rollup import Rollup  # noqa F401
+from .rates import Rates, rate_cache  # noqa F401
+from .budget import Budget  # noqa F401
+from .ledger_csv import LedgerCSV  # noqa F401
+from .partitions import LedgerPartitions  # noqa F401
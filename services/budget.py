@@ -0,0 +1,212 @@
+"""
+Monthly spending limits per category
+"""
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+from config.settings import BUDGET_WARNING_SHARE, CURRENCIES, DEFAULT_CURRENCY
+from db.exceptions import DBError
+from db.queries import DBManager
+from .category import Category
+from .exceptions import BudgetError, CategoryError
+from .model import Model
+from .rollup import report_timezone
+
+BudgetStatus = namedtuple('BudgetStatus', 'codename currency amount spent')
+BudgetAlert = namedtuple('BudgetAlert', 'chat_id codename currency amount spent level')
+
+WARNING, EXCEEDED = 1, 2
+
+_STATUS = '''
+    SELECT b.codename, b.currency, b.amount, COALESCE(m.total, 0)
+    FROM budget b
+    LEFT JOIN ledger_monthly m ON m.chat_id = b.chat_id AND m.codename = b.codename
+        AND m.currency = b.currency AND m.month = %s AND m.type = 'expense'
+    WHERE b.chat_id = %s
+    ORDER BY b.codename, b.currency
+'''
+# one statement for all users: find budgets whose alert level rose this
+# month, remember new level so every alert is sent once, return them
+_CHECK = '''
+    WITH spent AS (
+        SELECT b.chat_id, b.codename, b.currency, m.total,
+               CASE WHEN m.total >= b.amount THEN 2 ELSE 1 END AS level
+        FROM budget b
+        JOIN ledger_monthly m ON m.chat_id = b.chat_id AND m.codename = b.codename
+            AND m.currency = b.currency AND m.month = %(month)s AND m.type = 'expense'
+        WHERE m.total >= b.amount * %(warning_share)s
+    )
+    UPDATE budget b SET alert_month = %(month)s, alert_level = s.level
+    FROM spent s
+    WHERE b.chat_id = s.chat_id AND b.codename = s.codename AND b.currency = s.currency
+        AND (b.alert_month IS DISTINCT FROM %(month)s OR b.alert_level < s.level)
+    RETURNING b.chat_id, b.codename, b.currency, b.amount, s.total, s.level
+'''
+
+
+def current_month() -> date:
+    """
+    :return: first day of current month in report timezone.
+    """
+    return datetime.now(report_timezone).date().replace(day=1)
+
+
+class Budget(Model):
+    """
+    Limit of monthly expenses in one category and currency.
+    """
+    _table_name = 'budget'
+    _table_cols = ('chat_id', 'codename', 'currency', 'amount')
+    _key_cols = ('chat_id', 'codename', 'currency')
+    __slots__ = _table_cols
+
+    def __init__(self, chat_id: int, codename: str, currency: str, amount: Decimal) -> None:
+        self.chat_id = chat_id
+        self.codename = codename
+        self.currency = currency
+        self.amount = amount
+
+    @staticmethod
+    def _parse_args(context_args: list[str, ], with_amount: bool) -> tuple:
+        """
+        Parse `<category> [<amount>] [<currency>]` arguments.
+        :raise BudgetError in case of invalid arguments.
+        :return: codename, amount or None, currency.
+        """
+        usage = 'Invalid command. Use `/budget <category> <amount> [<currency>]`' \
+            if with_amount else 'Invalid command. Use `/delete_budget <category> [<currency>]`'
+        if not context_args or len(context_args) > (3 if with_amount else 2):
+            raise BudgetError(usage)
+
+        try:
+            category = Category.get(context_args[0])
+        except CategoryError as error:
+            raise BudgetError(str(error)) from error
+        if category.type != 'expense':
+            raise BudgetError('Budget can be set only for expense category')
+
+        amount = None
+        rest = context_args[1:]
+        if with_amount:
+            if not rest:
+                raise BudgetError(usage)
+            try:
+                amount = Decimal(rest.pop(0).replace(',', '.'))
+            except InvalidOperation as error:
+                raise BudgetError('Amount must be positive number') from error
+            if not amount.is_finite() or amount <= 0:
+                raise BudgetError('Amount must be positive number')
+            amount = amount.quantize(Decimal('0.01'))
+
+        currency = rest[0].upper() if rest else DEFAULT_CURRENCY
+        if currency not in CURRENCIES:
+            raise BudgetError(f'Supported currencies: {", ".join(CURRENCIES)}')
+        return category.codename, amount, currency
+
+    @classmethod
+    def set(cls, chat_id: int, context_args: list[str, ]) -> 'Budget':
+        """
+        Create budget or change its amount. Alerts of this month are
+        sent again for the new amount.
+        :param chat_id: chat id of user.
+        :param context_args: `/budget` command arguments.
+        :raise BudgetError in case of invalid arguments or db errors.
+        :return: Budget instance.
+        """
+        codename, amount, currency = cls._parse_args(context_args, with_amount=True)
+        data = {
+            'chat_id': chat_id,
+            'codename': codename,
+            'currency': currency,
+            'amount': amount,
+            'alert_month': None,
+            'alert_level': 0,
+        }
+        try:
+            row = DBManager().upsert(
+                cls._table_name, data, ('chat_id', 'codename', 'currency'), cls._table_cols
+            )
+        except DBError as error:
+            raise BudgetError(str(error)) from error
+        return cls(*row)
+
+    @classmethod
+    def delete(cls, chat_id: int, context_args: list[str, ]) -> 'Budget':
+        """
+        Delete budget.
+        :param chat_id: chat id of user.
+        :param context_args: `/delete_budget` command arguments.
+        :raise BudgetError if budget does not exist or in case of db errors.
+        :return: deleted Budget instance.
+        """
+        codename, _, currency = cls._parse_args(context_args, with_amount=False)
+        try:
+            rows = DBManager().delete(
+                cls._table_name,
+                {'chat_id': chat_id, 'codename': codename, 'currency': currency},
+                returning=cls._table_cols,
+            )
+        except DBError as error:
+            raise BudgetError(str(error)) from error
+        if not rows:
+            raise BudgetError(f'Budget for {codename} in {currency} does not exist')
+        return cls(*rows[0])
+
+    @staticmethod
+    def get_all(chat_id: int) -> list[BudgetStatus]:
+        """
+        :return: budgets of user with amounts spent this month.
+        :raise BudgetError in case of db errors.
+        """
+        try:
+            rows = DBManager().execute(_STATUS, (current_month(), chat_id), fetch='all')
+        except DBError as error:
+            raise BudgetError(str(error)) from error
+        return [BudgetStatus(*row) for row in rows]
+
+    @staticmethod
+    def check(month: date = None, warning_share: float = BUDGET_WARNING_SHARE
+              ) -> list[BudgetAlert]:
+        """
+        Evaluate budgets of all users with single query against
+        monthly totals. Every alert level is returned once per month.
+        :param month: first day of month, current by default.
+        :param warning_share: share of budget spent to warn about.
+        :raise BudgetError in case of db errors.
+        :return: alerts to send.
+        """
+        try:
+            rows = DBManager().execute(
+                _CHECK, {'month': month or current_month(), 'warning_share': warning_share},
+                fetch='all',
+            )
+        except DBError as error:
+            raise BudgetError(str(error)) from error
+        return [BudgetAlert(*row) for row in rows]
+
+    @staticmethod
+    def format_alert(alert: BudgetAlert) -> str:
+        """
+        :return: alert text sent to user.
+        """
+        if alert.level == EXCEEDED:
+            return f'Budget for {alert.codename} exceeded: ' \
+                   f'spent {alert.spent} of {alert.amount} {alert.currency} this month'
+        return f'Budget for {alert.codename} is almost spent: ' \
+               f'{alert.spent} of {alert.amount} {alert.currency} this month'
+
+    @staticmethod
+    def list_str(budgets: list[BudgetStatus]) -> str:
+        """
+        :return: text with budgets and spent amounts.
+        """
+        if not budgets:
+            return 'No budgets. Set one with `/budget <category> <amount> [<currency>]`'
+        return '\n'.join(
+            f'{budget.codename}: {budget.spent} of {budget.amount} {budget.currency}'
+            for budget in budgets
+        )
+
+    def __str__(self) -> str:
+        return f'{self.codename}: {self.amount} {self.currency} per month'
@@ -0,0 +1,100 @@
+"""
+In-process caches used by services
+"""
+import threading
+from typing import Any, Hashable
+
+from cachetools import Cache, TTLCache
+
+
+class _CountingTTLCache(TTLCache):
+    """
+    TTLCache which counts items evicted because of size limit and
+    items dropped because their TTL expired.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        super().__init__(maxsize, ttl)
+        self.evictions = 0
+        self.expirations = 0
+
+    def popitem(self) -> tuple[Hashable, Any]:
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def expire(self, time: float = None) -> Any:
+        size = Cache.__len__(self)
+        result = super().expire(time)
+        self.expirations += size - Cache.__len__(self)
+        return result
+
+
+class ObservableCache:
+    """
+    Thread-safe bounded LRU cache with TTL.
+    Counts hits, misses and evictions so they can be monitored.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        """
+        :param maxsize: max number of cached items, least recently
+               used item is evicted when cache is full.
+        :param ttl: seconds item stays in cache.
+        """
+        self._cache = _CountingTTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        :return: cached value or default if key is missing or expired.
+        """
+        with self._lock:
+            try:
+                value = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Put value to cache, evicting least recently used item if needed.
+        """
+        with self._lock:
+            self._cache[key] = value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Remove key from cache.
+        :return: removed value or default.
+        """
+        with self._lock:
+            return self._cache.pop(key, default)
+
+    def clear(self) -> None:
+        """
+        Remove all items from cache. Counters are kept.
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict[str, Any]:
+        """
+        :return: cache size and counters for monitoring.
+        """
+        with self._lock:
+            self._cache.expire()
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._cache),
+                'maxsize': self._cache.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self._cache.evictions,
+                'expirations': self._cache.expirations,
+            }
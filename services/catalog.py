@@ -0,0 +1,173 @@
+"""
+In-memory catalog of rarely changed db tables with
+cross-process invalidation via postgres LISTEN/NOTIFY
+"""
+import logging
+import select
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from psycopg2 import connect, extensions
+
+from config.settings import DB_CONNECTION
+from db.queries import DBManager
+
+logger = logging.getLogger(__name__)
+
+
+class Catalog:
+    """
+    Copy of whole db table kept in memory and indexed by key column
+    and by group column. Table is loaded once and served without db
+    access until catalog is invalidated.
+    Every change of the table must be followed by `DBManager.notify`
+    with catalog `channel`, so catalogs in all bot processes are invalidated.
+    """
+
+    def __init__(self, table_name: str, table_cols: tuple,
+                 key_col: str, group_col: str) -> None:
+        """
+        :param table_name: table to load.
+        :param table_cols: columns to load.
+        :param key_col: unique column used for lookup of single row.
+        :param group_col: column used for lookup of several rows.
+        """
+        self.table_name = table_name
+        self.table_cols = table_cols
+        self.channel = f'{table_name}_changed'
+        self._key_index = table_cols.index(key_col)
+        self._group_index = table_cols.index(group_col)
+        self._lock = threading.Lock()
+        self._rows_by_key: dict[Any, tuple] = {}
+        self._rows_by_group: dict[Any, list[tuple]] = {}
+        self._version = 0
+        self._loaded_version: Optional[int] = None
+        self._listener: Optional[threading.Thread] = None
+        self._subscribers: list[Callable[[], None]] = []
+
+    def subscribe(self, callback: Callable[[], None]) -> None:
+        """
+        :param callback: called without arguments every time catalog is
+               invalidated. Used to drop data derived from catalog rows.
+        """
+        self._subscribers.append(callback)
+
+    def warm(self) -> None:
+        """
+        Load table from db and rebuild indexes.
+        :raise DBError in case of errors during loading.
+        """
+        with self._lock:
+            self._load()
+
+    def _ensure_loaded(self) -> None:
+        """
+        Reload table if catalog is stale. Concurrent callers wait
+        for one reload instead of loading table several times.
+        """
+        if self.is_stale:
+            with self._lock:
+                if self.is_stale:
+                    self._load()
+
+    def _load(self) -> None:
+        """
+        Load rows and swap indexes. Must be called under lock.
+        """
+        version = self._version
+        # catalog is shared by all updates, so uncommitted rows of unit are not read
+        rows = DBManager(use_replicas=False, join_unit=False).select(
+            self.table_name, self.table_cols, {}
+        )
+        rows_by_key = {}
+        rows_by_group: dict[Any, list[tuple]] = {}
+        for row in rows:
+            rows_by_key[row[self._key_index]] = row
+            rows_by_group.setdefault(row[self._group_index], []).append(row)
+        self._rows_by_key = rows_by_key
+        self._rows_by_group = rows_by_group
+        self._loaded_version = version
+
+    def invalidate(self) -> None:
+        """
+        Mark loaded rows stale. Table is reloaded on next access.
+        """
+        self._version += 1
+        for callback in self._subscribers:
+            callback()
+
+    @property
+    def is_stale(self) -> bool:
+        """
+        :return: True if catalog was never loaded or was invalidated.
+        """
+        return self._loaded_version != self._version
+
+    def get(self, key: Any) -> Optional[tuple]:
+        """
+        :param key: value of key column.
+        :return: row with given key or None.
+        """
+        self._ensure_loaded()
+        return self._rows_by_key.get(key)
+
+    def get_group(self, group: Any) -> list[tuple]:
+        """
+        :param group: value of group column.
+        :return: rows with given group column value.
+        """
+        self._ensure_loaded()
+        return list(self._rows_by_group.get(group, ()))
+
+    def all(self) -> list[tuple]:
+        """
+        :return: all rows of the table.
+        """
+        self._ensure_loaded()
+        return list(self._rows_by_key.values())
+
+    def listen(self, dsn: dict = None, reconnect_delay: float = 5.0) -> None:
+        """
+        Start daemon thread which listens to catalog channel
+        and reloads catalog when notification is received.
+        :param dsn: connection parameters, DB_CONNECTION by default.
+        :param reconnect_delay: seconds to wait before reconnecting
+               after connection is lost.
+        """
+        if self._listener is not None:
+            return
+        self._listener = threading.Thread(
+            target=self._listen, args=(dsn or DB_CONNECTION, reconnect_delay),
+            name=f'{self.channel}-listener', daemon=True,
+        )
+        self._listener.start()
+
+    def _listen(self, dsn: dict, reconnect_delay: float) -> None:
+        """
+        Listener thread loop. Notifications could be missed while
+        connection is down, so catalog is invalidated on every reconnect.
+        """
+        while True:
+            connection = None
+            try:
+                connection = connect(**dsn)
+                connection.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self.channel}')
+                self.invalidate()
+                self.warm()
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    if connection.notifies:
+                        connection.notifies.clear()
+                        self.invalidate()
+                        self.warm()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning('Catalog %s listener failed: %s', self.table_name, error)
+                self.invalidate()
+                if connection is not None:
+                    connection.close()
+                time.sleep(reconnect_delay)
@@ -1,18 +1,45 @@
 """
 Business logic connected to category
 """
+import asyncio
 from collections import namedtuple
 
-from db.queries import DBManager, DBError, DBUniqueViolation
+from db.async_queries import AsyncDBManager
+from db.queries import (DBManager, DBError, DBUniqueViolation, UnitOfWork, after_commit,
+                        current_unit)
+from .catalog import Catalog
 from .exceptions import CategoryError
+from .model import Model
+from .parser import fold
 
 
 CategoryInput = namedtuple(
     'CategoryInput', 'codename title description category_type'
 )
 
+CATEGORY_TYPES = ('expense', 'income')
 
-class Category:
+# aggregates of category are moved to its new type, merged with ones
+# already written with new type
+_RETYPE_ROLLUP = '''
+    WITH moved AS (
+        DELETE FROM {table} WHERE codename = %s AND type <> %s
+        RETURNING chat_id, codename, currency, {period}, total, entries
+    )
+    INSERT INTO {table} (chat_id, codename, type, currency, {period}, total, entries)
+    SELECT chat_id, codename, %s, currency, {period}, sum(total), sum(entries)
+    FROM moved
+    GROUP BY chat_id, codename, currency, {period}
+    ON CONFLICT (chat_id, {period}, codename, type, currency) DO UPDATE
+    SET total = {table}.total + EXCLUDED.total, entries = {table}.entries + EXCLUDED.entries
+'''
+_RETYPE_ROLLUPS = tuple(
+    _RETYPE_ROLLUP.format(table=table_name, period=period)
+    for table_name, period in (('ledger_daily', 'day'), ('ledger_monthly', 'month'))
+)
+
+
+class Category(Model):
     """
     Class representing income/expense category
     """
@@ -24,6 +51,8 @@ class Category:
         'description',
         'type',
     )
+    _key_cols = ('codename',)
+    __slots__ = _table_cols
 
     def __init__(self, codename: str, title: str, description: str, type: str):
         self.codename = codename
@@ -39,13 +68,17 @@ class Category:
         :return: Category instance.
         """
         try:
-            DBManager().insert(self._table_name, self.__dict__)
+            with DBManager().transaction(savepoint=True) as db_manager:
+                db_manager.insert(self._table_name, self.as_dict())
+                db_manager.notify(catalog.channel, self.codename)
         except DBUniqueViolation as error:
             raise CategoryError(
                 f'Category with codename {self.codename} or title {self.title} already exists'
             ) from error
         except DBError as error:
             raise CategoryError(str(error)) from error
+        finally:
+            after_commit(catalog.invalidate)
 
         return self
 
@@ -67,42 +100,69 @@ class Category:
     @classmethod
     def get_all(cls, category_type: str = 'expense') -> list['Category', ]:
         """
-        Get categories with specified type from db.
+        Get categories with specified type from catalog.
         :param category_type: type of category, `expense` by default.
         :raise: CategoryError in case of invalid category type or other errors.
         :return: list of Category instances.
         """
+        if category_type not in CATEGORY_TYPES:
+            raise CategoryError(f'Invalid category type {category_type}')
         try:
-            categories = DBManager().select(
-                cls._table_name, cls._table_cols, {'type': category_type}
-            )
+            categories = catalog.get_group(category_type)
         except DBError as error:
             raise CategoryError(str(error)) from error
-        return [cls(*category) for category in categories]
+        return [cls._loaded(category) for category in categories]
 
     @classmethod
     def get(cls, codename: str) -> 'Category':
         """
-        Get category from db by codename.
+        Get category from unit of work or catalog by codename.
         :param codename: category codename.
         :raise: CategoryError in category with given codename does not
                 exist in db and in case of other errors.
         :return: Category instance.
         """
+        unit = current_unit.get()
+        if unit is not None and (category := unit.get(cls, (codename,))) is not None:
+            return category
         try:
-            category = DBManager().select(cls._table_name, cls._table_cols, {'codename': codename})
+            category = catalog.get(codename)
         except DBError as error:
             raise CategoryError(str(error)) from error
 
         if category:
-            return cls(*category[0])
+            return cls._loaded(category)
         raise CategoryError(f'Category with codename {codename} does not exist')
 
+    @classmethod
+    def _loaded(cls, row: tuple) -> 'Category':
+        """
+        :return: instance of catalog row, the same one within unit of work.
+        """
+        unit = current_unit.get()
+        category = cls(*row)
+        return unit.add(category) if unit is not None else category
+
+    def flush(self, db_manager: DBManager) -> None:
+        """
+        Write changed columns and notify catalogs.
+        """
+        if not self._dirty:
+            return
+        super().flush(db_manager)
+        db_manager.notify(catalog.channel, self.codename)
+        db_manager.notify(alias_catalog.channel, self.codename)
+        self._unit.after_commit(catalog.invalidate)
+        self._unit.after_commit(alias_catalog.invalidate)
+
     @classmethod
     def update(cls, codename: str = None, data: dict = None,
                context_args: list[str, ] = None) -> 'Category':
         """
         Update category by given codename and data or by given context args.
+        Changes are written when unit of work commits, inside handler
+        at its end, see `UnitOfWork`. If type changes, ledger aggregates
+        of category are moved to the new type in the same transaction.
         :param codename: category codename.
         :param data: dict with keys - category attribute and value - its value.
         :param context_args: text passed by user in telegram message after command.
@@ -110,7 +170,31 @@ class Category:
                 in case of invalid input data or invalid context_args.
         :return: update Category instance.
         """
+        codename, data = cls._update_data(codename, data, context_args)
+        try:
+            with UnitOfWork.join():
+                category = cls.get(codename)
+                retyped = data.get('type', category.type) != category.type
+                for key, value in data.items():
+                    setattr(category, key, value)
+                if retyped:
+                    db_manager = DBManager()
+                    for query in _RETYPE_ROLLUPS:
+                        db_manager.execute(query, (codename, category.type, category.type))
+        except DBError as error:
+            raise CategoryError(str(error)) from error
+        except DBUniqueViolation as error:
+            raise CategoryError(str(error)) from error
+
+        return category
 
+    @classmethod
+    def _update_data(cls, codename: str = None, data: dict = None,
+                     context_args: list[str, ] = None) -> tuple[str, dict]:
+        """
+        :return: codename and changed columns of category to update.
+        :raise CategoryError in case of invalid input data or context_args.
+        """
         if not (codename and data) and not context_args:
             raise CategoryError('Pass codename and data or context_args')
 
@@ -130,20 +214,12 @@ class Category:
 
                 data[key] = value
 
-        category = cls.get(codename)
-
-        for key, value in data.items():
-            if hasattr(category, key):
-                setattr(category, key, value)
-
-        try:
-            DBManager().update(cls._table_name, data, {'codename': codename})
-        except DBError as error:
-            raise CategoryError(str(error)) from error
-        except DBUniqueViolation as error:
-            raise CategoryError(str(error)) from error
-
-        return category
+        for key in data:
+            if key not in cls._table_cols:
+                raise CategoryError(f'Unknown category field {key}')
+        if data.get('type', CATEGORY_TYPES[0]) not in CATEGORY_TYPES:
+            raise CategoryError(f'Invalid category type {data["type"]}')
+        return codename, data
 
     @staticmethod
     def _parse_text(context_args: list[str, ]) -> CategoryInput:
@@ -178,13 +254,171 @@ class Category:
                sql query performing.
         :return: None
         """
-        db_manager = DBManager()
-        if not db_manager.exists(cls._table_name, {'codename': codename}):
-            raise CategoryError(f'Category with codename {codename} does not exist')
         try:
-            db_manager.delete(cls._table_name, {'codename': codename})
+            with DBManager().transaction(savepoint=True) as db_manager:
+                if not db_manager.delete(
+                        cls._table_name, {'codename': codename}, returning=('codename',)
+                ):
+                    raise CategoryError(f'Category with codename {codename} does not exist')
+                db_manager.notify(catalog.channel, codename)
+                db_manager.notify(alias_catalog.channel, codename)
+                if db_manager.unit is not None:
+                    db_manager.unit.discard(cls, (codename,))
+        except DBError as error:
+            raise CategoryError(str(error)) from error
+        finally:
+            after_commit(catalog.invalidate)
+            after_commit(alias_catalog.invalidate)
+
+    @classmethod
+    def add_alias(cls, context_args: list[str, ]) -> tuple[str, str]:
+        """
+        Add alias used to recognize category in expense messages.
+        :param context_args: text passed by user as command arguments.
+               Example: `/add_alias food groceries`, alias could have
+               several words.
+        :raise CategoryError in case of invalid context_args, unknown
+               category or if alias already exists.
+        :return: saved alias and codename.
+        """
+        if len(context_args) < 2:
+            raise CategoryError('Invalid command. See `/admin_help`')
+        category = cls.get(context_args[0])
+        alias = fold(' '.join(context_args[1:]))
+        try:
+            with DBManager().transaction(savepoint=True) as db_manager:
+                db_manager.insert(
+                    alias_catalog.table_name, {'alias': alias, 'codename': category.codename}
+                )
+                db_manager.notify(alias_catalog.channel, alias)
+        except DBUniqueViolation as error:
+            raise CategoryError(f'Alias {alias} already exists') from error
+        except DBError as error:
+            raise CategoryError(str(error)) from error
+        finally:
+            after_commit(alias_catalog.invalidate)
+        return alias, category.codename
+
+    @classmethod
+    def delete_alias(cls, context_args: list[str, ]) -> str:
+        """
+        Delete category alias.
+        :param context_args: alias words passed by user as command arguments.
+        :raise CategoryError if alias does not exist or on db errors.
+        :return: deleted alias.
+        """
+        alias = fold(' '.join(context_args))
+        try:
+            with DBManager().transaction() as db_manager:
+                deleted = db_manager.delete(
+                    alias_catalog.table_name, {'alias': alias}, returning=('alias',)
+                )
+                db_manager.notify(alias_catalog.channel, alias)
         except DBError as error:
             raise CategoryError(str(error)) from error
+        finally:
+            after_commit(alias_catalog.invalidate)
+        if not deleted:
+            raise CategoryError(f'Alias {alias} does not exist')
+        return alias
+
+    @staticmethod
+    async def _fresh(table_catalog: Catalog) -> None:
+        """
+        Reload stale catalog in worker thread, so event loop is not blocked.
+        """
+        if table_catalog.is_stale:
+            await asyncio.to_thread(table_catalog.warm)
+
+    async def asave(self) -> 'Category':
+        """
+        Coroutine version of `save` for asyncio mode.
+        """
+        try:
+            async with AsyncDBManager().transaction() as db_manager:
+                await db_manager.insert(self._table_name, self.as_dict())
+                await db_manager.notify(catalog.channel, self.codename)
+        except DBUniqueViolation as error:
+            raise CategoryError(
+                f'Category with codename {self.codename} or title {self.title} already exists'
+            ) from error
+        except DBError as error:
+            raise CategoryError(str(error)) from error
+        finally:
+            catalog.invalidate()
+
+        return self
+
+    @classmethod
+    async def aadd_category(cls, context_args: list[str, ]) -> 'Category':
+        """
+        Coroutine version of `add_category` for asyncio mode.
+        """
+        return await cls(*cls._parse_text(context_args)).asave()
+
+    @classmethod
+    async def aget_all(cls, category_type: str = 'expense') -> list['Category', ]:
+        """
+        Coroutine version of `get_all` for asyncio mode.
+        """
+        await cls._fresh(catalog)
+        return cls.get_all(category_type)
+
+    @classmethod
+    async def aget(cls, codename: str) -> 'Category':
+        """
+        Coroutine version of `get` for asyncio mode.
+        """
+        await cls._fresh(catalog)
+        return cls.get(codename)
+
+    @classmethod
+    async def aupdate(cls, codename: str = None, data: dict = None,
+                      context_args: list[str, ] = None) -> 'Category':
+        """
+        Coroutine version of `update` for asyncio mode, changes are
+        written right away.
+        """
+        codename, data = cls._update_data(codename, data, context_args)
+        category = await cls.aget(codename)
+        retyped = data.get('type', category.type) != category.type
+        for key, value in data.items():
+            setattr(category, key, value)
+        try:
+            async with AsyncDBManager().transaction() as db_manager:
+                await db_manager.update(cls._table_name, data, {'codename': codename})
+                if retyped:
+                    for query in _RETYPE_ROLLUPS:
+                        await db_manager.execute(query, (codename, category.type, category.type))
+                await db_manager.notify(catalog.channel, codename)
+                await db_manager.notify(alias_catalog.channel, codename)
+        except DBError as error:
+            raise CategoryError(str(error)) from error
+        except DBUniqueViolation as error:
+            raise CategoryError(str(error)) from error
+        finally:
+            catalog.invalidate()
+            alias_catalog.invalidate()
+        return category
+
+    @classmethod
+    async def adelete(cls, codename: str) -> None:
+        """
+        Coroutine version of `delete` for asyncio mode.
+        """
+        try:
+            async with AsyncDBManager().transaction() as db_manager:
+                if not await db_manager.delete(
+                        cls._table_name, {'codename': codename}, returning=('codename',)
+                ):
+                    raise CategoryError(f'Category with codename {codename} does not exist')
+                await db_manager.notify(catalog.channel, codename)
+                await db_manager.notify(alias_catalog.channel, codename)
+        except DBError as error:
+            raise CategoryError(str(error)) from error
+        finally:
+            catalog.invalidate()
+            alias_catalog.invalidate()
 
     def admin_str(self) -> str:
         """
@@ -195,3 +429,8 @@ class Category:
 
     def __str__(self) -> str:
         return f'{self.codename}: {self.title}'
+
+
+# pylint: disable=protected-access
+catalog = Catalog(Category._table_name, Category._table_cols, 'codename', 'type')
+alias_catalog = Catalog('category_alias', ('alias', 'codename'), 'alias', 'codename')
@@ -1,27 +1,104 @@
 """
 Project decorators
 """
+import asyncio
+import logging
+import time
 from typing import Callable
 
+from telegram.message import Message
 from telegram.update import Update
 from telegram.ext import CallbackContext
 
+from db.exceptions import DBError, DBUniqueViolation
+from db.queries import UnitOfWork
+from db.replicas import current_chat
+from runtime.metrics import HANDLER_LATENCY
+from runtime.sender import outbox
 from .user import User, UserError
 
+logger = logging.getLogger(__name__)
+
+
+def _user_message(update: Update) -> Message:
+    """
+    :return: message of update sent by user. Message of callback query
+             is sent by bot, so user who pressed the button is its sender.
+    """
+    query = update.callback_query
+    if query is not None:
+        return Message(query.message.message_id, query.message.date, query.message.chat,
+                       from_user=query.from_user)
+    return update.message or update.edited_message
+
 
 def user_required(handler: Callable) -> Callable:
     """
     Every handler must have user as argument.
     Get user from database if it exists else create.
+    Handler runs in unit of work, its db changes are committed together
+    when it returns and its replies are sent after commit, see `UnitOfWork`.
+    Handler latency is recorded to metrics. Chat is remembered
+    for routing reads, see `ReplicaRouter`.
+    Coroutine handlers of asyncio mode get user from async db layer,
+    they run without unit of work.
     """
+    if asyncio.iscoroutinefunction(handler):
+        return _async_user_required(handler)
+
     def decorator(update: Update, context: CallbackContext,
                   *args, **kwargs
                   ):
+        started = time.perf_counter()
+        status = 'error'
+        chat_token = current_chat.set(update.effective_chat.id)
         try:
-            user = User.get_or_create(update.message or update.edited_message)
-        except UserError as error:
-            return context.bot.send_message(
-                chat_id=update.effective_chat.id, text=str(error)
+            with outbox.hold(), UnitOfWork():
+                try:
+                    user = User.get_or_create(_user_message(update))
+                except UserError as error:
+                    status = 'user_error'
+                    return outbox.send_message(
+                        context.bot, chat_id=update.effective_chat.id, text=str(error)
+                    )
+                result = handler(user, update, context, *args, **kwargs)
+            status = 'ok'
+            return result
+        except (DBError, DBUniqueViolation) as error:
+            status = 'db_error'
+            logger.warning('Changes of %s were not saved: %s', handler.__name__, error)
+            reason = f'{error}.' if isinstance(error, DBUniqueViolation) \
+                else 'Please try again later.'
+            return outbox.send_message(
+                context.bot, chat_id=update.effective_chat.id,
+                text=f'Changes were not saved. {reason}',
             )
-        return handler(user, update, context, *args, **kwargs)
+        finally:
+            current_chat.reset(chat_token)
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler.__name__, status)
+    return decorator
+
+
+def _async_user_required(handler: Callable) -> Callable:
+    async def decorator(update: Update, context: CallbackContext,
+                        *args, **kwargs
+                        ):
+        started = time.perf_counter()
+        status = 'error'
+        chat_token = current_chat.set(update.effective_chat.id)
+        try:
+            with outbox.hold():
+                try:
+                    user = await User.aget_or_create(_user_message(update))
+                except UserError as error:
+                    status = 'user_error'
+                    return outbox.send_message(
+                        context.bot, chat_id=update.effective_chat.id, text=str(error)
+                    )
+                result = await handler(user, update, context, *args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            current_chat.reset(chat_token)
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler.__name__, status)
     return decorator
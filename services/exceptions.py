@@ -13,3 +13,27 @@ class CategoryError(Exception):
     """
     Exception raised on any error related to categories
     """
+
+
+class LedgerError(Exception):
+    """
+    Exception raised on any error related to ledger entries
+    """
+
+
+class ReportError(Exception):
+    """
+    Exception raised on any error related to reports
+    """
+
+
+class BudgetError(Exception):
+    """
+    Exception raised on any error related to budgets
+    """
+
+
+class RateError(Exception):
+    """
+    Exception raised on any error related to currency rates
+    """
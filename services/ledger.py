@@ -0,0 +1,470 @@
+"""
+Business logic connected to ledger entries (expenses and incomes)
+"""
+import re
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import closing
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from typing import Iterator, Optional
+
+from cachetools import TTLCache
+
+from config.settings import (
+    CURRENCIES, DEFAULT_CURRENCY, LEDGER_BATCH_DELAY, LEDGER_BATCH_SIZE,
+    LEDGER_WRITE_TIMEOUT, SEARCH_CACHE_PAGES, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL,
+)
+from db.batch import BatchWriter
+from db.exceptions import DBError
+from db.queries import And, Compare, DBManager, In, Matches, Or, Range, Where
+from .cache import ObservableCache
+from .category import Category, alias_catalog, catalog
+from .exceptions import CategoryError, LedgerError
+from .model import Model
+from .parser import AliasIndex, ExpenseParser, fold
+from .partitions import month_start, next_month, report_timezone
+from .rollup import Rollup
+
+DELETE_USAGE = 'Invalid command. Use `/delete_entry <id> [<YYYY-MM-DD>]`'
+EDIT_USAGE = 'Invalid command. Use `/edit_entry <id> [<YYYY-MM-DD>] amount=<amount> ' \
+             'currency=<currency> category=<category> note=<note>`'
+SEARCH_USAGE = 'Invalid command. Use `/search <words> [<YYYY-MM[-DD]> [<YYYY-MM[-DD]>]]`'
+_SEARCH_MAX_WORDS = 10
+# words of search query, the same as words of `simple` text search configuration
+_WORD = re.compile(r'[^\W_]+')
+_PERIOD = re.compile(r'\d{4}-\d{2}(-\d{2})?')
+
+# pages of search results by chat, dropped when chat writes to ledger
+search_cache = ObservableCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+# number of ledger writes by chat, page read while chat writes is not cached.
+# Counter is forgotten after TTL, searches take much less
+_search_writes = TTLCache(maxsize=SEARCH_CACHE_SIZE * 10, ttl=SEARCH_CACHE_TTL)
+_search_lock = threading.Lock()
+
+
+class LedgerEntry(Model):
+    """
+    Class representing single expense or income
+    """
+
+    _table_name = 'ledger'
+    _table_cols = (
+        'id',
+        'chat_id',
+        'codename',
+        'amount',
+        'currency',
+        'note',
+        'created_at',
+    )
+    _insert_cols = _table_cols[1:]
+    _key_cols = ('id',)
+    __slots__ = _table_cols
+
+    def __init__(self, id: int, chat_id: int, codename: str,  # pylint: disable=redefined-builtin
+                 amount: Decimal, currency: str, note: str = None,
+                 created_at: datetime = None) -> None:
+        self.id = id  # pylint: disable=invalid-name
+        self.chat_id = chat_id
+        self.codename = codename
+        self.amount = amount
+        self.currency = currency
+        self.note = note
+        self.created_at = created_at
+
+    def save(self) -> 'LedgerEntry':
+        """
+        Save entry through write-behind buffer. Entries of many users
+        are inserted together, method returns after entry is committed.
+        Entry still waiting in buffer when timeout expires is not saved.
+        :raise: LedgerError if entry was not saved or saving timed out.
+        :return: LedgerEntry instance with id set.
+        """
+        if self.created_at is None:
+            self.created_at = datetime.now().astimezone()
+        future = ledger_writer.submit(
+            tuple(getattr(self, col) for col in self._insert_cols)
+        )
+        try:
+            self.id, = future.result(timeout=LEDGER_WRITE_TIMEOUT)
+        except FutureTimeoutError as error:
+            # buffered entry is dropped by writer, entry being inserted is committed later
+            if future.cancel():
+                raise LedgerError('Saving takes too long, entry was not saved. '
+                                  'Please try again later.') from error
+            raise LedgerError('Saving takes too long, entry may have been saved. '
+                              'Please check /entries before trying again.') from error
+        except Exception as error:
+            raise LedgerError('Entry was not saved. Please try again later.') from error
+        finally:
+            # entry could be committed even if waiting for it failed
+            invalidate_search(self.chat_id)
+        return self
+
+    @classmethod
+    def add_entry(cls, chat_id: int, text: str, created_at: datetime = None) -> 'LedgerEntry':
+        """
+        Create entry from user telegram message and save it to db.
+        :param chat_id: chat id of user.
+        :param text: message text. Example: `120.50 USD coffee at work`.
+        :param created_at: time of entry, current time by default.
+        :raise: LedgerError in case of invalid text, unknown category or
+                errors while saving entry to db.
+        :return: LedgerEntry instance.
+        """
+        parsed = expense_parser.parse(text)
+        entry = cls(
+            None, chat_id, parsed.codename, parsed.amount,
+            parsed.currency, parsed.note, created_at,
+        )
+        return entry.save()
+
+    @classmethod
+    def iter_entries(cls, chat_id: int, after: tuple = (),
+                     limit: int = None) -> Iterator['LedgerEntry']:
+        """
+        Stream entries of user from newest to oldest.
+        :param chat_id: chat id of user.
+        :param after: `(created_at, id)` of last entry of previous page.
+        :param limit: max number of entries.
+        :raise LedgerError on db errors.
+        :return: iterator over LedgerEntry instances.
+        """
+        filters = {'chat_id': chat_id}
+        if after:
+            # keyset row comparison doesn't prune partitions, plain bound does
+            filters['created_at'] = Compare('<=', after[0])
+        rows = DBManager().select_iter(
+            cls._table_name, cls._table_cols, filters,
+            order_by=('created_at', 'id'), after=after, descending=True, limit=limit,
+        )
+        try:
+            with closing(rows):
+                for row in rows:
+                    yield cls(*row)
+        except DBError as error:
+            raise LedgerError(str(error)) from error
+
+    @staticmethod
+    def parse_search(context_args: list[str, ]
+                     ) -> tuple[tuple[str, ...], Optional[datetime], Optional[datetime]]:
+        """
+        Parse `/search` command arguments: words and optional period, a
+        month or a day, or first and last month or day of period.
+        Example: `/search taxi airport 2021-07 2021-08-15`.
+        :raise LedgerError in case of invalid arguments.
+        :return: lowercase words, start and end of period or None.
+        """
+        args = list(context_args or ())
+        periods: list[tuple[datetime, datetime]] = []
+        while args and len(periods) < 2 and _PERIOD.fullmatch(args[-1]):
+            try:
+                periods.insert(0, _parse_period(args.pop()))
+            except ValueError as error:
+                raise LedgerError('Invalid period. Use `YYYY-MM` or `YYYY-MM-DD`') from error
+        words = tuple(dict.fromkeys(_WORD.findall(' '.join(args).lower())))
+        if not words or len(words) > _SEARCH_MAX_WORDS:
+            raise LedgerError(SEARCH_USAGE)
+        if not periods:
+            return words, None, None
+        since, until = periods[0][0], periods[-1][1]
+        if since >= until:
+            raise LedgerError('Period must start before it ends')
+        return words, since, until
+
+    @staticmethod
+    def _matching_codenames(word: str) -> list[str]:
+        """
+        :return: codenames of categories whose codename, title or alias
+                 has a word starting with given one.
+        """
+        names = list(alias_catalog.all())
+        for codename, title, *_ in catalog.all():
+            names.extend(((codename, codename), (title, codename)))
+        word = fold(word)
+        return sorted({
+            codename for name, codename in names
+            if any(part.startswith(word) for part in _WORD.findall(fold(name)))
+        })
+
+    @classmethod
+    def search(cls, chat_id: int, words: tuple[str, ...], since: datetime = None,
+               until: datetime = None, after: tuple = (),
+               limit: int = None) -> list['LedgerEntry']:
+        """
+        Find entries of user from newest to oldest. Every word must be
+        a prefix of a word of entry note or of its category codename,
+        title or alias. Pages are cached until user writes to ledger.
+        :param chat_id: chat id of user.
+        :param words: lowercase words, see `parse_search`.
+        :param since: start of period, not limited if None.
+        :param until: end of period (exclusive), not limited if None.
+        :param after: `(created_at, id)` of last entry of previous page.
+        :param limit: max number of entries.
+        :raise LedgerError on db errors.
+        :return: list of LedgerEntry instances.
+        """
+        key = (words, since, until, tuple(after), limit)
+        with _search_lock:
+            writes = _search_writes.get(chat_id, 0)
+            pages = search_cache.get(chat_id) or {}
+        if key in pages:
+            return pages[key]
+
+        filters = [Where({'chat_id': chat_id, 'created_at': Range(since, until)})]
+        if after:
+            # keyset row comparison doesn't prune partitions, plain bound does
+            filters.append(Where({'created_at': Compare('<=', after[0])}))
+        note_words = []
+        for word in words:
+            codenames = cls._matching_codenames(word)
+            if codenames:
+                filters.append(Or({'note': Matches([word])}, {'codename': In(codenames)}))
+            else:
+                note_words.append(word)
+        if note_words:
+            # one index scan for all words
+            filters.append(Where({'note': Matches(note_words)}))
+        rows = DBManager().select_iter(
+            cls._table_name, cls._table_cols, And(*filters),
+            order_by=('created_at', 'id'), after=after, descending=True, limit=limit,
+        )
+        try:
+            with closing(rows):
+                entries = [cls(*row) for row in rows]
+        except DBError as error:
+            raise LedgerError(str(error)) from error
+
+        with _search_lock:
+            if _search_writes.get(chat_id, 0) != writes:
+                # chat wrote to ledger while page was read, it may be stale
+                return entries
+            # new dict, so pages read by other threads are not changed
+            pages = dict(pages)
+            pages[key] = entries
+            while len(pages) > SEARCH_CACHE_PAGES:
+                del pages[next(iter(pages))]
+            search_cache.set(chat_id, pages)
+        return entries
+
+    @staticmethod
+    def parse_entry_ref(context_args: list[str, ], usage: str = DELETE_USAGE
+                        ) -> tuple[int, Optional[tuple[datetime, datetime]], list[str, ]]:
+        """
+        Parse `<id> [<YYYY-MM[-DD]>]` at start of command arguments, as
+        entry is shown in entries list. Day or month of entry limits
+        lookup of entry to its partition.
+        :param usage: error text in case of invalid id.
+        :raise LedgerError in case of invalid arguments.
+        :return: entry id, start and end of its day or month or None,
+                 remaining arguments.
+        """
+        try:
+            entry_id = int(context_args[0].lstrip('#'))
+        except (IndexError, ValueError) as error:
+            raise LedgerError(usage) from error
+        args = list(context_args[1:])
+        period = None
+        if args and _PERIOD.fullmatch(args[0]):
+            try:
+                period = _parse_period(args.pop(0))
+            except ValueError as error:
+                raise LedgerError('Invalid date. Use `YYYY-MM-DD`') from error
+        return entry_id, period, args
+
+    @staticmethod
+    def _entry_filters(chat_id: int, entry_id: int,
+                       period: Optional[tuple[datetime, datetime]]) -> dict:
+        """
+        :return: filters of entry, bounded by period of entry if it is known.
+        """
+        filters = {'id': entry_id, 'chat_id': chat_id}
+        if period is not None:
+            filters['created_at'] = Range(*period)
+        return filters
+
+    @classmethod
+    def delete(cls, chat_id: int, entry_id: int,
+               period: tuple[datetime, datetime] = None) -> 'LedgerEntry':
+        """
+        Delete entry of given user and subtract it from aggregates.
+        :param chat_id: chat id of user.
+        :param entry_id: entry id.
+        :param period: start and end of day or month of entry, only its
+               partition is searched. All partitions if None.
+        :raise LedgerError if entry does not exist or on db errors.
+        :return: deleted LedgerEntry instance.
+        """
+        try:
+            with DBManager().transaction() as db_manager:
+                rows = db_manager.delete(
+                    cls._table_name, cls._entry_filters(chat_id, entry_id, period),
+                    returning=cls._table_cols,
+                )
+                entries = [cls(*row) for row in rows]
+                Rollup.apply(db_manager, entries, sign=-1)
+        except DBError as error:
+            raise LedgerError(str(error)) from error
+
+        invalidate_search(chat_id)
+        if not entries:
+            raise LedgerError(f'Entry #{entry_id} does not exist')
+        return entries[0]
+
+    @classmethod
+    def update(cls, chat_id: int, context_args: list[str, ]) -> 'LedgerEntry':
+        """
+        Update entry of given user and move it between aggregates.
+        :param chat_id: chat id of user.
+        :param context_args: text passed by user in telegram message after command.
+               Example: `12 2021-07-28 amount=10.5 category=food note=lunch with team`,
+               date of entry is optional.
+        :raise LedgerError if entry does not exist, in case of invalid
+               context_args or on db errors.
+        :return: updated LedgerEntry instance.
+        """
+        entry_id, period, data = cls._parse_update_args(context_args)
+        filters = cls._entry_filters(chat_id, entry_id, period)
+        try:
+            with DBManager().transaction() as db_manager:
+                old_rows = db_manager.select(
+                    cls._table_name, cls._table_cols, filters, for_update=True,
+                )
+                if not old_rows:
+                    raise LedgerError(f'Entry #{entry_id} does not exist')
+                new_rows = db_manager.update(
+                    cls._table_name, data, filters, returning=cls._table_cols,
+                )
+                Rollup.apply(db_manager, [cls(*old_rows[0])], sign=-1)
+                entry = cls(*new_rows[0])
+                Rollup.apply(db_manager, [entry])
+        except DBError as error:
+            raise LedgerError(str(error)) from error
+        invalidate_search(chat_id)
+        return entry
+
+    @classmethod
+    def _parse_update_args(cls, context_args: list[str, ]
+                           ) -> tuple[int, Optional[tuple[datetime, datetime]], dict]:
+        """
+        Parse `/edit_entry` command arguments `<id> [<YYYY-MM-DD>] <key>=<value> ...`.
+        Words without `=` are appended to previous value, so note
+        could contain spaces.
+        :raise LedgerError in case of invalid arguments.
+        :return: entry id, period of entry or None and dict with columns to update.
+        """
+        usage = EDIT_USAGE
+        entry_id, period, rest = cls.parse_entry_ref(context_args, usage)
+
+        args: dict[str, str] = {}
+        key = None
+        for arg in rest:
+            if '=' in arg:
+                key, value = arg.split('=', 1)
+                args[key] = value
+            elif key is not None:
+                args[key] += f' {arg}'
+            else:
+                raise LedgerError(usage)
+
+        data = {}
+        for key, value in args.items():
+            if key == 'amount':
+                try:
+                    amount = Decimal(value.replace(',', '.'))
+                except InvalidOperation as error:
+                    raise LedgerError('Amount must be positive number') from error
+                if not amount.is_finite() or amount <= 0:
+                    raise LedgerError('Amount must be positive number')
+                data['amount'] = amount.quantize(Decimal('0.01'))
+            elif key == 'currency':
+                if value.upper() not in CURRENCIES:
+                    raise LedgerError(f'Supported currencies: {", ".join(CURRENCIES)}')
+                data['currency'] = value.upper()
+            elif key == 'category':
+                try:
+                    data['codename'] = Category.get(value).codename
+                except CategoryError as error:
+                    raise LedgerError(str(error)) from error
+            elif key == 'note':
+                data['note'] = value or None
+            else:
+                raise LedgerError(usage)
+
+        if not data:
+            raise LedgerError(usage)
+        return entry_id, period, data
+
+    def ref_str(self) -> str:
+        """
+        :return: `#<id> <YYYY-MM-DD>` reference of entry, accepted by
+                 `/edit_entry` and `/delete_entry`. Day is in report timezone
+                 like partition boundaries.
+        """
+        return f'#{self.id} {self.created_at.astimezone(report_timezone):%Y-%m-%d}'
+
+    def list_str(self) -> str:
+        """
+        :return: String representation of entry. Used in entries list.
+        """
+        return f'{self.ref_str()} {self}'
+
+    def __str__(self) -> str:
+        text = f'{self.amount} {self.currency} {self.codename}'
+        if self.note:
+            text += f' ({self.note})'
+        return text
+
+
+def invalidate_search(chat_id: int) -> None:
+    """
+    Drop cached search pages of chat after it writes to ledger. Pages
+    being read meanwhile are not cached.
+    """
+    with _search_lock:
+        _search_writes[chat_id] = _search_writes.get(chat_id, 0) + 1
+        search_cache.pop(chat_id)
+
+
+def _parse_period(text: str) -> tuple[datetime, datetime]:
+    """
+    :raise ValueError if text is not valid `YYYY-MM` or `YYYY-MM-DD`.
+    :return: start and end of month or day in report timezone.
+    """
+    if len(text) == 7:
+        month = datetime.strptime(text, '%Y-%m').date()
+        return month_start(month), month_start(next_month(month))
+    day = date.fromisoformat(text)
+    start = datetime(day.year, day.month, day.day, tzinfo=report_timezone)
+    return start, start + timedelta(days=1)
+
+
+def _load_alias_index() -> AliasIndex:
+    """
+    Build alias index from categories codenames, titles and aliases.
+    """
+    aliases = []
+    for codename, title, *_ in catalog.all():
+        aliases.append((codename, codename))
+        aliases.append((title, codename))
+    aliases.extend(alias_catalog.all())
+    return AliasIndex(aliases)
+
+
+def _apply_rollups(db_manager: DBManager, rows: list[tuple]) -> None:
+    """
+    Add batch of inserted ledger rows to aggregates.
+    """
+    Rollup.apply(db_manager, (LedgerEntry(None, *row) for row in rows))
+
+
+# pylint: disable=protected-access
+ledger_writer = BatchWriter(
+    LedgerEntry._table_name, LedgerEntry._insert_cols, returning=('id',),
+    max_batch_size=LEDGER_BATCH_SIZE, max_delay=LEDGER_BATCH_DELAY,
+    on_flush=_apply_rollups,
+)
+expense_parser = ExpenseParser(_load_alias_index, CURRENCIES, DEFAULT_CURRENCY)
+catalog.subscribe(expense_parser.invalidate)
+alias_catalog.subscribe(expense_parser.invalidate)
@@ -0,0 +1,274 @@
+"""
+CSV export and import of ledger entries streamed through COPY
+"""
+import csv
+import io
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from tempfile import SpooledTemporaryFile
+from typing import IO, Iterator, Optional
+
+from psycopg2 import sql
+
+from config.settings import (CURRENCIES, DEFAULT_CURRENCY, IMPORT_BATCH_SIZE, REPORT_TIMEZONE,
+                             SPOOL_MAX_SIZE)
+from db.exceptions import DBError
+from db.queries import DBManager
+from .category import alias_catalog, catalog
+from .exceptions import LedgerError
+from .ledger import invalidate_search
+from .parser import fold
+from .partitions import LedgerPartitions
+from .rollup import Rollup, report_timezone
+
+ImportSummary = namedtuple('ImportSummary', 'accepted rejected duplicates errors')
+
+CSV_COLUMNS = ('date', 'amount', 'currency', 'category', 'note')
+_COLUMN_NAMES = {
+    'date': 'date', 'created_at': 'date',
+    'amount': 'amount', 'sum': 'amount',
+    'currency': 'currency',
+    'category': 'category', 'codename': 'category',
+    'note': 'note', 'description': 'note',
+}
+_DATE_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y')
+_MAX_AMOUNT = Decimal('1e10')
+_MAX_NOTE_LENGTH = 255
+_MAX_ERRORS = 10
+
+_STAGING_TABLE = 'ledger_import'
+_STAGING_COLS = ('chat_id', 'codename', 'amount', 'currency', 'note', 'created_at')
+_CREATE_STAGING = '''
+    CREATE TEMP TABLE ledger_import (
+        chat_id integer NOT NULL,
+        codename VARCHAR(15) NOT NULL,
+        amount NUMERIC(12, 2) NOT NULL,
+        currency CHAR(3) NOT NULL,
+        note VARCHAR(255),
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL
+    ) ON COMMIT DROP
+'''
+# rows equal to existing entries are dropped, so the same
+# statement can be imported twice without doubling expenses
+_DELETE_DUPLICATES = '''
+    WITH deleted AS (
+        DELETE FROM ledger_import s USING ledger l
+        WHERE l.chat_id = s.chat_id AND l.created_at = s.created_at
+            AND l.amount = s.amount AND l.currency = s.currency
+            AND l.codename = s.codename AND l.note IS NOT DISTINCT FROM s.note
+        RETURNING 1
+    )
+    SELECT count(*) FROM deleted
+'''
+_INSERT_STAGED = '''
+    INSERT INTO ledger (chat_id, codename, amount, currency, note, created_at)
+    SELECT chat_id, codename, amount, currency, note, created_at
+    FROM ledger_import ORDER BY created_at
+'''
+
+
+class LedgerCSV:
+    """
+    Ledger of one user as CSV with columns `date,amount,currency,category,note`.
+    Data flows between db and file with COPY, file is spooled to disk
+    when it grows, so no full dataset is held in memory.
+    """
+
+    @staticmethod
+    def export(chat_id: int, file: IO[bytes]) -> int:
+        """
+        Write all entries of user to file.
+        :param chat_id: chat id of user.
+        :param file: binary file to write to.
+        :raise LedgerError in case of db errors.
+        :return: number of exported entries.
+        """
+        query = sql.SQL(
+            "SELECT to_char(created_at AT TIME ZONE {}, 'YYYY-MM-DD HH24:MI:SS') AS date, "
+            'amount, currency, codename AS category, note '
+            'FROM ledger WHERE chat_id = {} ORDER BY created_at, id'
+        ).format(sql.Literal(REPORT_TIMEZONE), sql.Literal(chat_id))
+        try:
+            return DBManager().copy_out(query, file, label='copy_out:ledger')
+        except DBError as error:
+            raise LedgerError(str(error)) from error
+
+    @staticmethod
+    def _category_map() -> dict[str, str]:
+        """
+        :return: codename by folded codename, title or alias, built once per import.
+        """
+        categories = {}
+        for codename, title, *_ in catalog.all():
+            categories[fold(codename)] = codename
+            categories[fold(title)] = codename
+        for alias, codename in alias_catalog.all():
+            categories.setdefault(fold(alias), codename)
+        return categories
+
+    @staticmethod
+    def _columns(first_row: list[str]) -> tuple[dict[str, int], bool]:
+        """
+        :return: column indexes by name and True if first row is header.
+                 Files without header must have columns in `CSV_COLUMNS` order.
+        """
+        names = [_COLUMN_NAMES.get(fold(cell)) for cell in first_row]
+        if 'date' in names and 'amount' in names and 'category' in names:
+            return {name: index for index, name in enumerate(names) if name}, True
+        return {name: index for index, name in enumerate(CSV_COLUMNS)}, False
+
+    @staticmethod
+    def _parse_date(value: str) -> datetime:
+        """
+        Parse ISO date or `DD.MM.YYYY`, with optional time.
+        Date without timezone is in report timezone.
+        :raise ValueError if date is invalid.
+        """
+        try:
+            created_at = datetime.fromisoformat(value)
+        except ValueError:
+            for date_format in _DATE_FORMATS:
+                try:
+                    created_at = datetime.strptime(value, date_format)
+                    break
+                except ValueError:
+                    continue
+            else:
+                raise ValueError(f'invalid date {value!r}') from None
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=report_timezone)
+        return created_at
+
+    @classmethod
+    def _parse_row(cls, row: list[str], columns: dict[str, int],
+                   categories: dict[str, str], horizon: Optional[datetime]) -> tuple:
+        """
+        :param horizon: entries before it are archived and can't be added.
+        :return: values of staging table columns except chat_id.
+        :raise ValueError with reason if row is invalid.
+        """
+        def cell(name: str) -> str:
+            index = columns.get(name)
+            return row[index].strip() if index is not None and index < len(row) else ''
+
+        created_at = cls._parse_date(cell('date'))
+        if horizon is not None and created_at < horizon:
+            raise ValueError(f'month of {cell("date")!r} is archived')
+        try:
+            # bank statements show expenses as negative amounts
+            amount = abs(Decimal(cell('amount').replace(' ', '').replace(',', '.')))
+        except InvalidOperation:
+            raise ValueError(f'invalid amount {cell("amount")!r}') from None
+        if not amount.is_finite() or not 0 < amount < _MAX_AMOUNT:
+            raise ValueError(f'invalid amount {cell("amount")!r}')
+        currency = cell('currency').upper() or DEFAULT_CURRENCY
+        if currency not in CURRENCIES:
+            raise ValueError(f'unsupported currency {currency!r}')
+        codename = categories.get(fold(cell('category')))
+        if codename is None:
+            raise ValueError(f'unknown category {cell("category")!r}')
+        note = cell('note')[:_MAX_NOTE_LENGTH] or None
+        return codename, amount.quantize(Decimal('0.01')), currency, note, created_at
+
+    @classmethod
+    def _validate(cls, chat_id: int, reader: Iterator[list[str]], staged: IO[str],
+                  batch_size: int) -> tuple[int, int, list[str], tuple]:
+        """
+        Validate rows batch by batch and write accepted ones to staged file.
+        :return: numbers of accepted and rejected rows, first errors
+                 and time range of accepted entries.
+        """
+        categories = cls._category_map()
+        horizon = LedgerPartitions.archive_horizon()
+        first_row = next(reader, None)
+        if first_row is None:
+            return 0, 0, [], ()
+        columns, has_header = cls._columns(first_row)
+        rows = reader if has_header else _prepend(first_row, reader)
+
+        writer = csv.writer(staged)
+        accepted = rejected = 0
+        errors: list[str] = []
+        dates: list[datetime] = []
+        line = 2 if has_header else 1
+        while batch := list(islice(rows, batch_size)):
+            valid = []
+            for row in batch:
+                if any(cell.strip() for cell in row):
+                    try:
+                        valid.append(
+                            (chat_id,) + cls._parse_row(row, columns, categories, horizon)
+                        )
+                    except ValueError as error:
+                        rejected += 1
+                        if len(errors) < _MAX_ERRORS:
+                            errors.append(f'line {line}: {error}')
+                line += 1
+            writer.writerows(valid)
+            accepted += len(valid)
+            if valid:
+                batch_dates = [row[-1] for row in valid]
+                dates = [min(batch_dates + dates[:1]), max(batch_dates + dates[1:])]
+        return accepted, rejected, errors, tuple(dates)
+
+    @classmethod
+    def import_(cls, chat_id: int, file: IO[bytes],
+                batch_size: int = IMPORT_BATCH_SIZE) -> ImportSummary:
+        """
+        Add entries from CSV file to ledger of user. Valid rows are loaded
+        with COPY into staging table, then moved to ledger and added to
+        rollups with set-based queries in one transaction.
+        :param chat_id: chat id of user.
+        :param file: binary file with UTF-8 CSV, header is optional.
+        :param batch_size: rows validated at once.
+        :raise LedgerError if file can't be read or in case of db errors.
+        :return: ImportSummary.
+        """
+        text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        try:
+            with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+', newline='') as staged:
+                try:
+                    accepted, rejected, errors, dates = cls._validate(
+                        chat_id, csv.reader(text), staged, batch_size
+                    )
+                except (UnicodeDecodeError, csv.Error) as error:
+                    raise LedgerError(f'File is not valid UTF-8 CSV: {error}') from error
+                if not accepted:
+                    return ImportSummary(0, rejected, 0, errors)
+
+                staged.seek(0)
+                with DBManager().transaction() as db_manager:
+                    LedgerPartitions.create(*dates, db_manager=db_manager)
+                    db_manager.execute(_CREATE_STAGING)
+                    db_manager.copy_in(_STAGING_TABLE, _STAGING_COLS, staged)
+                    duplicates = db_manager.execute(_DELETE_DUPLICATES, fetch='one')[0]
+                    db_manager.execute(_INSERT_STAGED)
+                    Rollup.apply_staged(db_manager, _STAGING_TABLE)
+        except DBError as error:
+            raise LedgerError(str(error)) from error
+        finally:
+            text.detach()
+        invalidate_search(chat_id)
+        return ImportSummary(accepted - duplicates, rejected, duplicates, errors)
+
+    @staticmethod
+    def summary_str(summary: ImportSummary) -> str:
+        """
+        :return: import result text sent to user.
+        """
+        lines = [f'Imported {summary.accepted} entries.']
+        if summary.duplicates:
+            lines.append(f'Skipped {summary.duplicates} already recorded entries.')
+        if summary.rejected:
+            lines.append(f'Rejected {summary.rejected} rows:')
+            lines.extend(summary.errors)
+            if summary.rejected > len(summary.errors):
+                lines.append('...')
+        return '\n'.join(lines)
+
+
+def _prepend(row: list[str], rows: Iterator[list[str]]) -> Iterator[list[str]]:
+    yield row
+    yield from rows
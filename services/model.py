@@ -0,0 +1,79 @@
+"""
+Base class of models stored in db tables
+"""
+from typing import Any
+
+from db.queries import DBManager
+
+
+class Model:
+    """
+    Row of `_table_name` with attribute per column of `_table_cols`.
+    Subclasses declare `__slots__ = _table_cols`, so instances are small.
+    Changes of model attached to unit of work are tracked and flushed
+    when unit commits, see `UnitOfWork`.
+    """
+    __slots__ = ('_unit', '_original', '_dirty')
+
+    _table_name = ''
+    _table_cols: tuple = ()
+    _key_cols: tuple = ()
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        unit = getattr(self, '_unit', None)
+        if unit is not None and name in self._table_cols:
+            current = getattr(self, name)
+            if current != value:
+                self._original.setdefault(name, current)
+                self._dirty.add(name)
+                unit.mark_dirty(self)
+        object.__setattr__(self, name, value)
+
+    @property
+    def key(self) -> tuple:
+        """
+        :return: values of key columns as loaded from db.
+        """
+        original = getattr(self, '_original', {})
+        return tuple(original.get(col, getattr(self, col)) for col in self._key_cols)
+
+    def as_dict(self) -> dict[str, Any]:
+        """
+        :return: column values by column name.
+        """
+        return {col: getattr(self, col) for col in self._table_cols}
+
+    def attach(self, unit: Any) -> None:
+        """
+        Track changes of model in unit of work.
+        """
+        object.__setattr__(self, '_unit', unit)
+        object.__setattr__(self, '_original', {})
+        object.__setattr__(self, '_dirty', set())
+
+    def flush(self, db_manager: DBManager) -> None:
+        """
+        Write columns changed since last flush.
+        :param db_manager: db manager of unit transaction.
+        """
+        if self._dirty:
+            db_manager.update(
+                self._table_name, {col: getattr(self, col) for col in self._dirty},
+                dict(zip(self._key_cols, self.key)),
+            )
+            self._dirty.clear()
+
+    def commit(self) -> None:
+        """
+        Forget loaded values after unit committed.
+        """
+        self._original.clear()
+
+    def revert(self) -> None:
+        """
+        Restore loaded values after unit rolled back.
+        """
+        for col, value in self._original.items():
+            object.__setattr__(self, col, value)
+        self._original.clear()
+        self._dirty.clear()
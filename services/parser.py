@@ -0,0 +1,266 @@
+"""
+Parser of free-form expense messages like `120.50 coffee at work`.
+Category words are resolved through in-memory alias index,
+so parsing never queries db.
+"""
+import re
+import threading
+import unicodedata
+from collections import namedtuple
+from decimal import Decimal
+from typing import Callable, Iterable, Optional
+
+from .exceptions import LedgerError
+
+
+ParsedEntry = namedtuple('ParsedEntry', 'amount currency codename note')
+
+CURRENCY_SYMBOLS = {
+    '$': 'USD',
+    '€': 'EUR',
+    '£': 'GBP',
+    '₴': 'UAH',
+}
+
+_AMOUNT = re.compile(
+    r'^(?P<prefix>[$€£₴])?(?P<amount>\d{1,10}(?:[.,]\d{1,2})?)(?P<suffix>[$€£₴]|[a-zA-Z]{3})?$'
+)
+_PUNCTUATION = '.,;:!?()"\''
+_AMBIGUOUS = object()
+
+
+def fold(text: str) -> str:
+    """
+    Normalize text for matching: strip diacritics and fold case.
+    Example: `Café` -> `cafe`.
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+class _TrieNode:
+    """
+    Node of alias trie. `value` is codename of alias ending at the node,
+    `unique` is codename shared by all aliases below the node or
+    `_AMBIGUOUS` if they point to different categories.
+    """
+    __slots__ = ('children', 'value', 'unique')
+
+    def __init__(self) -> None:
+        self.children: dict[str, '_TrieNode'] = {}
+        self.value: Optional[str] = None
+        self.unique = None
+
+
+class AliasIndex:
+    """
+    Index of category aliases supporting exact multi-word lookup,
+    unique prefix lookup and fuzzy lookup of misspelled words.
+    Fuzzy lookup uses precomputed single-deletion variants of aliases,
+    so it costs a few dict lookups instead of comparing word with
+    every alias.
+    """
+
+    def __init__(self, aliases: Iterable[tuple[str, str]], min_prefix: int = 3,
+                 min_fuzzy: int = 4) -> None:
+        """
+        :param aliases: pairs of alias and category codename.
+        :param min_prefix: shortest word matched as prefix.
+        :param min_fuzzy: shortest word matched fuzzily.
+        """
+        self.min_prefix = min_prefix
+        self.min_fuzzy = min_fuzzy
+        self._root = _TrieNode()
+        self._variants: dict[str, set[str]] = {}
+        self.size = 0
+        for alias, codename in aliases:
+            self.add(alias, codename)
+
+    def add(self, alias: str, codename: str) -> None:
+        """
+        Add alias of category to index. Alias may contain several words.
+        """
+        alias = ' '.join(fold(alias).split())
+        if not alias:
+            return
+        node = self._root
+        for char in alias:
+            node = node.children.setdefault(char, _TrieNode())
+            if node.unique is None:
+                node.unique = codename
+            elif node.unique != codename:
+                node.unique = _AMBIGUOUS
+        if node.value is None:
+            self.size += 1
+        node.value = codename
+
+        if ' ' not in alias and len(alias) >= self.min_fuzzy:
+            for variant in _variants(alias):
+                self._variants.setdefault(variant, set()).add(codename)
+
+    def match(self, words: list[str], start: int = 0) -> Optional[tuple[str, int]]:
+        """
+        Find longest alias equal to words starting at `start`.
+        :param words: folded words of message.
+        :return: codename and number of matched words or None.
+        """
+        node = self._root
+        best = None
+        for position in range(start, len(words)):
+            if position > start:
+                node = node.children.get(' ')
+                if node is None:
+                    break
+            for char in words[position]:
+                node = node.children.get(char)
+                if node is None:
+                    return best
+            if node.value is not None:
+                best = node.value, position - start + 1
+        return best
+
+    def match_prefix(self, word: str) -> Optional[str]:
+        """
+        :param word: folded word.
+        :return: codename if all aliases starting with word
+                 belong to one category else None.
+        """
+        if len(word) < self.min_prefix:
+            return None
+        node = self._root
+        for char in word:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return None if node.unique is _AMBIGUOUS else node.unique
+
+    def match_fuzzy(self, word: str) -> Optional[str]:
+        """
+        :param word: folded word.
+        :return: codename of single-word alias which differs from word
+                 by one inserted, deleted, replaced or two swapped letters,
+                 None if there is no such alias or aliases belong to
+                 different categories.
+        """
+        if len(word) < self.min_fuzzy:
+            return None
+        codenames: set[str] = set()
+        for variant in _variants(word):
+            codenames.update(self._variants.get(variant, ()))
+        return codenames.pop() if len(codenames) == 1 else None
+
+
+def _variants(word: str) -> set[str]:
+    """
+    :return: word itself and all words produced by deleting one letter.
+    """
+    return {word} | {word[:position] + word[position + 1:] for position in range(len(word))}
+
+
+class ExpenseParser:
+    """
+    Parse messages in free form: amount with optional currency
+    anywhere in message, category word or alias anywhere in message,
+    other words become note.
+    Examples: `120.50 coffee at work`, `taxi 15$`, `300 UAH groceries`.
+    """
+
+    def __init__(self, load_index: Callable[[], AliasIndex], currencies: list[str],
+                 default_currency: str) -> None:
+        """
+        :param load_index: builds alias index from category catalog.
+        :param currencies: supported currency codes.
+        :param default_currency: currency used if message has none.
+        """
+        self._load_index = load_index
+        self.currencies = currencies
+        self.default_currency = default_currency
+        self._index: Optional[AliasIndex] = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        """
+        Drop alias index. It is rebuilt on next parse.
+        """
+        self._version += 1
+        self._index = None
+
+    @property
+    def index(self) -> AliasIndex:
+        """
+        :return: alias index, built on first access after invalidation.
+        """
+        index = self._index
+        if index is None:
+            with self._lock:
+                index = self._index
+                if index is None:
+                    version = self._version
+                    index = self._load_index()
+                    if version == self._version:
+                        self._index = index
+        return index
+
+    def parse(self, text: str) -> ParsedEntry:
+        """
+        :param text: message text.
+        :raise LedgerError if message has no amount or no known category.
+        :return: ParsedEntry named tuple.
+        """
+        words = text.split()
+        folded = [fold(word.strip(_PUNCTUATION)) for word in words]
+        used = [False] * len(words)
+
+        amount, currency = None, None
+        for position, word in enumerate(words):
+            if currency is None and word.upper() in self.currencies:
+                currency = word.upper()
+                used[position] = True
+            elif amount is None and (match := _AMOUNT.match(word)):
+                amount = Decimal(match['amount'].replace(',', '.'))
+                symbol = match['prefix'] or match['suffix']
+                if symbol:
+                    symbol = CURRENCY_SYMBOLS.get(symbol, symbol.upper())
+                    if symbol not in self.currencies:
+                        raise LedgerError(f'Supported currencies: {", ".join(self.currencies)}')
+                    currency = symbol
+                used[position] = True
+
+        if amount is None:
+            raise LedgerError('Send expense as `<amount> <category> [<note>]`')
+        if amount <= 0:
+            raise LedgerError('Amount must be positive number')
+
+        codename = self._find_category(folded, used)
+        if codename is None:
+            raise LedgerError('Unknown category. Send `<amount> <category> [<note>]`')
+
+        note = ' '.join(word for word, is_used in zip(words, used) if not is_used)
+        return ParsedEntry(
+            amount.quantize(Decimal('0.01')), currency or self.default_currency,
+            codename, note or None,
+        )
+
+    def _find_category(self, words: list[str], used: list[bool]) -> Optional[str]:
+        """
+        Try exact alias match at every position, then prefix match,
+        then fuzzy match. Matched words are marked as used.
+        """
+        index = self.index
+        for position in range(len(words)):
+            if used[position]:
+                continue
+            match = index.match(words, position)
+            if match:
+                codename, length = match
+                for offset in range(length):
+                    used[position + offset] = True
+                return codename
+
+        for matcher in (index.match_prefix, index.match_fuzzy):
+            for position, word in enumerate(words):
+                if not used[position] and (codename := matcher(word)):
+                    used[position] = True
+                    return codename
+        return None
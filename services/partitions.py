@@ -0,0 +1,179 @@
+"""
+Monthly partitions of the ledger and archival of old ones.
+Archived partitions are detached, written to gzipped CSV files and
+dropped. Rollups keep their totals, so reports of archived months work.
+"""
+import gzip
+import os
+import re
+from collections import namedtuple
+from datetime import date, datetime
+from pathlib import Path
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from psycopg2 import sql
+
+from config.settings import LEDGER_ARCHIVE_DIR, LEDGER_PARTITIONS_AHEAD, REPORT_TIMEZONE
+from db.exceptions import DBError
+from db.queries import DBManager
+from .exceptions import LedgerError
+
+Partition = namedtuple('Partition', 'name month')
+ArchivedPartition = namedtuple('ArchivedPartition', 'name month entries path')
+
+report_timezone = ZoneInfo(REPORT_TIMEZONE)
+
+_PARTITION_NAME = re.compile(r'ledger_(\d{4})_(\d{2})')
+_PARTITIONS = '''
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'ledger'::regclass
+'''
+_CREATE = 'SELECT ledger_create_partitions(%s, %s, %s)'
+
+
+def month_start(month: date) -> datetime:
+    """
+    :return: start of month in report timezone, partition boundary.
+    """
+    return datetime(month.year, month.month, 1, tzinfo=report_timezone)
+
+
+def next_month(month: date) -> date:
+    """
+    :return: first day of month after given one.
+    """
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+class LedgerPartitions:
+    """
+    Ledger is partitioned by month of `created_at` in report timezone,
+    partition of month is named `ledger_YYYY_MM`.
+    """
+
+    @staticmethod
+    def create(since: datetime, until: datetime, db_manager: DBManager = None) -> int:
+        """
+        Create missing partitions for months from `since` to `until`.
+        Partitions of archived months are not created.
+        :param db_manager: db manager with open transaction to create them in.
+        :raise LedgerError in case of db errors.
+        :return: number of created partitions.
+        """
+        try:
+            return (db_manager or DBManager()).execute(
+                _CREATE, (since, until, REPORT_TIMEZONE), fetch='one'
+            )[0]
+        except DBError as error:
+            raise LedgerError(str(error)) from error
+
+    @classmethod
+    def create_upcoming(cls, months: int = LEDGER_PARTITIONS_AHEAD) -> int:
+        """
+        Create partitions of current month and `months` next ones.
+        :return: number of created partitions.
+        """
+        today = datetime.now(report_timezone).date().replace(day=1)
+        until = today
+        for _ in range(months):
+            until = next_month(until)
+        return cls.create(month_start(today), month_start(until))
+
+    @staticmethod
+    def get_all() -> list[Partition]:
+        """
+        :return: attached partitions ordered by month.
+        :raise LedgerError in case of db errors.
+        """
+        try:
+            rows = DBManager(use_replicas=False).execute(_PARTITIONS, fetch='all')
+        except DBError as error:
+            raise LedgerError(str(error)) from error
+        partitions = []
+        for name, in rows:
+            if match := _PARTITION_NAME.fullmatch(name):
+                partitions.append(
+                    Partition(name, date(int(match.group(1)), int(match.group(2)), 1))
+                )
+        return sorted(partitions, key=lambda partition: partition.month)
+
+    @staticmethod
+    def archive_horizon(db_manager: DBManager = None) -> Optional[datetime]:
+        """
+        :param db_manager: db manager with open transaction to read in.
+        :return: end of the last archived month, entries before it are
+                 not in the ledger, None if nothing was archived.
+        :raise LedgerError in case of db errors.
+        """
+        try:
+            return (db_manager or DBManager(use_replicas=False)).execute(
+                'SELECT max(range_end) FROM ledger_archive', fetch='one'
+            )[0]
+        except DBError as error:
+            raise LedgerError(str(error)) from error
+
+    @classmethod
+    def archive(cls, before: date, directory: Path = Path(LEDGER_ARCHIVE_DIR)
+                ) -> list[ArchivedPartition]:
+        """
+        Archive partitions of months before given one, oldest first.
+        Every partition is copied to `<directory>/<name>.csv.gz`,
+        detached and dropped in one transaction, which blocks ledger
+        only for detaching.
+        :param before: first month which is kept, not later than current month.
+        :param directory: directory for archive files.
+        :raise LedgerError if month is not in the past or in case of db errors.
+        :return: archived partitions.
+        """
+        if before > datetime.now(report_timezone).date().replace(day=1):
+            raise LedgerError('Only months before current one can be archived')
+        directory.mkdir(parents=True, exist_ok=True)
+        archived = []
+        for partition in cls.get_all():
+            if partition.month >= before:
+                break
+            archived.append(cls._archive_one(partition, directory))
+        return archived
+
+    @staticmethod
+    def _archive_one(partition: Partition, directory: Path) -> ArchivedPartition:
+        path = directory / f'{partition.name}.csv.gz'
+        temporary = path.with_name(path.name + '.tmp')
+        table = sql.Identifier(partition.name)
+        try:
+            with DBManager(use_replicas=False).transaction() as db_manager:
+                # writes to the month wait until it is archived
+                db_manager.execute(
+                    sql.SQL('LOCK TABLE {} IN SHARE MODE').format(table).as_string(
+                        db_manager.connection
+                    )
+                )
+                with open(temporary, 'wb') as raw:
+                    with gzip.GzipFile(fileobj=raw, mode='wb') as file:
+                        entries = db_manager.copy_out(
+                            sql.SQL('SELECT * FROM {} ORDER BY created_at, id').format(table),
+                            file, label='copy_out:ledger_archive',
+                        )
+                    raw.flush()
+                    os.fsync(raw.fileno())
+                os.replace(temporary, path)
+                db_manager.execute(
+                    sql.SQL('ALTER TABLE ledger DETACH PARTITION {}').format(table).as_string(
+                        db_manager.connection
+                    )
+                )
+                db_manager.insert('ledger_archive', {
+                    'partition_name': partition.name,
+                    'range_start': month_start(partition.month),
+                    'range_end': month_start(next_month(partition.month)),
+                    'entries': entries,
+                    'path': str(path),
+                })
+                db_manager.execute(
+                    sql.SQL('DROP TABLE {}').format(table).as_string(db_manager.connection)
+                )
+        except DBError as error:
+            temporary.unlink(missing_ok=True)
+            raise LedgerError(f'Archiving {partition.name} failed: {error}') from error
+        return ArchivedPartition(partition.name, partition.month, entries, path)
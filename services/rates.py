@@ -0,0 +1,249 @@
+"""
+Currency rates loaded by admins from CSV files or commands.
+Rates are stored per day relative to DEFAULT_CURRENCY, a rate is valid
+until the next known one. Reports convert totals with them in db,
+see `Rollup.get_report`.
+"""
+import csv
+import io
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from typing import IO, Iterable, Optional
+
+from config.settings import (CURRENCIES, DEFAULT_CURRENCY, IMPORT_BATCH_SIZE, RATE_CACHE_SIZE,
+                             RATE_CACHE_TTL)
+from db.exceptions import DBError
+from db.queries import DBManager
+from .cache import ObservableCache
+from .exceptions import RateError
+from .partitions import report_timezone
+
+Rate = namedtuple('Rate', 'currency day rate')
+RateSummary = namedtuple('RateSummary', 'loaded rejected errors')
+
+RATE_COLUMNS = ('date', 'currency', 'rate')
+_TABLE_NAME = 'currency_rate'
+_TABLE_COLS = ('currency', 'day', 'rate')
+_MAX_RATE = Decimal('1e10')
+_MAX_ERRORS = 10
+_MISSING = object()
+
+# latest rate on or before every requested day, one index lookup per key
+_RATES_ON = '''
+    SELECT k.currency, k.day, (
+        SELECT r.rate FROM currency_rate r
+        WHERE r.currency = k.currency AND r.day <= k.day
+        ORDER BY r.day DESC LIMIT 1
+    )
+    FROM unnest(%s::char(3)[], %s::date[]) AS k(currency, day)
+'''
+
+# rate or None by (currency, day), cleared when rates are loaded
+rate_cache = ObservableCache(RATE_CACHE_SIZE, RATE_CACHE_TTL)
+
+
+class Rates:
+    """
+    Rates of CURRENCIES to DEFAULT_CURRENCY by day.
+    """
+
+    @staticmethod
+    def get_many(keys: Iterable[tuple[str, date]]) -> dict[tuple[str, date], Optional[Decimal]]:
+        """
+        Get rates of several currencies and days. Cached rates are not
+        read again, missing ones are read with one query.
+        :param keys: `(currency, day)` pairs.
+        :raise RateError in case of db errors.
+        :return: rate or None if it is unknown by `(currency, day)`.
+        """
+        rates: dict[tuple[str, date], Optional[Decimal]] = {}
+        missing = []
+        for key in keys:
+            if key in rates:
+                continue
+            if key[0] == DEFAULT_CURRENCY:
+                rates[key] = Decimal(1)
+            elif (rate := rate_cache.get(key, _MISSING)) is not _MISSING:
+                rates[key] = rate
+            else:
+                rates[key] = None
+                missing.append(key)
+        if not missing:
+            return rates
+
+        currencies, days = zip(*missing)
+        try:
+            rows = DBManager().execute(_RATES_ON, (list(currencies), list(days)), fetch='all')
+        except DBError as error:
+            raise RateError(str(error)) from error
+        for currency, day, rate in rows:
+            rates[(currency, day)] = rate
+            rate_cache.set((currency, day), rate)
+        return rates
+
+    @classmethod
+    def get(cls, currency: str, day: date) -> Optional[Decimal]:
+        """
+        :raise RateError in case of db errors.
+        :return: units of DEFAULT_CURRENCY for one unit of currency on
+                 day, None if currency has no rate on or before day.
+        """
+        return cls.get_many(((currency, day),))[(currency, day)]
+
+    @classmethod
+    def convert(cls, amount: Decimal, currency: str, target: str, day: date) -> Decimal:
+        """
+        Convert amount with rates of day. Used for single amounts,
+        totals of reports are converted in db.
+        :raise RateError if rate is unknown or in case of db errors.
+        :return: amount in target currency, not rounded.
+        """
+        if currency == target:
+            return amount
+        rates = cls.get_many(((currency, day), (target, day)))
+        for code in (currency, target):
+            if rates[(code, day)] is None:
+                raise RateError(f'No rate of {code} on {day}')
+        return amount * rates[(currency, day)] / rates[(target, day)]
+
+    @staticmethod
+    def _parse_row(row: list[str]) -> Rate:
+        """
+        Parse `<date> <currency> <rate>` values.
+        :raise ValueError with reason if values are invalid.
+        """
+        day_text, currency, rate_text = (cell.strip() for cell in row)
+        try:
+            day = date.fromisoformat(day_text)
+        except ValueError:
+            raise ValueError(f'invalid date {day_text!r}, use YYYY-MM-DD') from None
+        currency = currency.upper()
+        if currency not in CURRENCIES or currency == DEFAULT_CURRENCY:
+            raise ValueError(f'unsupported currency {currency!r}')
+        try:
+            rate = Decimal(rate_text.replace(',', '.'))
+        except InvalidOperation:
+            raise ValueError(f'invalid rate {rate_text!r}') from None
+        if not rate.is_finite() or not 0 < rate < _MAX_RATE:
+            raise ValueError(f'invalid rate {rate_text!r}')
+        return Rate(currency, day, rate)
+
+    @staticmethod
+    def _save(rates: list[Rate], batch_size: int) -> None:
+        """
+        Insert or replace rates in one transaction and drop cached ones.
+        Rates cached by other processes expire after RATE_CACHE_TTL.
+        """
+        # last rate of currency and day in file wins
+        rows = list({(rate.currency, rate.day): rate for rate in rates}.values())
+        with DBManager().transaction() as db_manager:
+            for start in range(0, len(rows), batch_size):
+                db_manager.upsert_many(
+                    _TABLE_NAME, _TABLE_COLS, ('currency', 'day'), rows[start:start + batch_size]
+                )
+        rate_cache.clear()
+
+    @classmethod
+    def set(cls, context_args: list[str, ]) -> Rate:
+        """
+        Set rate of currency from day.
+        :param context_args: `/set_rate <currency> <rate> [<YYYY-MM-DD>]`
+               command arguments, today by default.
+        :raise RateError in case of invalid arguments or db errors.
+        :return: saved Rate.
+        """
+        if len(context_args) not in (2, 3):
+            raise RateError('Invalid command. Use `/set_rate <currency> <rate> [<YYYY-MM-DD>]`')
+        today = datetime.now(report_timezone).date().isoformat()
+        currency, rate_text, day_text = (list(context_args) + [today])[:3]
+        try:
+            rate = cls._parse_row([day_text, currency, rate_text])
+        except ValueError as error:
+            raise RateError(f'Invalid command: {error}') from error
+        try:
+            cls._save([rate], 1)
+        except DBError as error:
+            raise RateError(str(error)) from error
+        return rate
+
+    @classmethod
+    def load(cls, file: IO[bytes], batch_size: int = IMPORT_BATCH_SIZE) -> RateSummary:
+        """
+        Insert or replace rates from CSV file with columns
+        `date,currency,rate`, header is optional.
+        :param file: binary file with UTF-8 CSV.
+        :param batch_size: rows upserted with one query.
+        :raise RateError if file can't be read or in case of db errors.
+        :return: RateSummary.
+        """
+        text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        rates: list[Rate] = []
+        rejected = 0
+        errors: list[str] = []
+        try:
+            for line, row in enumerate(csv.reader(text), 1):
+                if not any(cell.strip() for cell in row):
+                    continue
+                if line == 1 and [cell.strip().lower() for cell in row] == list(RATE_COLUMNS):
+                    continue
+                try:
+                    if len(row) != len(RATE_COLUMNS):
+                        raise ValueError(f'expected columns {",".join(RATE_COLUMNS)}')
+                    rates.append(cls._parse_row(row))
+                except ValueError as error:
+                    rejected += 1
+                    if len(errors) < _MAX_ERRORS:
+                        errors.append(f'line {line}: {error}')
+            if rates:
+                cls._save(rates, batch_size)
+        except (UnicodeDecodeError, csv.Error) as error:
+            raise RateError(f'File is not valid UTF-8 CSV: {error}') from error
+        except DBError as error:
+            raise RateError(str(error)) from error
+        finally:
+            text.detach()
+        return RateSummary(len(rates), rejected, errors)
+
+    @staticmethod
+    def parse_day(context_args: list[str, ]) -> date:
+        """
+        Parse `/rates` command arguments: nothing (today) or `YYYY-MM-DD`.
+        :raise RateError in case of invalid arguments.
+        """
+        if not context_args:
+            return datetime.now(report_timezone).date()
+        try:
+            return date.fromisoformat(context_args[0])
+        except ValueError as error:
+            raise RateError('Invalid date. Use `YYYY-MM-DD`') from error
+
+    @classmethod
+    def list_str(cls, day: date) -> str:
+        """
+        :raise RateError in case of db errors.
+        :return: text with rates of all currencies on day sent to user.
+        """
+        currencies = [currency for currency in CURRENCIES if currency != DEFAULT_CURRENCY]
+        if not currencies:
+            return f'Only {DEFAULT_CURRENCY} is supported'
+        rates = cls.get_many((currency, day) for currency in currencies)
+        lines = [f'Rates on {day}']
+        for currency in currencies:
+            rate = rates[(currency, day)]
+            value = f'{rate.normalize():f} {DEFAULT_CURRENCY}' if rate is not None else 'unknown'
+            lines.append(f'1 {currency} = {value}')
+        return '\n'.join(lines)
+
+    @staticmethod
+    def summary_str(summary: RateSummary) -> str:
+        """
+        :return: load result text sent to user.
+        """
+        lines = [f'Loaded {summary.loaded} rates.']
+        if summary.rejected:
+            lines.append(f'Rejected {summary.rejected} rows:')
+            lines.extend(summary.errors)
+            if summary.rejected > len(summary.errors):
+                lines.append('...')
+        return '\n'.join(lines)
@@ -0,0 +1,361 @@
+"""
+Daily and monthly ledger aggregates. Maintained incrementally on
+every ledger change, so reports never scan the ledger itself.
+"""
+from collections import defaultdict, namedtuple
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Iterable, Optional
+
+from psycopg2 import sql
+
+from config.settings import CURRENCIES, DEFAULT_CURRENCY, REPORT_TIMEZONE
+from db.exceptions import DBError
+from db.queries import DBManager
+from .category import Category
+from .exceptions import LedgerError, ReportError
+from .partitions import LedgerPartitions, report_timezone
+
+
+ReportRow = namedtuple('ReportRow', 'type codename currency total entries')
+RollupMismatch = namedtuple(
+    'RollupMismatch', 'table chat_id codename type currency period expected actual'
+)
+
+_REBUILD_DAILY = '''
+    INSERT INTO ledger_daily (chat_id, codename, type, currency, day, total, entries)
+    SELECT l.chat_id, l.codename, c.type, l.currency,
+           (l.created_at AT TIME ZONE %s)::date, sum(l.amount), count(*)
+    FROM ledger l JOIN category c ON c.codename = l.codename
+    WHERE l.created_at >= %s
+    GROUP BY 1, 2, 3, 4, 5
+'''
+_REBUILD_MONTHLY = '''
+    INSERT INTO ledger_monthly (chat_id, codename, type, currency, month, total, entries)
+    SELECT chat_id, codename, type, currency,
+           date_trunc('month', day)::date, sum(total), sum(entries)
+    FROM ledger_daily
+    WHERE day >= %s
+    GROUP BY 1, 2, 3, 4, 5
+'''
+_APPLY_STAGED = '''
+    INSERT INTO {table} (chat_id, codename, type, currency, {period}, total, entries)
+    SELECT s.chat_id, s.codename, c.type, s.currency, {period_start}, sum(s.amount), count(*)
+    FROM {staged} s JOIN category c ON c.codename = s.codename
+    GROUP BY 1, 2, 3, 4, 5
+    ORDER BY 1, 2, 3, 4, 5
+    ON CONFLICT (chat_id, {period}, codename, type, currency) DO UPDATE
+    SET total = {table}.total + EXCLUDED.total, entries = {table}.entries + EXCLUDED.entries
+'''
+_CHECK_DAILY = '''
+    WITH expected AS (
+        SELECT l.chat_id, l.codename, c.type, l.currency,
+               (l.created_at AT TIME ZONE %s)::date AS day,
+               sum(l.amount) AS total, count(*) AS entries
+        FROM ledger l JOIN category c ON c.codename = l.codename
+        WHERE l.created_at >= %s
+        GROUP BY 1, 2, 3, 4, 5
+    ), actual AS (
+        SELECT chat_id, codename, type, currency, day, total, entries
+        FROM ledger_daily WHERE entries <> 0 AND day >= %s
+    )
+    SELECT 'ledger_daily', chat_id, codename, type, currency, day,
+           e.total, a.total
+    FROM expected e FULL JOIN actual a USING (chat_id, codename, type, currency, day)
+    WHERE e.total IS DISTINCT FROM a.total OR e.entries IS DISTINCT FROM a.entries
+    LIMIT %s
+'''
+_CHECK_MONTHLY = '''
+    WITH expected AS (
+        SELECT chat_id, codename, type, currency,
+               date_trunc('month', day)::date AS month,
+               sum(total) AS total, sum(entries) AS entries
+        FROM ledger_daily WHERE entries <> 0 AND day >= %s
+        GROUP BY 1, 2, 3, 4, 5
+    ), actual AS (
+        SELECT chat_id, codename, type, currency, month, total, entries
+        FROM ledger_monthly WHERE entries <> 0 AND month >= %s
+    )
+    SELECT 'ledger_monthly', chat_id, codename, type, currency, month,
+           e.total, a.total
+    FROM expected e FULL JOIN actual a USING (chat_id, codename, type, currency, month)
+    WHERE e.total IS DISTINCT FROM a.total OR e.entries IS DISTINCT FROM a.entries
+    LIMIT %s
+'''
+# totals of period converted to target currency with rates of their
+# days, every rate is looked up once per currency and day, not per row
+_CONVERTED_REPORT = '''
+    WITH days AS (
+        SELECT type, codename, currency, day, total, entries
+        FROM ledger_daily
+        WHERE chat_id = %(chat_id)s AND day >= %(since)s AND day < %(until)s
+            AND entries <> 0
+    ), rates AS (
+        SELECT k.currency, k.day, CASE WHEN k.currency = %(base)s THEN 1 ELSE (
+            SELECT r.rate FROM currency_rate r
+            WHERE r.currency = k.currency AND r.day <= k.day
+            ORDER BY r.day DESC LIMIT 1
+        ) END AS rate
+        FROM (
+            SELECT currency, day FROM days UNION SELECT %(target)s::char(3), day FROM days
+        ) k
+    )
+    SELECT d.type, d.codename, %(target)s::char(3), round(sum(d.total * f.rate / t.rate), 2),
+           sum(d.entries),
+           min(CASE WHEN f.rate IS NULL THEN d.currency WHEN t.rate IS NULL THEN %(target)s END
+               || ' on ' || d.day)
+    FROM days d
+    JOIN rates f ON f.currency = d.currency AND f.day = d.day
+    JOIN rates t ON t.currency = %(target)s AND t.day = d.day
+    GROUP BY 1, 2
+'''
+
+
+class Rollup:
+    """
+    Ledger totals per `(chat_id, codename, type, currency)`
+    for every day and every month.
+    """
+
+    _periods = {
+        'day': 'ledger_daily',
+        'month': 'ledger_monthly',
+    }
+    _key_cols = ('chat_id', 'codename', 'type', 'currency')
+    _value_cols = ('total', 'entries')
+
+    @classmethod
+    def apply(cls, db_manager: DBManager, entries: Iterable, sign: int = 1) -> None:
+        """
+        Add entries to aggregates, or subtract them if sign is -1.
+        Must be called in the same transaction which changes the ledger.
+        :param db_manager: db manager with open transaction.
+        :param entries: LedgerEntry instances.
+        :param sign: 1 for inserted entries, -1 for deleted ones.
+        """
+        totals: dict[str, dict] = {
+            period: defaultdict(lambda: [Decimal(0), 0]) for period in cls._periods
+        }
+        for entry in entries:
+            category_type = Category.get(entry.codename).type
+            day = entry.created_at.astimezone(report_timezone).date()
+            key = (entry.chat_id, entry.codename, category_type, entry.currency)
+            for period, period_start in (('day', day), ('month', day.replace(day=1))):
+                total = totals[period][key + (period_start,)]
+                total[0] += sign * entry.amount
+                total[1] += sign
+
+        for period, table_name in cls._periods.items():
+            # sorted rows lock aggregates in the same order in every
+            # transaction, so concurrent writers don't deadlock
+            rows = sorted(key + tuple(total) for key, total in totals[period].items())
+            db_manager.increment_many(
+                table_name, cls._key_cols + (period,), cls._value_cols, rows
+            )
+
+    @classmethod
+    def apply_staged(cls, db_manager: DBManager, staged_table: str) -> None:
+        """
+        Add entries from table with ledger columns to aggregates with one
+        query per period. Used for bulk loads instead of `apply`.
+        Must be called in the same transaction which changes the ledger.
+        :param db_manager: db manager with open transaction.
+        :param staged_table: table with entries to add.
+        """
+        local_time = sql.SQL('(s.created_at AT TIME ZONE {})').format(
+            sql.Literal(REPORT_TIMEZONE)
+        )
+        period_starts = {
+            'day': local_time + sql.SQL('::date'),
+            'month': sql.SQL("date_trunc('month', {})::date").format(local_time),
+        }
+        for period, table_name in cls._periods.items():
+            query = sql.SQL(_APPLY_STAGED).format(
+                table=sql.Identifier(table_name), period=sql.Identifier(period),
+                period_start=period_starts[period], staged=sql.Identifier(staged_table),
+            )
+            db_manager.execute(query.as_string(db_manager.connection))
+
+    @classmethod
+    def rebuild(cls, since: date = None) -> None:
+        """
+        Recompute aggregates from the ledger in bulk. Months which are
+        archived keep their aggregates, ledger partitions of other months
+        are read only from `since`.
+        Concurrent ledger writes wait until rebuild is committed.
+        :param since: day in first month to rebuild, all months by default.
+        :raise ReportError in case of db errors.
+        """
+        try:
+            with DBManager().transaction() as db_manager:
+                since = cls._since(db_manager, since)
+                if since is None:
+                    db_manager.execute('TRUNCATE ledger_daily, ledger_monthly')
+                    since = date.min
+                else:
+                    db_manager.execute(
+                        'LOCK TABLE ledger_daily, ledger_monthly IN EXCLUSIVE MODE'
+                    )
+                    db_manager.execute('DELETE FROM ledger_daily WHERE day >= %s', (since,))
+                    db_manager.execute('DELETE FROM ledger_monthly WHERE month >= %s', (since,))
+                db_manager.execute(
+                    _REBUILD_DAILY, (REPORT_TIMEZONE, cls._local_start(since))
+                )
+                db_manager.execute(_REBUILD_MONTHLY, (since,))
+        except (DBError, LedgerError) as error:
+            raise ReportError(str(error)) from error
+
+    @classmethod
+    def check(cls, limit: int = 20) -> list[RollupMismatch]:
+        """
+        Compare daily aggregates with the ledger and monthly
+        aggregates with daily ones. Archived months are not checked.
+        :param limit: max number of mismatches returned per table.
+        :raise ReportError in case of db errors.
+        :return: list of RollupMismatch, empty if aggregates are consistent.
+        """
+        try:
+            with DBManager().transaction() as db_manager:
+                since = cls._since(db_manager) or date.min
+                rows = db_manager.execute(
+                    _CHECK_DAILY,
+                    (REPORT_TIMEZONE, cls._local_start(since), since, limit),
+                    fetch='all',
+                )
+                rows += db_manager.execute(_CHECK_MONTHLY, (since, since, limit), fetch='all')
+        except (DBError, LedgerError) as error:
+            raise ReportError(str(error)) from error
+        return [RollupMismatch(*row) for row in rows]
+
+    @staticmethod
+    def _since(db_manager: DBManager, since: date = None) -> Optional[date]:
+        """
+        :return: first day of first month whose aggregates can be
+                 recomputed from the ledger, None if it holds all months.
+        """
+        since = since.replace(day=1) if since else None
+        horizon = LedgerPartitions.archive_horizon(db_manager)
+        if horizon is not None:
+            horizon = horizon.astimezone(report_timezone).date()
+            return max(since, horizon) if since else horizon
+        return since
+
+    @staticmethod
+    def _local_start(day: date) -> datetime:
+        """
+        :return: start of day in report timezone.
+        """
+        if day == date.min:
+            return datetime.min.replace(tzinfo=timezone.utc)
+        return datetime(day.year, day.month, day.day, tzinfo=report_timezone)
+
+    @classmethod
+    def get_report(cls, chat_id: int, period: str, period_start: date,
+                   currency: str = None) -> list[ReportRow]:
+        """
+        Read totals of one user for one day or month.
+        :param chat_id: chat id of user.
+        :param period: `day` or `month`.
+        :param period_start: day, or first day of month.
+        :param currency: currency to convert all totals to, each daily
+               total is converted with rate of its day. Totals are kept
+               in their currencies by default.
+        :raise ReportError if rate is unknown or in case of db errors.
+        :return: list of ReportRow sorted by type and total.
+        """
+        try:
+            if currency is None:
+                rows = DBManager().select(
+                    cls._periods[period], ReportRow._fields,
+                    {'chat_id': chat_id, period: period_start},
+                )
+            else:
+                rows = cls._converted(chat_id, period, period_start, currency)
+        except DBError as error:
+            raise ReportError(str(error)) from error
+        report = [ReportRow(*row) for row in rows if row[-1]]
+        return sorted(report, key=lambda row: (row.type, -row.total))
+
+    @staticmethod
+    def _converted(chat_id: int, period: str, period_start: date,
+                   currency: str) -> list[tuple]:
+        """
+        :raise ReportError if rate of any currency and day is unknown.
+        :return: rows of converted report, summed from daily totals.
+        """
+        if period == 'day':
+            until = period_start + timedelta(days=1)
+        else:
+            until = (period_start + timedelta(days=32)).replace(day=1)
+        rows = DBManager().execute(_CONVERTED_REPORT, {
+            'chat_id': chat_id, 'since': period_start, 'until': until,
+            'base': DEFAULT_CURRENCY, 'target': currency,
+        }, fetch='all')
+        missing = min((row[-1] for row in rows if row[-1]), default=None)
+        if missing is not None:
+            raise ReportError(
+                f'No rate of {missing}. Admins can set it with `/set_rate`'
+            )
+        return [row[:-1] for row in rows]
+
+    @staticmethod
+    def parse_period(context_args: list[str, ]) -> tuple[str, date, str]:
+        """
+        Parse `/report` command arguments.
+        Supported: nothing (current month), `today`, `YYYY-MM`, `YYYY-MM-DD`.
+        :param context_args: text passed by user as command arguments.
+        :raise ReportError in case of invalid arguments.
+        :return: period, its first day and its label.
+        """
+        today = datetime.now(report_timezone).date()
+        arg = context_args[0] if context_args else ''
+        if not arg:
+            return 'month', today.replace(day=1), today.strftime('%Y-%m')
+        if arg == 'today':
+            return 'day', today, today.isoformat()
+        try:
+            if len(arg) == 7:
+                return 'month', datetime.strptime(arg, '%Y-%m').date(), arg
+            return 'day', datetime.strptime(arg, '%Y-%m-%d').date(), arg
+        except ValueError as error:
+            raise ReportError('Invalid period. Use `today`, `YYYY-MM` or `YYYY-MM-DD`') \
+                from error
+
+    @staticmethod
+    def parse_currency(context_args: list[str, ]) -> tuple[list[str, ], Optional[str]]:
+        """
+        Split currency off `/report` command arguments,
+        e.g. `/report EUR`, `/report 2021-07 EUR`.
+        :raise ReportError if currency is not supported.
+        :return: period arguments and currency or None.
+        """
+        args = list(context_args or ())
+        if args and len(args[-1]) == 3 and args[-1].isalpha():
+            currency = args.pop().upper()
+            if currency not in CURRENCIES:
+                raise ReportError(f'Supported currencies: {", ".join(CURRENCIES)}')
+            return args, currency
+        return args, None
+
+    @staticmethod
+    def format_report(label: str, report: list[ReportRow]) -> str:
+        """
+        :return: report text sent to user.
+        """
+        if not report:
+            return f'Nothing recorded for {label}'
+
+        lines = [f'Report for {label}']
+        totals: dict[tuple, Decimal] = defaultdict(Decimal)
+        current_type = None
+        for row in report:
+            if row.type != current_type:
+                current_type = row.type
+                lines.append(f'\n{current_type.capitalize()}:')
+            lines.append(f'{row.codename}: {row.total} {row.currency} ({row.entries})')
+            totals[(row.type, row.currency)] += row.total
+
+        lines.append('')
+        for (category_type, currency), total in sorted(totals.items()):
+            lines.append(f'Total {category_type}: {total} {currency}')
+        return '\n'.join(lines)
@@ -2,13 +2,20 @@
 Business logic connected to user
 """
 from telegram.message import Message
+from telegram.user import User as TelegramUser
 
-from db.queries import DBManager
+from config.settings import USER_CACHE_SIZE, USER_CACHE_TTL
+from db.async_queries import AsyncDBManager
+from db.queries import DBManager, current_unit
 from db.exceptions import DBError
+from .cache import ObservableCache
 from .exceptions import UserError
+from .model import Model
 
+user_cache = ObservableCache(USER_CACHE_SIZE, USER_CACHE_TTL)
 
-class User:
+
+class User(Model):
     """
     Class representing telegram user.
     """
@@ -21,6 +28,8 @@ class User:
         'username',
         'language_code',
     )
+    _key_cols = ('chat_id',)
+    __slots__ = _table_cols
 
     def __init__(self, chat_id: int, is_bot: bool, first_name: str,
                  last_name: str = None, username: str = None,
@@ -47,40 +56,93 @@ class User:
         Save user instance to db
         """
         try:
-            DBManager().insert(self._table_name, self.__dict__)
+            DBManager().insert(self._table_name, self.as_dict())
         except DBError as error:
             raise UserError('Please try again later.') from error
         return self
 
+    def is_outdated(self, message_user: TelegramUser) -> bool:
+        """
+        :param message_user: user who sent the message.
+        :return: True if user changed name, username or language
+                 in telegram since instance was loaded.
+        """
+        return (
+            self.first_name != message_user.first_name
+            or self.last_name != message_user.last_name
+            or self.username != message_user.username
+            or self.language_code != message_user.language_code
+        )
+
     @classmethod
     def get_or_create(cls, message: Message) -> 'User':
         """
-        Try to find user in db. If user does not exists
-        create new user in db.
+        Get user from unit of work or cache. On cache miss or if user data
+        in message differs from cached, create or update user in db with
+        single upsert query. Upsert is committed right away, outside unit
+        of work, so entries saved by other connections can refer to user.
         :param message: Telegram message from user.
         :return: User instance.
         """
+        message_user = message.from_user
+        unit = current_unit.get()
+        user = unit.get(cls, (message.chat_id,)) if unit is not None else None
+        if user is None:
+            user = user_cache.get(message.chat_id)
+        if user is not None and not user.is_outdated(message_user):
+            return unit.add(user, track=False) if unit is not None else user
+
         try:
-            user_rows = DBManager().select(
-                cls._table_name, cls._table_cols, {'chat_id': message.chat_id}
+            user_row = DBManager(join_unit=False).upsert(
+                cls._table_name, cls._message_data(message), ('chat_id',), cls._table_cols
             )
         except DBError as error:
             raise UserError('Please try again later.') from error
-        if user_rows:
-            return User(*user_rows[0])
 
-        message_user = message.from_user
-        user = cls(
-            chat_id=message_user.id,
-            is_bot=message_user.is_bot,
-            first_name=message_user.first_name,
-            last_name=message_user.last_name,
-            username=message_user.username,
-            language_code=message_user.language_code,
-        ).save()
+        user = cls(*user_row)
+        user_cache.set(user.chat_id, user)
+        if unit is not None:
+            # instance is shared with other updates through cache
+            unit.discard(cls, user.key)
+            unit.add(user, track=False)
+        return user
+
+    @classmethod
+    async def aget_or_create(cls, message: Message) -> 'User':
+        """
+        Coroutine version of `get_or_create` for asyncio mode.
+        :param message: Telegram message from user.
+        :return: User instance.
+        """
+        user = user_cache.get(message.chat_id)
+        if user is not None and not user.is_outdated(message.from_user):
+            return user
+        try:
+            user_row = await AsyncDBManager().upsert(
+                cls._table_name, cls._message_data(message), ('chat_id',), cls._table_cols
+            )
+        except DBError as error:
+            raise UserError('Please try again later.') from error
 
+        user = cls(*user_row)
+        user_cache.set(user.chat_id, user)
         return user
 
+    @staticmethod
+    def _message_data(message: Message) -> dict:
+        """
+        :return: user columns from telegram message.
+        """
+        message_user = message.from_user
+        return {
+            'chat_id': message.chat_id,
+            'is_bot': message_user.is_bot,
+            'first_name': message_user.first_name,
+            'last_name': message_user.last_name,
+            'username': message_user.username,
+            'language_code': message_user.language_code,
+        }
+
     def __str__(self) -> str:
         return self.name
 